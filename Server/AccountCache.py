@@ -0,0 +1,112 @@
+'''
+In-process cache of account rows for realm server logins.
+'''
+import threading
+import time
+from collections import OrderedDict
+
+
+class AccountCache:
+    '''
+    LRU cache username -> account dict with time to live. Unknown
+    usernames are cached too (as None), with their own negative_ttl.
+
+    >>> now = [0]
+    >>> cache = AccountCache(size=2, ttl=10, negative_ttl=1,
+    ...                      clock=lambda: now[0])
+    >>> cache.put('PLAYER', {'id': 4})
+    >>> cache.put('NOBODY', None)
+    >>> cache.get('PLAYER'), cache.get('NOBODY')
+    ({'id': 4}, None)
+    >>> 'NOBODY' in cache
+    True
+    >>> now[0] = 5
+    >>> 'NOBODY' in cache, 'PLAYER' in cache
+    (False, True)
+    >>> cache.invalidate('PLAYER')
+    >>> 'PLAYER' in cache
+    False
+    >>> cache.stats()['hits'], cache.stats()['misses']
+    (2, 2)
+    '''
+
+    def __init__(self, size=10000, ttl=300, negative_ttl=30,
+                 clock=time.monotonic):
+        self.size         = size
+        self.ttl          = ttl
+        self.negative_ttl = negative_ttl
+        self.clock        = clock
+        self.lock         = threading.Lock()
+        #username -> (expires, account)
+        self.entries      = OrderedDict()
+        self.hits          = 0
+        self.negative_hits = 0
+        self.misses        = 0
+        self.evictions     = 0
+        self.invalidations = 0
+
+    def lookup(self, username):
+        '''
+        Returns (found, account). found is False if there is no fresh
+        entry, account is None for cached unknown username.
+        '''
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self.entries[username]
+                self.misses += 1
+                return (False, None)
+            self.entries.move_to_end(username)
+            if entry[1] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return (True, entry[1])
+
+    def get(self, username):
+        return self.lookup(username)[1]
+
+    def __contains__(self, username):
+        return self.lookup(username)[0]
+
+    def put(self, username, account):
+        ttl = self.ttl if account is not None else self.negative_ttl
+        if ttl <= 0 or self.size <= 0:
+            return
+        with self.lock:
+            self.entries[username] = (self.clock() + ttl, account)
+            self.entries.move_to_end(username)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, username, **fields):
+        'Adds fields (for example derived verifier) to cached account'
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is not None and entry[1] is not None:
+                entry[1].update(fields)
+
+    def invalidate(self, username=None):
+        'Drops one username, or everything if username is None'
+        with self.lock:
+            if username is None:
+                self.invalidations += len(self.entries)
+                self.entries.clear()
+            elif self.entries.pop(username, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        return {'size'          : len(self.entries),
+                'max_size'      : self.size,
+                'hits'          : self.hits,
+                'negative_hits' : self.negative_hits,
+                'misses'        : self.misses,
+                'evictions'     : self.evictions,
+                'invalidations' : self.invalidations}
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
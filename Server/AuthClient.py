@@ -0,0 +1,216 @@
+'''
+Client side of realm server login, does what WoW client does.
+Used by benchmarks and load tests, not by the servers.
+'''
+import os
+import time
+
+from AuthLib import SRP6Client
+from SessionKeys import reconnect_digest
+from WoWPackets import *
+from Framing import Framer, FrameError, client_length
+
+from twisted.internet import defer
+from twisted.internet.protocol import ClientFactory, Protocol
+
+
+#phases of login in order, each one is timed
+phases = ('connect', 'challenge', 'proof', 'realmlist')
+
+
+class LoginError(Exception):
+    '''Login failed, phase is the one where it happened.'''
+
+    def __init__(self, phase, reason):
+        Exception.__init__(self, '{0}: {1}'.format(phase, reason))
+        self.phase  = phase
+        self.reason = reason
+
+
+class AuthClient(Protocol):
+    '''
+    One login CHALLENGE -> PROOF -> REALMLIST. Phase time is from
+    sending request to receiving complete answer, client SRP6 math is
+    not counted. After login client can stay on realm selection screen
+    and ask for realm list again every poll_interval seconds, like WoW
+    client does. Client with session key K of earlier login reconnects
+    with AUTH_RECONNECT packets instead, phases have the same names.
+    '''
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.reactor = factory.reactor
+        self.clock   = factory.clock
+        self.srp     = SRP6Client(factory.username, factory.pwHash)
+        self.framer  = Framer(client_length)
+        self.state   = 'connect'
+        self.mark    = factory.started
+        self.polls   = factory.polls
+        #delayed call of login timeout or of next poll
+        self.timer   = None
+
+    def finish(self):
+        'Time of current phase'
+        self.factory.times[self.state] = self.clock() - self.mark
+
+    def send(self, raw, state):
+        self.state = state
+        self.mark  = self.clock()
+        self.transport.write(raw)
+
+    def connectionMade(self):
+        self.finish()
+        if self.factory.timeout:
+            self.timer = self.reactor.callLater(self.factory.timeout,
+                                                self.timed_out)
+        if self.factory.K is not None:
+            challenge = RS_CLIENT_RECONNECT_CHALLENGE()
+        else:
+            challenge = RS_CLIENT_LOGON_CHALLENGE()
+        self.send(challenge.encode(self.factory.username), 'challenge')
+
+    def timed_out(self):
+        self.timer = None
+        self.factory.fail(LoginError(self.state, 'timeout'))
+        self.transport.abortConnection()
+
+    def cancel_timer(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+    def poll(self):
+        self.timer = None
+        self.send(RS_CLIENT_REALM_LIST().encode(), 'poll')
+
+    def dataReceived(self, data):
+        try:
+            self.framer.feed(data)
+            for packet in self.framer.packets():
+                if self.state == 'challenge':
+                    self.handle_CHALLENGE(packet)
+                elif self.state == 'proof' and packet[0] == 0x03:
+                    self.handle_RECONNECT_PROOF(packet)
+                elif self.state == 'proof':
+                    self.handle_PROOF(packet)
+                elif self.state in ('realmlist', 'poll'):
+                    self.handle_REALMLIST(packet)
+        except (FrameError, LoginError) as e:
+            self.factory.fail(e if isinstance(e, LoginError)
+                              else LoginError(self.state, e))
+            self.transport.loseConnection()
+
+    def handle_CHALLENGE(self, packet):
+        self.finish()
+        if self.factory.K is not None:
+            self.handle_RECONNECT_CHALLENGE(packet)
+            return
+        if len(packet) == 3:
+            raise LoginError('challenge', 'error {0}'.format(packet[2]))
+        PublicB, g, N, Salt = RS_SERVER_LOGON_CHALLENGE(packet).decode()
+        A, M1 = self.srp.process_challenge(PublicB, g, N, Salt)
+        self.send(RS_CLIENT_LOGON_PROOF().encode(A, M1), 'proof')
+
+    def handle_PROOF(self, packet):
+        self.finish()
+        error, M2 = RS_SERVER_LOGON_PROOF(packet).decode()
+        if error:
+            raise LoginError('proof', 'error {0}'.format(error))
+        if not self.srp.check_proof(M2):
+            raise LoginError('proof', 'wrong M2')
+        self.factory.K = self.srp.K
+        self.send(RS_CLIENT_REALM_LIST().encode(), 'realmlist')
+
+    def handle_RECONNECT_CHALLENGE(self, packet):
+        R = RS_SERVER_RECONNECT_CHALLENGE(packet).decode()
+        R1 = os.urandom(16)
+        R2 = reconnect_digest(self.factory.username, R1, R, self.factory.K)
+        self.send(RS_CLIENT_RECONNECT_PROOF().encode(R1, R2), 'proof')
+
+    def handle_RECONNECT_PROOF(self, packet):
+        self.finish()
+        error = RS_SERVER_RECONNECT_PROOF(packet).decode()
+        if error:
+            raise LoginError('proof', 'error {0}'.format(error))
+        self.send(RS_CLIENT_REALM_LIST().encode(), 'realmlist')
+
+    def handle_REALMLIST(self, packet):
+        if self.state == 'realmlist':
+            self.finish()
+            self.cancel_timer()
+            self.factory.logged_in()
+        else:
+            self.factory.poll_times.append(self.clock() - self.mark)
+        self.factory.realms = RS_SERVER_REALM_LIST(packet).decode()
+        if self.polls:
+            self.polls -= 1
+            self.state = 'idle'
+            self.timer = self.reactor.callLater(self.factory.poll_interval,
+                                                self.poll)
+            return
+        self.factory.succeed()
+        self.state = 'done'
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.cancel_timer()
+        if self.state != 'done':
+            state = 'poll' if self.state == 'idle' else self.state
+            self.factory.fail(LoginError(state, 'connection lost'))
+
+
+class AuthClientFactory(ClientFactory):
+    '''
+    deferred fires with dict phase -> seconds when login and all polls
+    are done, or fails with LoginError. realms are the last realm list
+    which server sent, poll_times are latencies of polls. Login is failed
+    if it takes more than timeout seconds after connection. K is session
+    key of earlier login to reconnect with, after full login it is the
+    new one.
+    '''
+
+    def __init__(self, username, pwHash, reactor=None, timeout=None,
+                 polls=0, poll_interval=5.0, clock=time.perf_counter,
+                 K=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.username = username
+        self.pwHash   = pwHash
+        self.reactor  = reactor
+        self.timeout  = timeout
+        self.polls    = polls
+        self.poll_interval = poll_interval
+        self.clock    = clock
+        self.started  = clock()
+        self.times    = {}
+        self.realms   = None
+        self.poll_times = []
+        self.K        = K
+        self.deferred = defer.Deferred()
+
+    def buildProtocol(self, addr):
+        return AuthClient(self)
+
+    def logged_in(self):
+        self.times['total'] = self.clock() - self.started
+
+    def succeed(self):
+        if not self.deferred.called:
+            self.deferred.callback(self.times)
+
+    def fail(self, error):
+        if not self.deferred.called:
+            self.deferred.errback(error)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.fail(LoginError('connect', reason.getErrorMessage()))
+
+
+def login(reactor, host, port, username, pwHash, timeout=30, **kwargs):
+    '''
+    Deferred with phase times of one login, kwargs are options of
+    AuthClientFactory.
+    '''
+    factory = AuthClientFactory(username, pwHash, reactor, timeout, **kwargs)
+    reactor.connectTCP(host, port, factory, timeout)
+    return factory.deferred
@@ -3,8 +3,6 @@ implementation of WoW 1.12 server SRP6 protocol
 https://en.wikipedia.org/wiki/Secure_Remote_Password_protocol#Implementation_example_in_Python
 http://srp.stanford.edu/design.html
 '''
-import functools
-import operator
 import os
 import hashlib
 import cryptography
@@ -18,13 +16,16 @@ sha1 = hashlib.sha1
 
 #OpenSSL primitives for work with "Big Numbers" https://www.openssl.org/docs/manmaster/crypto/bn.html
 BN_new     = backend._lib.BN_new
+BN_free    = backend._lib.BN_free
 BN_CTX_new = backend._lib.BN_CTX_new
+BN_CTX_free = backend._lib.BN_CTX_free
 BN_bin2bn  = backend._lib.BN_bin2bn 
 BN_mod_exp = backend._lib.BN_mod_exp
 BN_mod     = backend._lib.BN_mod
 BN_mul     = backend._lib.BN_mul
 BN_add     = backend._lib.BN_add
 BN_bn2bin  = backend._lib.BN_bn2bin
+BN_num_bytes = backend._lib.BN_num_bytes
 RAND_bytes = backend._lib.RAND_bytes
 BN_to_int  = backend._bn_to_int
 #constructor of pointers to C arrays
@@ -32,12 +33,63 @@ Cnew       = backend._ffi.new
 #python-list-like interface to access to C arrays
 buffer     = backend._ffi.buffer
 null       = backend._ffi.NULL
+#attach destructor to C object, called when python object is collected
+gc         = backend._ffi.gc
 
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
 
 
 
 
-#service functions
+
+#bytes helpers, SRP6Engine and SRP6Client work with them
+
+def interleave(b1, b2):
+    '''
+    Bytes of b1 and b2 in turn, both have the same length.
+    >>> interleave(b'aaa', b'bbb')
+    b'ababab'
+    '''
+    out = bytearray(len(b1) * 2)
+    out[::2]  = b1
+    out[1::2] = b2
+    return bytes(out)
+
+def session_key(S):
+    '''
+    Session key K of 32 bytes S: sha1 of even and odd bytes interleaved.
+    >>> len(session_key(bytes(32)))
+    40
+    '''
+    return interleave(sha1(S[::2]).digest(), sha1(S[1::2]).digest())
+
+def ng_hash(N, g):
+    'sha1(N) xor sha1(g), it is the same for all logins'
+    return bytes(i ^ j for i, j in zip(sha1(N).digest(), sha1(g).digest()))
+
+def proof_M1(ngHash, login, Salt, A, PublicB, K):
+    'Client proof, login is account name as bytes'
+    h = sha1(ngHash)
+    h.update(sha1(login).digest())
+    h.update(Salt)
+    h.update(A)
+    h.update(PublicB)
+    h.update(K)
+    return h.digest()
+
+def proof_M2(A, M1, K):
+    'Server proof'
+    h = sha1(A)
+    h.update(M1)
+    h.update(K)
+    return h.digest()
+
+
+#service functions for C arrays, kept for compatibility, SRP6Engine
+#doesn't use them
 
 def reverseC(ar):
     '''
@@ -48,9 +100,7 @@ def reverseC(ar):
     >>> [int(i) for i in buffer(b)[:]]
     [9, 8, 7, 6, 5, 4, 3, 2, 1, 0]
     '''
-    ar1 = [i for i in buffer(ar)[:]]
-    ar1.reverse()
-    buffer(ar)[:] = bytes(ar1)
+    buffer(ar)[:] = buffer(ar)[:][::-1]
 
 def blockCopy(ar1, ofs1, ar2, ofs2, count):
     '''
@@ -83,13 +133,7 @@ def Combine(b1, b2):
     '''
     if (len(b1) == len(b2)):
         buffer1 = Cnew('char[]', (len(b1) + len(b2)) ) 
-
-        buffer(buffer1)[:] = bytes(
-            list(
-                functools.reduce(
-                    operator.add,
-                    zip(buffer(b1)[:], buffer(b2)[:])))[:])
-        
+        buffer(buffer1)[:] = interleave(buffer(b1)[:], buffer(b2)[:])
         return buffer1
     else: return None
 
@@ -104,204 +148,342 @@ def Split(bo):
     [1, 3, 5, 7, 9]
     '''
 
-    buffer2 = Cnew('char[]', int(len(bo) / 2))
-    buffer3 = Cnew('char[]', int(len(bo) / 2)) 
+    data = buffer(bo)[:]
+    buffer2 = Cnew('char[]', len(bo) // 2)
+    buffer3 = Cnew('char[]', len(bo) // 2) 
 
-    buffer(buffer2)[:] = buffer(bo)[:][::2]  #even
-    buffer(buffer3)[:] = buffer(bo)[:][1::2] #odd
+    buffer(buffer2)[:] = data[::2]  #even
+    buffer(buffer3)[:] = data[1::2] #odd
     return (buffer2, buffer3)
     
     
-#Constants
+#Big number backends.
+#SRP6Engine does all its modular arithmetic through one of them, chosen
+#at startup (see bignum_backend in RealmServer.ini). Every backend works
+#with little-endian byte strings on the outside, like the WoW client does,
+#and gives identical results.
+
+class OpenSSLBackend:
+    '''
+    BIGNUM arithmetic through OpenSSL. One BN_CTX is created per backend 
+    instance and reused by all operations, BIGNUMs are freed when python
+    collects them.
+    >>> bn = OpenSSLBackend()
+    >>> bn.to_bytes(bn.mod_exp(bn.from_bytes(bytes([3])),
+    ...                        bn.from_bytes(bytes([4])),
+    ...                        bn.from_bytes(bytes([100]))), 2)
+    b'Q\\x00'
+    '''
+    name = 'openssl'
+
+    def __init__(self):
+        self.ctx = gc(BN_CTX_new(), BN_CTX_free)
+
+    def new(self):
+        return gc(BN_new(), BN_free)
+
+    def from_bytes(self, data):
+        'little-endian bytes to BIGNUM'
+        data = bytes(data)[::-1]
+        return gc(BN_bin2bn(data, len(data), null), BN_free)
+
+    def to_bytes(self, n, length):
+        'BIGNUM to little-endian bytes, padded with nulls up to length'
+        size = BN_num_bytes(n)
+        out = Cnew('unsigned char[]', size)
+        BN_bn2bin(n, out)
+        return buffer(out)[:][::-1] + bytes(length - size)
+
+    def mod_exp(self, a, p, m):
+        r = self.new()
+        #BN_mod_exp() computes a to the p-th power modulo m (r=a^p % m).
+        #This function uses less time and space than BN_exp().
+        BN_mod_exp(r, a, p, m, self.ctx)
+        return r
+
+    def mul(self, a, b):
+        r = self.new()
+        BN_mul(r, a, b, self.ctx)
+        return r
+
+    def add(self, a, b):
+        r = self.new()
+        BN_add(r, a, b)
+        return r
+
+    def mod(self, a, m):
+        r = self.new()
+        BN_mod(r, a, m, self.ctx)
+        return r
+
+
+class IntBackend:
+    '''
+    Python native int. pow() with modulus is implemented in C and there 
+    is no conversion through cffi at all.
+    >>> bn = IntBackend()
+    >>> bn.to_bytes(bn.mod_exp(bn.from_bytes(bytes([3])),
+    ...                        bn.from_bytes(bytes([4])),
+    ...                        bn.from_bytes(bytes([100]))), 2)
+    b'Q\\x00'
+    '''
+    name = 'int'
+
+    def from_bytes(self, data):
+        return int.from_bytes(bytes(data), 'little')
 
+    def to_bytes(self, n, length):
+        return int(n).to_bytes(length, 'little')
 
+    def mod_exp(self, a, p, m):
+        return pow(a, p, m)
+
+    def mul(self, a, b):
+        return a * b
+
+    def add(self, a, b):
+        return a + b
+
+    def mod(self, a, m):
+        return a % m
+
+
+class GMPYBackend(IntBackend):
+    '''
+    GMP through gmpy2, used only if gmpy2 is installed.
+    '''
+    name = 'gmpy2'
+
+    def __init__(self):
+        if gmpy2 is None:
+            raise Exception('gmpy2 backend requested, but gmpy2 is not installed')
+
+    def from_bytes(self, data):
+        return gmpy2.mpz(int.from_bytes(bytes(data), 'little'))
+
+    def mod_exp(self, a, p, m):
+        return gmpy2.powmod(a, p, m)
+
+
+backends = {OpenSSLBackend.name : OpenSSLBackend,
+            IntBackend.name     : IntBackend,
+            GMPYBackend.name    : GMPYBackend}
+
+def get_backend(name):
+    '''
+    Returns big number backend class by its name from config.
+    >>> get_backend('int')().mod_exp(7, 2, 10)
+    9
+    >>> get_backend('rsa')
+    Traceback (most recent call last):
+    ...
+    Exception: Unknown big number backend rsa, use one of openssl, int, gmpy2
+    '''
+    if name not in backends:
+        raise Exception('Unknown big number backend {0}, use one of {1}'\
+                        .format(name, ', '.join(backends)))
+    return backends[name]
+
+
+#calculate* functions take and return C arrays, see bytes helpers above
 
 # ...A and B are random one time ephemeral keys of the user and host respectively...
-def calculateB(bNg, bNn, bNk, bNv):
+def make_ephemeral(bNg, bNn, bn):
+    '''
+    Random private b and g^b mod N as (20 bytes, 32 bytes). They don't
+    depend on account, so they can be made before login comes.
+    '''
+    b = os.urandom(20)
+    return (b, bn.to_bytes(bn.mod_exp(bNg, bn.from_bytes(b), bNn), 32))
 
+def calculateB(bNg, bNn, bNk, bNv, bn, ephemeral=None):
+    '''
+    PublicB = k*v + g^b mod N. ephemeral is (b, g^b mod N) from
+    make_ephemeral, used only once. Without it they are made here.
+    '''
+    if ephemeral is None:
+        ephemeral = make_ephemeral(bNg, bNn, bn)
     PublicB =  Cnew('char[]', 32)
     b = Cnew('char[]', 20)
-    #RAND_bytes(b, 20)
-    buffer(b)[:] = bytes([27,240, 101, 209, 76, 3, 187, 19, 210, 192, 139, 227, 243, 223, 184, 36, 228, 74, 182, 91])
-    ptr1      = BN_new()
-    ptr2      = BN_new()
-    ptr3      = BN_new()
-    bnPublicB = BN_new()
-    ptr5      = BN_CTX_new()
-    reverseC(b)
-    bNb = BN_bin2bn(b, len(b), null)
-    reverseC(b)
-    #BN_mod_exp() computes a to the p-th power modulo m (r=a^p % m).
-    #This function uses less time and space than BN_exp().
-    BN_mod_exp(ptr1, bNg, bNb, bNn, ptr5)
-    #BN_mul() multiplies a and b and places the result in r (r=a*b).
-    #r may be the same BIGNUM as a or b. For multiplication by powers of 2, use BN_lshift.
-    BN_mul(ptr2, bNk, bNv, ptr5)
-    BN_add(ptr3, ptr1, ptr2)
-    BN_mod(bnPublicB, ptr3, bNn, ptr5)
-    BN_bn2bin(bnPublicB, PublicB)
-    reverseC(PublicB)
+    buffer(b)[:] = ephemeral[0]
+    bNb = bn.from_bytes(ephemeral[0])
+    bnPublicB = bn.mod(bn.add(bn.from_bytes(ephemeral[1]),
+                              bn.mul(bNk, bNv)),
+                       bNn)
+    buffer(PublicB)[:] = bn.to_bytes(bnPublicB, 32)
     return (b, bNb, PublicB)
 
 def calculateK(s):
+    K = Cnew('char[]', 40)
+    buffer(K)[:] = session_key(buffer(s)[:])
+    return K
 
-    s1, s2 = Split(s) #split s to 2 16-byte chunks
-    #sha1 hashes of s1 and s2
-    h1, h2 = Cnew('char[]', 20), Cnew('char[]', 20)
-    
-    buffer(h1)[:] = sha1(buffer(s1)[:]).digest()
-    buffer(h2)[:] = sha1(buffer(s2)[:]).digest()
-    return Combine(h1, h2)
 
 
 
-
-def calculateS(bna, bNv, bNu, bNn, bNb):
-    ptr1  = BN_new()
-    ptr2  = BN_new()
-    bns   = BN_new()
-    ptr5  = BN_CTX_new()
+def calculateS(bna, bNv, bNu, bNn, bNb, bn):
     s     = Cnew('char[]',32) 
-    BN_mod_exp(ptr1, bNv, bNu, bNn, ptr5)
-    BN_mul(ptr2, bna, ptr1, ptr5)
-    BN_mod_exp(bns, ptr2, bNb, bNn, ptr5)
-    BN_bn2bin(bns, s)
-    reverseC(s)
+    bns   = bn.mod_exp(bn.mul(bna, bn.mod_exp(bNv, bNu, bNn)), bNb, bNn)
+    buffer(s)[:] = bn.to_bytes(bns, 32)
     return s
     
 # Random scrambling parameter
-def calculateU(a, PublicB):
-    buffer1  = Cnew ('char[]',(len(a) + len(PublicB)))
-    blockCopy(a, 0, buffer1, 0, len(a))
-    blockCopy(PublicB, 0, buffer1, len(a), len(PublicB))
-    u = Cnew ('char[]',20)
-    buffer(u)[:] = sha1(bytes(buffer(buffer1)[:])).digest()
-    reverseC(u)
-    bNu = BN_bin2bn(u, len(u), null)
-    reverseC(u)
-    reverseC(a)
-    bNa = BN_bin2bn(a, len(a), null)
-    reverseC(a)
+def calculateU(a, PublicB, bn):
+    u = sha1(buffer(a)[:] + buffer(PublicB)[:]).digest()
+    bNu = bn.from_bytes(u)
+    bNa = bn.from_bytes(buffer(a)[:])
     return (bNa, bNu)
     
 # Password verifier (server side)
-def calculateV(bNg, bNx, bNn, bNk):
-    bNv = BN_new()
-    ptr1  = BN_CTX_new()
-    BN_mod_exp(bNv, bNg, bNx, bNn, ptr1)
-    return bNv
+def calculateV(bNg, bNx, bNn, bNk, bn):
+    return bn.mod_exp(bNg, bNx, bNn)
 
 #Private key .derived from p(password) and s(users salt) 
-def calculateX(pwHash, Salt, g, k, N):
-    buffer3 = Cnew('char[]', 20)
-    buffer5 = Cnew('char[]', (len(Salt) + 20) )
-    blockCopy(pwHash, 0, buffer5, len(Salt), 20)
-    blockCopy(Salt,   0, buffer5, 0,         len(Salt))
-    buffer(buffer3)[:] = sha1(bytes(buffer(buffer5)[:])).digest()
-    reverseC(buffer3)
-    bNx = BN_bin2bn(buffer3, len(buffer3), null)
-    reverseC(g)
-    bNg = BN_bin2bn(g, len(g), null)
-    reverseC(g)
-    reverseC(k)
-    bNk = BN_bin2bn(k, len(k), null)
-    reverseC(k)
-    reverseC(N)
-    bNn = BN_bin2bn(N, len(N), null)
-    reverseC(N)
-    return (bNg, bNx, bNn, bNk)
+def calculateX(pwHash, Salt, bn):
+    x   = sha1(buffer(Salt)[:] + buffer(pwHash)[:]).digest()
+    return bn.from_bytes(x)
 
 
 def calculateM1(username, N, g, Salt, a, PublicB, ssHash):
-    nHash    = Cnew('char[]', 20)
-    gHash    = Cnew('char[]', 20) 
-    ngHash   = Cnew('char[]', 20)
-    userHash = Cnew('char[]', 20)
-
-    buffer(nHash)[:]    = sha1(buffer(N)[:]).digest()
-    buffer(gHash)[:]    = sha1(buffer(g)[:]).digest()
-    buffer(userHash)[:] = sha1(buffer(username)[:].split(b'\00')[0]).digest()
-
-    
-    buffer(ngHash)[:] = bytes([i ^ j for i, j in zip(buffer(nHash)[:], buffer(gHash)[:])])
-
-    temp =   buffer(ngHash)[:] \
-           + buffer(userHash)[:] \
-           + buffer(Salt)[:] \
-           + buffer(a)[:] \
-           + buffer(PublicB)[:] \
-           + buffer(ssHash)[:]
-
     M1 = Cnew('char[]', 20) 
-    buffer(M1)[:] = sha1(temp).digest()
+    buffer(M1)[:] = proof_M1(ng_hash(buffer(N)[:], buffer(g)[:]),
+                             buffer(username)[:].split(b'\00')[0],
+                             buffer(Salt)[:], buffer(a)[:],
+                             buffer(PublicB)[:], buffer(ssHash)[:])
     return M1
 
 def calculateM2(a, m1Loc, ssHash):
-
-
-    buffer1 = Cnew("char[]", ((len(a) + len(m1Loc)) + len(ssHash)))
-    blockCopy(a, 0, buffer1, 0, len(a))
-    blockCopy(m1Loc, 0, buffer1, len(a), len(m1Loc))
-    blockCopy(ssHash, 0, buffer1, (len(a) + len(m1Loc)), len(ssHash))
     M2 = Cnew('char[]', 20) 
-    buffer(M2)[:] = sha1(buffer(buffer1)[:]).digest()
+    buffer(M2)[:] = proof_M2(buffer(a)[:], buffer(m1Loc)[:],
+                             buffer(ssHash)[:])
     return M2
 
 
-class SRP6Engine:
+
+def make_pwHash(login, password):
     '''
-    Example variables witch emulate 1-st client logon request PLAYER:PLAYER. 
-    Login value from request, salt and pwhash stored in database.
-    >>> Salt = [173, 208, 58,  49,\
-                210, 113, 20,  70,\
-                117, 242, 112, 126,\
-                80,  38,  182, 210,\
-                241, 134, 89,  153,\
-                118, 2,   80,  170,\
-                185, 69,  224, 158,\
-                221, 42,  163, 69]
-    >>> login = bytes(map(lambda x: int(x,16),\
-             ['50','4c','41','59','45','52']))
-    >>> pwHash = map(lambda x: int(x,16),\
-             ['3c','e8','a9','6d','17','c5','ae','88',\
-              'a3','06','81','02','4e','86','27','9f',\
-              '1a','38','c0','41'])
-    >>> s = AuthSession()
-
-    Calculate some values:
-    >>> s.process_rs_logon_challenge(login, pwHash, Salt)
-
-    Check is values exists:
-    >>> all([s.bNg, s.bNx, s.bNn, s.bNk,s.bNv, s.b, s.bNb, s.PublicB])
-    True
-    
-    Recieving second packet from client with a.
-    
-    >>> a = list(map(lambda x: int(x,16),\
-        '92-B5-A2-EE-2F-48-3A-55-C0-26-6A-4B-0D-33-76-E7-AB-62-62-85-41-7D-52-41-DB-3F-1F-72-57-E0-95-5E'.split('-')))
-
-    #>>> a = map(lambda x: int(x,16),\
-    #            ['ff','be','72','5b','b2','1e','50','14',\
-    #             'c8','8b','48','1c','6b','84','b7','20',\
-    #             'a1','8b','be','6f','d0','43','c4','c6',\
-    #             'f6','10','02','a7','98','0b','04','08'])
-    
-    Calculate second part of auth.
-    >>> s.process_rs_logon_proof(a)
+    pwHash as it is stored in database, sha1 of LOGIN:PASSWORD in hex.
+    >>> make_pwHash('player', 'player')
+    '3ce8a96d17c5ae88a30681024e86279f1a38c041'
+    '''
+    return sha1('{0}:{1}'.format(login.upper(), password.upper())
+                .encode('ascii')).hexdigest()
+
 
-    Check results are exists:
-    >>> all([s.bNa, s.bNu, s.s, s.ssHash, s.M1, s.M2])
+class SRP6Client:
+    '''
+    Client half of SRP6, does what WoW client does with server challenge.
+    For benchmarks and load tests, so it uses python ints and bytes only.
+    a is private ephemeral key as little-endian bytes, random if not given.
+    '''
+    k = 3
+
+    def __init__(self, login, pwHash, a=None):
+        self.login  = login
+        self.pwHash = bytes.fromhex(pwHash)
+        self.a      = a or os.urandom(19)
+        self.M2     = None
+        #session key
+        self.K      = None
+
+    def process_challenge(self, PublicB, g, N, Salt):
+        '''
+        Takes values from RS_SERVER_LOGON_CHALLENGE, returns (A, M1)
+        for RS_CLIENT_LOGON_PROOF.
+        '''
+        number = lambda data: int.from_bytes(data, 'little')
+        nN, ng, nB = number(N), number(g), number(PublicB)
+        na = number(self.a)
+        A  = pow(ng, na, nN).to_bytes(32, 'little')
+        u  = number(sha1(A + PublicB).digest())
+        x  = number(sha1(Salt + self.pwHash).digest())
+        S  = pow((nB - self.k * pow(ng, x, nN)) % nN, na + u * x, nN)\
+             .to_bytes(32, 'little')
+        K  = session_key(S)
+        ngHash = bytes([i ^ j for i, j in zip(sha1(N).digest(),
+                                               sha1(g).digest())])
+        M1 = sha1(ngHash
+                  + sha1(self.login.encode('ascii')).digest()
+                  + Salt + A + PublicB + K).digest()
+        self.M2 = sha1(A + M1 + K).digest()
+        self.K  = K
+        return (A, M1)
+
+    def check_proof(self, M2):
+        'True if server proved it knows verifier'
+        return M2 == self.M2
+
+
+class SRPGroup:
+    '''
+    Group parameters g, k, N of SRP6 as bytes with their ngHash. They are
+    the same for every login, so engines share one immutable group and
+    its big numbers are made once for every backend.
+    >>> default_group.g, default_group.N == bytes(SRP6Engine.d_N)
+    (b'\\x07', True)
+    >>> default_group.numbers(IntBackend())[:2]
+    (7, 3)
+    >>> SRP6Engine().N is SRP6Engine(backend='int').N
     True
+    >>> default_group.g = bytes([2])
+    Traceback (most recent call last):
+    ...
+    Exception: SRP6 group can't be changed
+    '''
+    __slots__ = ('g', 'k', 'N', 'ngHash', '_numbers')
+
+    def __init__(self, g, k, N):
+        init = object.__setattr__
+        init(self, 'g', bytes([g]))
+        init(self, 'k', bytes([k]))
+        init(self, 'N', bytes(N))
+        init(self, 'ngHash', ng_hash(self.N, self.g))
+        #backend name -> (g, k, N) big numbers
+        init(self, '_numbers', {})
+
+    def __setattr__(self, name, value):
+        raise Exception("SRP6 group can't be changed")
+
+    def numbers(self, bn):
+        '(g, k, N) as big numbers of backend bn, they are only read'
+        numbers = self._numbers.get(bn.name)
+        if numbers is None:
+            numbers = self._numbers[bn.name] = (bn.from_bytes(self.g),
+                                                bn.from_bytes(self.k),
+                                                bn.from_bytes(self.N))
+        return numbers
+
 
-    >>> hexize = lambda x: hex(int(x))
-    >>> print('account', list(map(hexize,login)))
-    >>> print('a', list(map(hexize,a)))
-    >>> print('Hash', list(map(hexize,buffer(s.pwHash)[:])))
-    >>> print('PublicB', list(map(hexize,buffer(s.PublicB)[:])))
-    >>> print('ssHash', list(map(hexize,buffer(s.ssHash)[:])))
-    >>> print('M1', list(map(hexize,buffer(s.M1)[:])))
-    >>> print('M2', list(map(hexize,buffer(s.M2)[:])))
+class SRP6Engine:
+    '''
+    Server half of SRP6. Login PLAYER:PLAYER, pwHash and salt are
+    stored in database, client half is SRP6Client.
+    logon_challenge and logon_proof take and return bytes, older
+    process_rs_* methods keep results for get_* methods.
+    >>> pwHash = '3ce8a96d17c5ae88a30681024e86279f1a38c041'
+    >>> s = SRP6Engine()
+
+    Calculate challenge for the first packet of client:
+    >>> s.process_rs_logon_challenge('PLAYER', pwHash, SRP6Engine.d_Salt)
+    >>> values = s.get_raw_challenge_values()
+    >>> len(values['PublicB']), values['g'], len(values['N'])
+    (32, b'\\x07', 32)
+
+    Client answers with A and its proof M1:
+    >>> c = SRP6Client('PLAYER', pwHash)
+    >>> A, M1 = c.process_challenge(values['PublicB'], values['g'],
+    ...                             values['N'], values['Salt'])
+
+    Calculate second part of auth, proofs of both sides should match:
+    >>> s.process_rs_logon_proof(A)
+    >>> s.get_M()[0] == M1
+    True
+    >>> c.check_proof(s.get_M()[1])
+    True
 
+    Both sides have the same session key now:
+    >>> s.get_K() == c.K
+    True
     '''
     #default values
     d_g = 7
@@ -322,79 +504,188 @@ class SRP6Engine:
               118, 2,   80,  170,\
               185, 69,  224, 158,\
               221, 42,  163, 69]
-    def __init__(self, g=d_g, k=d_k, N=d_N):
-        self.g = Cnew('char[]', 1)
-        self.k = Cnew('char[]', 1)
-        self.N = Cnew('char[]', 32)
-        
-
-        buffer(self.g)[:] = bytes([g])
-        buffer(self.k)[:] = bytes([k])
-        buffer(self.N)[:] = bytes(N)
-
-
-
-    def process_rs_logon_challenge(self, login, pwHash, Salt=d_Salt):
-        self.login = Cnew('char[]', 20)
-        buffer(self.login)[:len(login)] = bytes(login, 'ascii')
-        self.pwHash = Cnew('char[]', 20)
-        buffer(self.pwHash)[:] = codecs.decode(pwHash, 'hex')
-        
-        self.Salt = Cnew('char[]', 32)
-        buffer(self.Salt)[:] = bytes(Salt)
-
-        self.bNg, self.bNx, self.bNn, self.bNk = calculateX(self.pwHash,
-                                                            self.Salt,
-                                                            self.g,
-                                                            self.k,
-                                                            self.N)
-        
-        self.bNv = calculateV(self.bNg,
-                              self.bNx,
-                              self.bNn,
-                              self.bNk)
-        
-        self.b, self.bNb, self.PublicB = calculateB(self.bNg,
-                                                    self.bNn,
-                                                    self.bNk,
-                                                    self.bNv)
-        
+    def __init__(self, g=d_g, k=d_k, N=d_N, backend='openssl'):
+        #big number backend with its own reusable context
+        self.bn = get_backend(backend)()
+        #group parameters are the same for every login
+        if (g, k, list(N)) == (self.d_g, self.d_k, self.d_N):
+            self.group = default_group
+        else:
+            self.group = SRPGroup(g, k, N)
+        self.g = self.group.g
+        self.k = self.group.k
+        self.N = self.group.N
+        self.ngHash = self.group.ngHash
+        self.bNg, self.bNk, self.bNn = self.group.numbers(self.bn)
+
+    def make_verifier(self, pwHash, Salt):
+        '''
+        Password verifier v = g^x mod N as 32 little-endian bytes. 
+        It is stored in database with its salt, so logins don't need 
+        to derive it again.
+        >>> e = SRP6Engine()
+        >>> v = e.make_verifier('3ce8a96d17c5ae88a30681024e86279f1a38c041',
+        ...                     SRP6Engine.d_Salt)
+        >>> v.hex()
+        'b91b7fcfa9fe76f2e884d04987dd2dc481985a4ab7af193c74ae884db40c259d'
+        '''
+        x = sha1(bytes(Salt) + codecs.decode(pwHash, 'hex')).digest()
+        return self.bn.to_bytes(self.bn.mod_exp(self.bNg,
+                                                self.bn.from_bytes(x),
+                                                self.bNn), 32)
+
+    def make_ephemeral(self):
+        '''
+        (b, g^b mod N) for process_rs_logon_challenge, see EphemeralPool
+        in AuthWorkers.py.
+        >>> e = SRP6Engine()
+        >>> b, gb = e.make_ephemeral()
+        >>> len(b), len(gb), e.make_ephemeral()[0] != b
+        (20, 32, True)
+        >>> e.process_rs_logon_challenge('PLAYER',
+        ...     '3ce8a96d17c5ae88a30681024e86279f1a38c041', ephemeral=(b, gb))
+        >>> e.get_raw_challenge_values()['b'] == b
+        True
+        '''
+        return make_ephemeral(self.bNg, self.bNn, self.bn)
+
+    #bytes API: arguments and results are bytes, nothing goes through
+    #C arrays
+
+    def logon_challenge(self, login, Salt, verifier=None, pwHash=None,
+                        ephemeral=None):
+        '''
+        Returns PublicB. Without stored verifier it is derived from
+        pwHash (hex string).
+        >>> e = SRP6Engine(backend='int')
+        >>> v = e.make_verifier('3ce8a96d17c5ae88a30681024e86279f1a38c041',
+        ...                     SRP6Engine.d_Salt)
+        >>> B = e.logon_challenge('PLAYER', bytes(SRP6Engine.d_Salt), v)
+        >>> M1, M2, K = e.logon_proof(bytes(range(32)))
+        >>> len(B), len(M1), len(M2), len(K)
+        (32, 20, 20, 40)
+        '''
+        bn = self.bn
+        self.login = bytes(login, 'ascii')
+        self.Salt  = bytes(Salt)
+        if verifier is None:
+            self.pwHash = codecs.decode(pwHash, 'hex')
+            verifier    = self.make_verifier(pwHash, self.Salt)
+        else:
+            self.pwHash = None
+        self.bNv = bn.from_bytes(verifier)
+        if ephemeral is None:
+            ephemeral = self.make_ephemeral()
+        self.b   = bytes(ephemeral[0])
+        self.bNb = bn.from_bytes(self.b)
+        self.PublicB = bn.to_bytes(bn.mod(bn.add(bn.from_bytes(ephemeral[1]),
+                                                 bn.mul(self.bNk, self.bNv)),
+                                          self.bNn), 32)
         self.status = 'client challenge calculated'
+        return self.PublicB
+
+    def logon_proof(self, A):
+        '''
+        Returns (M1, M2, K) for public key A of client. A which is 0
+        mod N would make S = 0 and proof possible without password.
+        >>> e = SRP6Engine()
+        >>> pwHash = '3ce8a96d17c5ae88a30681024e86279f1a38c041'
+        >>> B = e.logon_challenge('PLAYER', bytes(SRP6Engine.d_Salt),
+        ...                       pwHash=pwHash)
+        >>> e.logon_proof(bytes(32))
+        Traceback (most recent call last):
+        ...
+        Exception: Client public key A is 0 mod N
+        >>> e.logon_proof(bytes(SRP6Engine.d_N))
+        Traceback (most recent call last):
+        ...
+        Exception: Client public key A is 0 mod N
+        '''
+        bn = self.bn
+        A  = bytes(A)
+        if bn.to_bytes(bn.mod(bn.from_bytes(A), self.bNn), 32) == bytes(32):
+            raise Exception('Client public key A is 0 mod N')
+        bNu = bn.from_bytes(sha1(A + self.PublicB).digest())
+        S  = bn.to_bytes(bn.mod_exp(bn.mul(bn.from_bytes(A),
+                                           bn.mod_exp(self.bNv, bNu, self.bNn)),
+                                    self.bNb, self.bNn), 32)
+        self.K  = session_key(S)
+        self.M1 = proof_M1(self.ngHash, self.login, self.Salt, A,
+                           self.PublicB, self.K)
+        self.M2 = proof_M2(A, self.M1, self.K)
+        self.status = 'client proof calculated'
+        return (self.M1, self.M2, self.K)
+
+    #the same with results kept in engine
+
+    def process_rs_logon_challenge(self, login, pwHash=None, Salt=d_Salt,
+                                   verifier=None, ephemeral=None):
+        '''
+        Calculates server challenge. If stored verifier for this Salt is 
+        given, pwHash is not needed and x, v are not derived. Precomputed
+        ephemeral saves modexp of g^b, see make_ephemeral.
+        '''
+        self.logon_challenge(login, Salt, verifier, pwHash, ephemeral)
 
     def process_rs_logon_proof(self,a):
-        self.a = Cnew('char[]', 32)
-        buffer(self.a)[:] = bytes(a) 
-        self.bNa, self.bNu = calculateU(self.a, self.PublicB)                              
-        self.s        = calculateS(self.bNa,
-                                   self.bNv,
-                                   self.bNu,
-                                   self.bNn,
-                                   self.bNb)                   
-        self.ssHash   = calculateK(self.s)                                         
-        self.M1       = calculateM1(self.login,
-                                    self.N,
-                                    self.g,
-                                    self.Salt,
-                                    self.a,
-                                    self.PublicB,
-                                    self.ssHash)
-        self.M2       = calculateM2(self.a, self.M1, self.ssHash)
-        self.status = 'client proof calculated'
+        self.logon_proof(a)
 
     def get_raw_challenge_values(self):
         return {
-            'N': buffer(self.N)[:],
-            'k': buffer(self.k)[:],
-            'g': buffer(self.g)[:],
-            'b': buffer(self.b)[:],
-            'PublicB': buffer(self.PublicB)[:],
-            'Salt': buffer(self.Salt)[:],
-            'login':buffer(self.login)[:],
-            'pwHash': buffer(self.pwHash)[:]}
+            'N': self.N,
+            'k': self.k,
+            'g': self.g,
+            'b': self.b,
+            'PublicB': self.PublicB,
+            'Salt': self.Salt,
+            #login was C array of 20 bytes
+            'login': self.login.ljust(20, b'\x00'),
+            'pwHash': self.pwHash}
 
     def get_M(self):
-        return (buffer(self.M1)[:],buffer(self.M2)[:])
-        
+        return (self.M1, self.M2)
+
+    def get_K(self):
+        'Session key, 40 bytes'
+        return self.K
+
+    def get_state(self):
+        '''
+        Handshake state between challenge and proof as dict of bytes, so
+        it can be pickled and proof can be calculated by another engine,
+        for example in worker process.
+        '''
+        return {'login'   : self.login,
+                'Salt'    : self.Salt,
+                'b'       : self.b,
+                'PublicB' : self.PublicB,
+                'v'       : self.bn.to_bytes(self.bNv, 32)}
+
+    def set_state(self, state):
+        '''
+        Restores state from get_state before process_rs_logon_proof.
+        >>> e1, e2 = SRP6Engine(), SRP6Engine(backend='int')
+        >>> e1.process_rs_logon_challenge('PLAYER',
+        ...                               '3ce8a96d17c5ae88a30681024e86279f1a38c041')
+        >>> e2.set_state(e1.get_state())
+        >>> e1.process_rs_logon_proof(bytes(range(32)))
+        >>> e2.process_rs_logon_proof(bytes(range(32)))
+        >>> e1.get_M() == e2.get_M()
+        True
+        '''
+        #login of older states is padded with nulls
+        self.login   = bytes(state['login']).rstrip(b'\x00')
+        self.Salt    = bytes(state['Salt'])
+        self.b       = bytes(state['b'])
+        self.PublicB = bytes(state['PublicB'])
+        self.pwHash = None
+        self.bNb    = self.bn.from_bytes(self.b)
+        self.bNv    = self.bn.from_bytes(state['v'])
+        self.status = 'client challenge calculated'
+
+
+default_group = SRPGroup(SRP6Engine.d_g, SRP6Engine.d_k, SRP6Engine.d_N)
+
 
 if __name__ == '__main__':
     import doctest
@@ -0,0 +1,218 @@
+'''
+Runs SRP6 calculations out of reactor thread.
+
+Modes:
+inline  - in reactor thread, like before. Good for development.
+thread  - in pool of threads. OpenSSL backend releases GIL inside
+          BN_mod_exp, so threads use all cores with it.
+process - in pool of processes. Works for every backend.
+
+Handshake state travels between calls as dict of bytes (see
+SRP6Engine.get_state), so it can be sent to worker process.
+
+Ephemeral (b, g^b mod N) pairs don't depend on account, EphemeralPool
+makes them ahead in the same mode, so challenge costs multiply and add
+instead of modexp.
+'''
+import os
+import threading
+import collections
+import concurrent.futures
+
+from AuthLib import SRP6Engine
+from ServerLog import auth_log
+from Metrics import registry
+
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+
+pool_size   = registry.gauge('ephemeral_pool_size',
+                             'Precomputed ephemeral keys')
+pool_misses = registry.counter('ephemeral_pool_misses_total',
+                               'Challenges with empty pool')
+
+
+#engines are reused by all jobs of one thread (or process)
+_local = threading.local()
+
+def get_engine(backend):
+    engines = getattr(_local, 'engines', None)
+    if engines is None:
+        engines = _local.engines = {}
+    if backend not in engines:
+        engines[backend] = SRP6Engine(backend=backend)
+    return engines[backend]
+
+def logon_challenge(backend, login, pwHash=None, Salt=SRP6Engine.d_Salt,
+                    verifier=None, ephemeral=None):
+    '''
+    Returns (challenge values for RS_SERVER_LOGON_CHALLENGE, state).
+    ephemeral is (b, g^b mod N) from make_ephemerals or None.
+    >>> values, state = logon_challenge('int', 'PLAYER',
+    ...                     '3ce8a96d17c5ae88a30681024e86279f1a38c041')
+    >>> sorted(state)
+    ['PublicB', 'Salt', 'b', 'login', 'v']
+    >>> values['PublicB'] == state['PublicB']
+    True
+    '''
+    engine = get_engine(backend)
+    engine.process_rs_logon_challenge(login, pwHash, Salt, verifier,
+                                      ephemeral)
+    return engine.get_raw_challenge_values(), engine.get_state()
+
+def make_ephemerals(backend, count):
+    'List of count (b, g^b mod N) pairs'
+    engine = get_engine(backend)
+    return [engine.make_ephemeral() for i in range(count)]
+
+def logon_proof(backend, state, A):
+    '''
+    Returns (M1, M2, session key) for client public key A and state
+    from logon_challenge.
+    '''
+    engine = get_engine(backend)
+    engine.set_state(state)
+    engine.process_rs_logon_proof(A)
+    return engine.get_M() + (engine.get_K(),)
+
+
+modes = ('inline', 'thread', 'process')
+
+class SRP6Executor:
+    '''
+    Runs logon_challenge and logon_proof in configured mode and returns
+    Deferreds, which fire in reactor thread. With pool_size challenges
+    take ephemeral keys from EphemeralPool.
+    '''
+
+    def __init__(self, reactor, mode='inline', workers=0, backend='openssl',
+                 pool_size=0, low_water=0, batch=64, refill_rate=0):
+        if mode not in modes:
+            raise Exception('Unknown workers mode {0}, use one of {1}'\
+                            .format(mode, ', '.join(modes)))
+        self.reactor = reactor
+        self.mode    = mode
+        self.backend = backend
+        self.workers = workers or os.cpu_count() or 1
+        self.pool    = None
+        if mode == 'thread':
+            self.pool = ThreadPool(minthreads=1,
+                                   maxthreads=self.workers,
+                                   name='srp6')
+            #threads are started with reactor, so a process which fails
+            #before reactor.run still exits
+            reactor.callWhenRunning(self.pool.start)
+            reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+        elif mode == 'process':
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+            reactor.addSystemEventTrigger('during', 'shutdown',
+                                          self.pool.shutdown)
+        self.ephemerals = None
+        if pool_size:
+            self.ephemerals = EphemeralPool(self, pool_size, low_water,
+                                            batch, refill_rate)
+            reactor.callWhenRunning(self.ephemerals.fill)
+
+    def run(self, func, *args):
+        if self.mode == 'inline':
+            return defer.maybeDeferred(func, self.backend, *args)
+        if self.mode == 'thread':
+            return threads.deferToThreadPool(self.reactor, self.pool,
+                                             func, self.backend, *args)
+        d = defer.Deferred()
+        future = self.pool.submit(func, self.backend, *args)
+        future.add_done_callback(
+            lambda f: self.reactor.callFromThread(self._fire, d, f))
+        return d
+
+    def _fire(self, d, future):
+        try:
+            result = future.result()
+        except Exception:
+            d.errback()
+        else:
+            d.callback(result)
+
+    def challenge(self, login, pwHash=None, Salt=SRP6Engine.d_Salt,
+                  verifier=None):
+        ephemeral = None
+        if self.ephemerals is not None:
+            ephemeral = self.ephemerals.take()
+        return self.run(logon_challenge, login, pwHash, Salt, verifier,
+                        ephemeral)
+
+    def proof(self, state, A):
+        return self.run(logon_proof, state, A)
+
+
+class EphemeralPool:
+    '''
+    Ephemeral keys made ahead by executor. When less than low_water are
+    left, batches are made until there are size of them, no more than
+    rate pairs per second (0 -> no limit). In inline mode batches run
+    in reactor thread between other events, keep them small there.
+    Every pair is taken once, empty pool gives None and challenge makes
+    its own pair.
+
+    >>> from twisted.internet.task import Clock
+    >>> clock = Clock()
+    >>> pool = EphemeralPool(SRP6Executor(clock, backend='int'), size=4,
+    ...                      low_water=2, batch=3)
+    >>> pool.take() is None, len(pool.pairs)
+    (True, 3)
+    >>> clock.advance(0)
+    >>> len(pool.pairs)
+    4
+    >>> b, gb = pool.take()
+    >>> pool.take() != (b, gb), len(pool.pairs)
+    (True, 4)
+    '''
+
+    def __init__(self, executor, size, low_water=0, batch=64, rate=0):
+        self.executor  = executor
+        self.reactor   = executor.reactor
+        self.size      = size
+        self.low_water = low_water
+        self.batch     = batch
+        self.rate      = rate
+        self.pairs     = collections.deque()
+        #batch which is made now, or delayed call of next one
+        self.job       = None
+        self.delayed   = None
+        pool_size.set_function(lambda: len(self.pairs))
+
+    def take(self):
+        'Pair (b, g^b mod N) or None'
+        pair = self.pairs.popleft() if self.pairs else None
+        if pair is None:
+            pool_misses.inc()
+        if len(self.pairs) <= self.low_water:
+            self.fill()
+        return pair
+
+    def fill(self):
+        'Starts next batch, unless one is made or waits already'
+        if self.job is not None or self.delayed is not None:
+            return
+        count = min(self.batch, self.size - len(self.pairs))
+        if count <= 0:
+            return
+        self.job = self.executor.run(make_ephemerals, count)
+        self.job.addCallbacks(self.filled, self.failed)
+
+    def filled(self, pairs):
+        self.job = None
+        self.pairs.extend(pairs)
+        if len(self.pairs) < self.size:
+            delay = len(pairs) / self.rate if self.rate else 0
+            self.delayed = self.reactor.callLater(delay, self.next_batch)
+
+    def next_batch(self):
+        self.delayed = None
+        self.fill()
+
+    def failed(self, failure):
+        self.job = None
+        auth_log.error('making ephemeral keys failed: %s',
+                       failure.getErrorMessage())
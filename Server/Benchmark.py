@@ -0,0 +1,391 @@
+'''
+Benchmarks of login path: SRP6 math, encode/decode of every auth packet
+and full CHALLENGE -> PROOF -> REALMLIST handshake over loopback against
+in-process RealmServer with in-memory SQLite account store. Works offline.
+
+python Server/Benchmark.py                      -> print results
+python Server/Benchmark.py --save bench.json    -> and save them as baseline
+python Server/Benchmark.py --compare bench.json -> exit with 1 if something
+                                                   is slower than baseline
+                                                   by more than threshold
+'''
+import argparse
+import json
+import sys
+import time
+
+from AuthLib import SRP6Engine, SRP6Client, backends, make_pwHash
+from WoWPackets import *
+from RealmList import RealmList
+import AuthClient
+import EventLoop
+
+
+pwHash = make_pwHash('PLAYER', 'PLAYER')
+Salt   = bytes(SRP6Engine.d_Salt)
+
+def bench_realms(count=10):
+    'Realm list of typical size, the same on every run'
+    return [{'type': 0, 'isLocked': 0, 'color': 0,
+             'name': 'PYWOW{0}'.format(i), 'address': '127.0.0.1',
+             'game_port': 8085 + i, 'comm_port': 8090 + i,
+             'population': 1, 'characters_count': 16, 'timezone': 1}
+            for i in range(count)]
+
+
+#measuring
+
+def summary(samples, elapsed):
+    '''
+    ops per second and latency percentiles in microseconds.
+    >>> s = summary([0.001] * 99 + [0.01], 0.109)
+    >>> round(s['ops']), s['p50'], s['p99'], s['max']
+    (917, 1000.0, 10000.0, 10000.0)
+    '''
+    samples = sorted(samples)
+    at = lambda part: round(samples[min(len(samples) - 1,
+                                        int(len(samples) * part))] * 1e6, 1)
+    return {'ops'   : len(samples) / elapsed if elapsed else None,
+            'count' : len(samples),
+            'p50'   : at(0.50),
+            'p90'   : at(0.90),
+            'p99'   : at(0.99),
+            'max'   : round(samples[-1] * 1e6, 1)}
+
+def measure(func, duration=1.0, warmup=100):
+    'Calls func again and again for duration seconds'
+    for i in range(warmup):
+        func()
+    clock   = time.perf_counter
+    samples = []
+    start   = clock()
+    end     = start + duration
+    while True:
+        t = clock()
+        func()
+        done = clock()
+        samples.append(done - t)
+        if done >= end:
+            break
+    return summary(samples, sum(samples))
+
+
+#micro benchmarks, each is (name, function without arguments)
+
+def srp_cases(backend):
+    engine = SRP6Engine(backend=backend)
+    verifier = engine.make_verifier(pwHash, Salt)
+    engine.process_rs_logon_challenge('PLAYER', Salt=Salt, verifier=verifier)
+    values = engine.get_raw_challenge_values()
+    client = SRP6Client('PLAYER', pwHash)
+    A, M1 = client.process_challenge(values['PublicB'], values['g'],
+                                     values['N'], values['Salt'])
+    #the same pair every time, only cost is measured
+    ephemeral = engine.make_ephemeral()
+    prefix = 'srp.{0}.'.format(backend)
+    return [(prefix + 'challenge',
+             lambda: engine.process_rs_logon_challenge('PLAYER', Salt=Salt,
+                                                       verifier=verifier)),
+            (prefix + 'challenge_pooled',
+             lambda: engine.process_rs_logon_challenge('PLAYER', Salt=Salt,
+                                                       verifier=verifier,
+                                                       ephemeral=ephemeral)),
+            (prefix + 'ephemeral', engine.make_ephemeral),
+            (prefix + 'challenge_pwhash',
+             lambda: engine.process_rs_logon_challenge('PLAYER', pwHash, Salt)),
+            (prefix + 'proof',
+             lambda: engine.process_rs_logon_proof(A))]
+
+def client_cases():
+    engine = SRP6Engine()
+    engine.process_rs_logon_challenge('PLAYER', pwHash, Salt)
+    values = engine.get_raw_challenge_values()
+    client = SRP6Client('PLAYER', pwHash)
+    return [('srp.client.challenge',
+             lambda: client.process_challenge(values['PublicB'], values['g'],
+                                              values['N'], values['Salt']))]
+
+def packet_cases():
+    realms = bench_realms()
+    proof = RS_SERVER_LOGON_PROOF()
+    proof.encode(bytes(20))
+    raw = {
+        RS_CLIENT_LOGON_CHALLENGE : RS_CLIENT_LOGON_CHALLENGE().encode('PLAYER'),
+        RS_SERVER_LOGON_CHALLENGE : RS_SERVER_LOGON_CHALLENGE().encode(
+                                        bytes(32), bytes([7]), bytes(32), Salt),
+        RS_CLIENT_LOGON_PROOF     : RS_CLIENT_LOGON_PROOF().encode(bytes(32),
+                                                                   bytes(20)),
+        RS_SERVER_LOGON_PROOF     : proof.raw,
+        RS_CLIENT_REALM_LIST      : RS_CLIENT_REALM_LIST().encode(),
+        RS_SERVER_REALM_LIST      : RS_SERVER_REALM_LIST().encode(realms),
+    }
+    encode = {
+        RS_CLIENT_LOGON_CHALLENGE : lambda p: p.encode('PLAYER'),
+        RS_SERVER_LOGON_CHALLENGE : lambda p: p.encode(bytes(32), bytes([7]),
+                                                       bytes(32), Salt),
+        RS_CLIENT_LOGON_PROOF     : lambda p: p.encode(bytes(32), bytes(20)),
+        RS_SERVER_LOGON_PROOF     : lambda p: p.encode(bytes(20)),
+        RS_CLIENT_REALM_LIST      : lambda p: p.encode(),
+        RS_SERVER_REALM_LIST      : lambda p: p.encode(realms),
+    }
+    cases = []
+    for packet in raw:
+        cases.append((packet.__name__ + '.encode',
+                      lambda packet=packet: encode[packet](packet())))
+        cases.append((packet.__name__ + '.decode',
+                      lambda packet=packet: packet(raw[packet]).decode()))
+    realm_list = RealmList(realms)
+    cases.append(('RealmList.encode', realm_list.encode))
+    return cases
+
+
+#full handshake
+
+class Handshakes:
+    '''
+    Keeps concurrency logins running until total are done. Clients come
+    from different 127.0.0.x addresses (Linux routes all of 127/8 to
+    loopback), like real clients from different hosts. Session keys of
+    logins are kept in keys, with reconnect clients use keys of earlier
+    run to log in with AUTH_RECONNECT.
+    '''
+
+    def __init__(self, reactor, port, accounts, total, concurrency,
+                 source_ips=200, keys=None, reconnect=False):
+        from twisted.internet import defer
+        self.reactor     = reactor
+        self.port        = port
+        self.accounts    = accounts
+        self.total       = total
+        self.concurrency = concurrency
+        self.source_ips  = source_ips
+        self.samples     = {phase: [] for phase in AuthClient.phases + ('total',)}
+        self.errors      = {}
+        #username -> session key
+        self.keys        = {} if keys is None else keys
+        self.reconnect   = reconnect
+        self.started     = 0
+        self.completed   = 0
+        self.finished    = defer.Deferred()
+
+    def start(self):
+        self.begin = time.perf_counter()
+        for i in range(min(self.concurrency, self.total)):
+            self.next()
+        return self.finished
+
+    def next(self):
+        username = self.accounts[self.started % len(self.accounts)]
+        bind = None
+        if self.source_ips > 1:
+            bind = ('127.0.0.{0}'.format(2 + self.started % self.source_ips), 0)
+        self.started += 1
+        K = self.keys.get(username) if self.reconnect else None
+        factory = AuthClient.AuthClientFactory(username,
+                                               make_pwHash(username, username),
+                                               K=K)
+        self.reactor.connectTCP('127.0.0.1', self.port, factory, 30, bind)
+        factory.deferred.addCallbacks(self.succeeded, self.failed,
+                                      callbackArgs=(factory,))
+        factory.deferred.addCallback(self.done)
+
+    def succeeded(self, times, factory):
+        self.keys[factory.username] = factory.K
+        for phase, seconds in times.items():
+            self.samples[phase].append(seconds)
+
+    def failed(self, failure):
+        error = str(failure.value)
+        self.errors[error] = self.errors.get(error, 0) + 1
+
+    def done(self, result):
+        self.completed += 1
+        if self.started < self.total:
+            self.next()
+        elif self.completed == self.total:
+            self.elapsed = time.perf_counter() - self.begin
+            self.finished.callback(self)
+
+    def results(self):
+        group = 'reconnect.' if self.reconnect else 'handshake.'
+        results = {}
+        for phase, samples in self.samples.items():
+            if samples:
+                result = summary(samples, self.elapsed)
+                if phase != 'total':
+                    #throughput is of whole handshakes only
+                    result['ops'] = None
+                results[group + phase] = result
+        return results
+
+def start_server(reactor, backend='openssl', workers_mode='inline',
+                 workers=0, accounts=100, pool_size=0):
+    '''
+    RealmServer on random loopback port with in-memory account store of
+    BENCH0, BENCH1... accounts, password of each is its name. pool_size
+    is size of ephemeral key pool, see AuthWorkers.EphemeralPool.
+    Returns (listening port, usernames).
+    '''
+    from database import AccountStore
+    from AccountCache import AccountCache
+    from AuthWorkers import SRP6Executor
+    from SessionKeys import KeyStore
+    import RealmServer
+
+    usernames = ['BENCH{0}'.format(i) for i in range(accounts)]
+    store = AccountStore('sqlite://', reactor=reactor, cache=AccountCache())
+    store.add_accounts([(name, make_pwHash(name, name), 0)
+                        for name in usernames])
+    server = RealmServer.RealmServer(backend, workers_mode, workers, store,
+                                     realm_list=RealmList(bench_realms()),
+                                     reconnect_keys=KeyStore(),
+                                     srp=SRP6Executor(reactor, workers_mode,
+                                                      workers, backend,
+                                                      pool_size,
+                                                      pool_size // 4))
+    return (EventLoop.listen(reactor, server, interface='127.0.0.1'),
+            usernames)
+
+def handshake(args, reconnect=False):
+    '''
+    Full logins, then as many reconnects with their session keys if
+    reconnect is set. Returns list of Handshakes runs.
+    '''
+    from twisted.internet import reactor
+
+    port, accounts = start_server(reactor, args.backend, args.workers_mode,
+                                  args.workers, args.accounts, args.pool_size)
+    runs = [Handshakes(reactor, port.getHost().port, accounts,
+                       args.handshakes, args.concurrency, args.source_ips)]
+    if reconnect:
+        runs.append(Handshakes(reactor, port.getHost().port, accounts,
+                               args.handshakes, args.concurrency,
+                               args.source_ips, runs[0].keys, True))
+
+    def run(result, index=0):
+        if index == len(runs):
+            reactor.stop()
+            return
+        d = runs[index].start()
+        d.addBoth(run, index + 1)
+    reactor.callWhenRunning(run, None)
+    reactor.run()
+    return runs
+
+
+#baseline
+
+def compare(results, baseline, threshold):
+    '''
+    Marks results which are worse than baseline by more than threshold:
+    less ops per second, or higher median latency if there is no ops.
+    Returns names of regressions.
+    >>> r = compare({'a': {'ops': 80, 'p50': 1}, 'b': {'ops': None, 'p50': 5}},
+    ...             {'a': {'ops': 100, 'p50': 1}, 'b': {'ops': None, 'p50': 4}},
+    ...             0.1)
+    >>> r
+    ['a', 'b']
+    '''
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['ops'] and base['ops']:
+            change = result['ops'] / base['ops'] - 1
+        else:
+            change = base['p50'] / result['p50'] - 1
+        result['change'] = change
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+def report(results, regressions=()):
+    print('{0:<36}{1:>12}{2:>10}{3:>10}{4:>10}{5:>10}{6:>10}'.format(
+          'benchmark', 'ops/s', 'p50 us', 'p90 us', 'p99 us', 'max us', 'change'))
+    for name, r in results.items():
+        change = ''
+        if 'change' in r:
+            change = '{0:+.1%}'.format(r['change'])
+        print('{0:<36}{1:>12}{2:>10}{3:>10}{4:>10}{5:>10}{6:>10}{7}'.format(
+              name, '{0:.0f}'.format(r['ops']) if r['ops'] else '-',
+              r['p50'], r['p90'], r['p99'], r['max'], change,
+              '  REGRESSION' if name in regressions else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Login path benchmarks')
+    parser.add_argument('--only', default='srp,packets,handshake,reconnect',
+                        help='comma separated groups: srp, packets, '
+                             'handshake, reconnect')
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='seconds for each micro benchmark')
+    parser.add_argument('--backend', default='openssl',
+                        help='big number backend of handshake server')
+    parser.add_argument('--workers-mode', default='inline')
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--handshakes', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--accounts', type=int, default=100)
+    parser.add_argument('--pool-size', type=int, default=0,
+                        help='ephemeral keys made ahead by server')
+    parser.add_argument('--source-ips', type=int, default=200,
+                        help='client addresses 127.0.0.x, 1 -> only 127.0.0.1')
+    parser.add_argument('--event-loop', default='twisted',
+                        choices=EventLoop.names,
+                        help='event loop of handshake server and clients')
+    parser.add_argument('--save', help='write results to this baseline file')
+    parser.add_argument('--compare', help='baseline file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed slowdown, 0.1 -> 10%%')
+    args = parser.parse_args(argv)
+    groups = args.only.split(',')
+    #before reactor is imported by handshake
+    EventLoop.install(args.event_loop)
+
+    cases = []
+    if 'srp' in groups:
+        for name in backends:
+            try:
+                backends[name]()
+            except Exception as e:
+                print('skip', name, e)
+                continue
+            cases += srp_cases(name)
+        cases += client_cases()
+    if 'packets' in groups:
+        cases += packet_cases()
+
+    results = {}
+    for name, func in cases:
+        results[name] = measure(func, args.duration)
+    errors = {}
+    if 'handshake' in groups or 'reconnect' in groups:
+        #reconnects need session keys of full logins
+        runs = handshake(args, 'reconnect' in groups)
+        if 'handshake' not in groups:
+            runs = runs[1:]
+        for run in runs:
+            results.update(run.results())
+            for error, count in run.errors.items():
+                errors[error] = errors.get(error, 0) + count
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.threshold)
+    report(results, regressions)
+    for error, count in errors.items():
+        print('handshake failed', count, 'times:', error)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python'  : sys.version.split()[0],
+                       'args'    : vars(args),
+                       'results' : results}, f, indent=1, sort_keys=True)
+    return 1 if regressions or errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+'''
+Persistent connection between realm server and one world server.
+
+Packets sent during one reactor tick are written to transport together,
+so heartbeats, population reports and player handoffs of thousands of
+logins make few big writes instead of many small ones. Requests get ids
+and Deferreds, answers fire them by id, so any number of requests can
+wait for answers on one connection at once.
+'''
+from CommPackets import ANSWER, VERSION, comm_type, parse_header
+from Framing import FrameError
+
+from twisted.internet import defer
+
+
+class CommTimeout(Exception):
+    '''No answer to request in time.'''
+
+
+class CommChannel:
+    '''
+    >>> from twisted.internet.task import Clock
+    >>> from twisted.test.proto_helpers import StringTransport
+    >>> from CommPackets import PING, PONG
+    >>> clock, transport = Clock(), StringTransport()
+    >>> channel = CommChannel(clock, transport)
+    >>> d = channel.request(PING)
+    >>> channel.send(PING)
+    >>> transport.value()
+    b''
+    >>> clock.advance(0)
+    >>> len(transport.value()), transport.value().count(b'\\xff\\x01')
+    (18, 2)
+    >>> channel.received(PONG().encode(True, request=1))
+    True
+    >>> PONG(d.result).decode()
+    True
+    >>> channel.received(PING().encode(request=5))
+    False
+    '''
+
+    def __init__(self, reactor, transport, traffic=None):
+        self.reactor   = reactor
+        self.transport = transport
+        #see Metrics.Traffic
+        self.traffic   = traffic
+        self.next_id   = 1
+        #request id -> (Deferred, timeout call or None)
+        self.pending   = {}
+        #packets of this tick
+        self.frames    = []
+        self.flushing  = None
+
+    def send(self, packet_class, *args, request=0):
+        'Packet goes with others of this tick'
+        self.frames.append(packet_class().encode(*args, request=request))
+        if self.flushing is None:
+            self.flushing = self.reactor.callLater(0, self.flush)
+
+    def answer(self, request, packet_class, *args):
+        self.send(packet_class, *args, request=request)
+
+    def request(self, packet_class, *args, timeout=None):
+        '''
+        Deferred which fires with raw answer, or fails with CommTimeout
+        or when connection is lost.
+        '''
+        request = self.next_id
+        self.next_id = self.next_id % 0xFFFFFFFF + 1
+        d = defer.Deferred()
+        call = None
+        if timeout:
+            call = self.reactor.callLater(timeout, self.expire, request)
+        self.pending[request] = (d, call)
+        self.send(packet_class, *args, request=request)
+        return d
+
+    def expire(self, request):
+        d, call = self.pending.pop(request)
+        d.errback(CommTimeout('no answer to request {0}'.format(request)))
+
+    def flush(self):
+        self.flushing = None
+        frames, self.frames = self.frames, []
+        if self.traffic is not None:
+            for raw in frames:
+                self.traffic.record(comm_type(raw), len(raw))
+        self.transport.write(b''.join(frames))
+
+    def received(self, raw):
+        '''
+        Checks version, answers are given to their requests and True is
+        returned. Other packets are for caller.
+        '''
+        version, size, request, type = parse_header(raw)
+        if version != VERSION:
+            raise FrameError('comm protocol version {0}, {1} is expected'
+                             .format(version, VERSION))
+        if not type & ANSWER:
+            return False
+        d, call = self.pending.pop(request, (None, None))
+        if call is not None and call.active():
+            call.cancel()
+        if d is not None:
+            d.callback(raw)
+        return True
+
+    def lost(self, reason):
+        'Connection is lost, unsent packets are dropped, requests fail'
+        if self.flushing is not None and self.flushing.active():
+            self.flushing.cancel()
+        self.flushing = None
+        self.frames = []
+        pending, self.pending = self.pending, {}
+        for d, call in pending.values():
+            if call is not None and call.active():
+                call.cancel()
+            d.errback(reason)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
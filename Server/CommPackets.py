@@ -1,44 +1,130 @@
 # this file contains packets of internal communication between servers
+'''
+Every internal packet is frame with header:
+uint8  marker   0xFF, world server tells them from client packets by it
+uint8  version  of protocol, peers with other version are disconnected
+uint16 size     of body after header
+uint32 request  id of request, answer has the same id, 0 -> no answer
+uint8  type     answer has type of its request with ANSWER bit set
+and body, which layout depends on type. See CommChannel.py.
+'''
+import struct
 
-class CommPacket:
+from WoWPackets import Layout, Packet
+
+
+MARKER  = 0xFF
+VERSION = 1
+#bit of type which marks answer to request
+ANSWER  = 0x80
+
+header = struct.Struct('<BBHIB')
+
+def comm_type(raw):
+    'Type of packet from its header'
+    return raw[8]
+
+def parse_header(raw):
+    'Returns (version, size, request, type)'
+    return header.unpack_from(raw)[1:]
+
+
+class CommPacket(Packet):
     '''Network package for internal communication between servers'''
+    type = None
+
+    def pack(self, request=0, **values):
+        body = self.layout.pack(values)
+        self.raw = header.pack(MARKER, VERSION, len(body), request,
+                               self.type) + body
+        return self.raw
 
-    def __init__(self, raw=b''):
-        self.raw = raw
-        self.raw_iter = iter(raw)
-        self.nb = self.raw_iter.__next__ #next byte from raw request
-    
-    def decode(self, raw):
-        '''if packet from client need to decode it to python values'''
-        pass
+    def unpack(self):
+        return self.layout.unpack_from(memoryview(self.raw), header.size)[0]
 
-    def encode(self, **kwargs):
-        '''if packet to client need to encode it from python values'''
-        pass
+    @property
+    def request(self):
+        return header.unpack_from(self.raw)[3]
 
-class ARE_YOU_ALIVE(CommPacket):
+
+class PING(CommPacket):
     '''
-    Request from one server to another. 
+    Realm server asks world server if it is alive.
+
+    >>> PING().encode(request=7)
+    b'\\xff\\x01\\x00\\x00\\x07\\x00\\x00\\x00\\x00'
     '''
+    type = 0x00
 
-    def __init__(self):
-        self.raw = bytes([255, 0])
-        
+    def encode(self, request=0):
+        return self.pack(request)
 
-class YES_I_AM_ALIVE(CommPacket):
+
+class PONG(CommPacket):
     '''
-    Response for reauest AreYouAlive meaning "yes" .
+    Answer for PING, alive is False when world server doesn't take players.
+
+    >>> p = PONG(PONG().encode(True, request=7))
+    >>> p.decode(), p.request, comm_type(p.raw) == PING.type | ANSWER
+    (True, 7, True)
     '''
-    def __init__(self):
-        self.raw = bytes([255, 1])
+    type = PING.type | ANSWER
+    layout = Layout([('alive', 'B')])
 
+    def encode(self, alive, request=0):
+        return self.pack(request, alive=int(alive))
 
-class NO_I_AM_DEAD(CommPacket):
+    def decode(self):
+        return bool(self.unpack()['alive'])
+
+
+class POPULATION(CommPacket):
     '''
-    Response for request AreYouAlive meaning "yes" .
+    World server tells realm server how many players it has
+    and how many it can take.
+
+    >>> POPULATION().encode(12, 100)[-4:]
+    b'\\x0c\\x00d\\x00'
+    >>> POPULATION(POPULATION().encode(12, 100)).decode()
+    (12, 100)
     '''
-    def __init__(self):
-        self.raw = bytes([255, 2])
+    type = 0x03
+    layout = Layout([('players',  'H'),
+                     ('capacity', 'H')])
+
+    def encode(self, players, capacity, request=0):
+        return self.pack(request, players=players, capacity=capacity)
+
+    def decode(self):
+        values = self.unpack()
+        return (values['players'], values['capacity'])
+
+
+class SESSION_KEY(CommPacket):
+    '''
+    Realm server gives session key of logged in account to world
+    servers, see SessionKeys.py.
+
+    >>> raw = SESSION_KEY().encode('PLAYER', 4, bytes(range(40)), '127.0.0.1')
+    >>> username, account_id, K, address = SESSION_KEY(raw).decode()
+    >>> username, account_id, K == bytes(range(40)), address
+    ('PLAYER', 4, True, '127.0.0.1')
+    '''
+    type = 0x04
+    layout = Layout([('account_id', 'I'),
+                     ('K',          '40s'),
+                     ('username',   'p'),
+                     ('address',    'p')])
+
+    def encode(self, username, account_id, K, address, request=0):
+        return self.pack(request, account_id=account_id, K=K,
+                         username=bytes(username, 'ascii'),
+                         address=bytes(address, 'ascii'))
+
+    def decode(self):
+        values = self.unpack()
+        return (str(values['username'], 'ascii'), values['account_id'],
+                values['K'], str(values['address'], 'ascii'))
 
 
 class THIS_GUY_WANNA_PLAY(CommPacket):
@@ -46,15 +132,22 @@ class THIS_GUY_WANNA_PLAY(CommPacket):
     When somebody login on RealmServer
     RealmServer tell about this to GameServer
 
-    >>> THIS_GUY_WANNA_PLAY('192.168.1.3').raw
-    b'\xffd192.168.1.3'
+    >>> raw = THIS_GUY_WANNA_PLAY().encode('192.168.1.3')
+    >>> raw[9:]
+    b'\\x0b192.168.1.3'
+    >>> THIS_GUY_WANNA_PLAY(raw).decode()
+    '192.168.1.3'
     '''
-    
-    def __init__(self, ip):
-        
-        self.raw = bytes([255, 100]) + bytes(ip, 'ascii')
-    
+    type = 0x64
+    layout = Layout([('ip', 'p')])
+
+    def encode(self, ip, request=0):
+        return self.pack(request, ip=bytes(ip, 'ascii'))
+
+    def decode(self):
+        return str(self.unpack()['ip'], 'ascii')
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
-
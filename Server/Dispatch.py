@@ -0,0 +1,110 @@
+'''
+Packets of sessions are handled by tables of (state, opcode) -> handler.
+
+Handler is function (session, data), method of session class works too.
+Handlers are registered with states where packet is accepted and states
+which handler may move session to, other transitions are refused.
+Packet without handler in current state is counted and dropped, so new
+packets (or handlers from other modules) are added by registering them,
+not by editing session class. entered is called with session after
+every transition, for example to set deadline of new state.
+'''
+from ServerLog import net_log
+from Metrics import registry
+
+
+#state of handlers which are accepted in every state
+ANY = '*'
+
+
+def first_byte(data):
+    return data[0]
+
+
+class Dispatcher:
+    '''
+    >>> from Metrics import Registry
+    >>> d = Dispatcher('test', registry=Registry())
+    >>> @d.handler('CHALLENGE', 0x00, next=['PROOF'])
+    ... def challenge(session, data):
+    ...     d.transition(session, 'PROOF')
+    ...     return 'challenge'
+    >>> class Session:
+    ...     state = 'CHALLENGE'
+    >>> s = Session()
+    >>> d.dispatch(s, b'\\x00'), s.state
+    ('challenge', 'PROOF')
+    >>> d.dispatch(s, b'\\x00') is None
+    True
+    >>> d.dropped.labels('test', 'PROOF').value
+    1
+    >>> d.transition(s, 'CHALLENGE')
+    Traceback (most recent call last):
+    ...
+    Exception: test: no transition PROOF -> CHALLENGE
+    '''
+
+    def __init__(self, protocol, opcode=first_byte, registry=registry,
+                 entered=None):
+        self.protocol = protocol
+        #data -> key of handler, first byte by default
+        self.opcode   = opcode
+        self.entered  = entered
+        #(state, opcode) -> handler
+        self.table    = {}
+        #state -> states where it can go
+        self.transitions = {}
+        self.dropped  = registry.counter('packets_dropped_total',
+                                         'Packets without handler in state',
+                                         ['protocol', 'state'])
+
+    def register(self, states, opcode, handler, next=()):
+        'states is one state or list of them, ANY for all states'
+        if isinstance(states, str):
+            states = [states]
+        for state in states:
+            if (state, opcode) in self.table:
+                raise Exception('{0}: handler of {1} in {2} exists already'
+                                .format(self.protocol, opcode, state))
+            self.table[(state, opcode)] = handler
+            self.allow(state, *next)
+
+    def handler(self, states, opcode, next=()):
+        'Decorator version of register'
+        def decorator(handler):
+            self.register(states, opcode, handler, next)
+            return handler
+        return decorator
+
+    def allow(self, state, *next):
+        self.transitions.setdefault(state, set()).update(next)
+
+    def transition(self, session, state):
+        if state not in self.transitions.get(session.state, ()) and \
+           state not in self.transitions.get(ANY, ()):
+            raise Exception('{0}: no transition {1} -> {2}'
+                            .format(self.protocol, session.state, state))
+        session.state = state
+        if self.entered is not None:
+            self.entered(session)
+
+    def dispatch(self, session, data):
+        'Result of handler, None if packet is dropped'
+        opcode  = self.opcode(data)
+        handler = self.table.get((session.state, opcode))
+        if handler is None:
+            handler = self.table.get((ANY, opcode))
+            if handler is None:
+                self.drop(session, opcode)
+                return None
+        return handler(session, data)
+
+    def drop(self, session, opcode):
+        self.dropped.labels(self.protocol, session.state).inc()
+        net_log.debug('%s: no handler of %r in state %s',
+                      self.protocol, opcode, session.state)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,189 @@
+'''
+Event loop of servers, chosen by event_loop in [net] section of config:
+
+twisted  default Twisted reactor, clients get Twisted TCP transports
+asyncio  Twisted reactor runs on asyncio loop (uvloop if it is
+         installed), listening sockets are served by loop.create_server,
+         so clients get asyncio transports wrapped in StreamProtocol
+
+Sessions are Twisted Protocols in both cases: they see only write,
+loseConnection, abortConnection, getPeer and getHost of transport.
+Deferreds, LoopingCalls and threads work the same, because reactor
+runs on the loop. install has to be called before twisted.internet.reactor
+is imported for the first time.
+'''
+import asyncio
+import configparser
+import socket
+
+from ServerLog import net_log
+
+from twisted.internet.address import IPv4Address
+from twisted.internet.error import ConnectionDone, ConnectionLost
+from twisted.python.failure import Failure
+
+
+names = ('twisted', 'asyncio')
+
+def install(name):
+    'Installs reactor for event loop name, returns name of loop'
+    if name == 'twisted':
+        return name
+    if name != 'asyncio':
+        raise Exception('Unknown event loop {0}, use one of {1}'\
+                        .format(name, ', '.join(names)))
+    from twisted.internet import asyncioreactor
+    try:
+        import uvloop
+        loop, name = uvloop.new_event_loop(), 'uvloop'
+    except ImportError:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    asyncioreactor.install(loop)
+    return name
+
+def install_from_config(path):
+    'The same for config file, before anything else is read from it'
+    config = configparser.ConfigParser()
+    config.read(path)
+    return install(config.get('net', 'event_loop', fallback='twisted'))
+
+def listen(reactor, factory, port=0, interface='', fileno=None):
+    '''
+    Listens on port or on inherited listening socket fileno with
+    transports of reactor's loop. Result has getHost and stopListening
+    like Twisted port.
+    '''
+    if not hasattr(reactor, '_asyncioEventloop'):
+        if fileno is not None:
+            return reactor.adoptStreamPort(fileno, socket.AF_INET, factory)
+        return reactor.listenTCP(port, factory, interface=interface)
+    if fileno is not None:
+        sock = socket.socket(fileno=fileno)
+    else:
+        #the same backlog as listenTCP
+        sock = socket.create_server((interface, port), backlog=50)
+    sock.setblocking(False)
+    listening = AsyncioPort(reactor, factory, sock)
+    listening.startListening()
+    return listening
+
+
+class AsyncioPort:
+    '''
+    Listening socket served by asyncio loop of reactor. Socket is bound
+    already, so getHost works before loop is running.
+    '''
+
+    def __init__(self, reactor, factory, sock):
+        self.reactor = reactor
+        self.loop    = reactor._asyncioEventloop
+        self.factory = factory
+        self.sock    = sock
+        #asyncio.Server, when loop has started it
+        self.server  = None
+
+    def startListening(self):
+        self.factory.doStart()
+        task = self.loop.create_task(self.loop.create_server(
+            lambda: StreamProtocol(self.factory), sock=self.sock))
+        task.add_done_callback(self.started)
+        self.reactor.addSystemEventTrigger('during', 'shutdown',
+                                           self.stopListening)
+
+    def started(self, task):
+        self.server = task.result()
+        net_log.info('%s listens on %s with asyncio transports',
+                     self.factory.__class__.__name__, self.getHost().port)
+
+    def getHost(self):
+        host, port = self.sock.getsockname()[:2]
+        return IPv4Address('TCP', host, port)
+
+    def stopListening(self):
+        if self.server is None:
+            return
+        self.server.close()
+        self.server = None
+        self.factory.doStop()
+
+
+class StreamProtocol(asyncio.Protocol):
+    '''
+    asyncio protocol of one connection, gives data to Twisted protocol
+    of factory and is its transport.
+
+    >>> from twisted.internet.protocol import Factory, Protocol
+    >>> class Echo(Protocol):
+    ...     def dataReceived(self, data):
+    ...         self.transport.write(data)
+    >>> class Transport:
+    ...     written = b''
+    ...     def get_extra_info(self, name):
+    ...         return ('127.0.0.2', 5000)
+    ...     def write(self, data):
+    ...         self.written += data
+    >>> stream = StreamProtocol(Factory.forProtocol(Echo))
+    >>> transport = Transport()
+    >>> stream.connection_made(transport)
+    >>> stream.data_received(b'ping')
+    >>> transport.written, stream.protocol.transport.getPeer().host
+    (b'ping', '127.0.0.2')
+    '''
+    #one for every connection
+    __slots__ = ('factory', 'protocol', 'transport')
+
+    def __init__(self, factory):
+        self.factory   = factory
+        self.protocol  = None
+        #asyncio transport
+        self.transport = None
+
+    #asyncio.Protocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.protocol = self.factory.buildProtocol(self.getPeer())
+        if self.protocol is None:
+            transport.close()
+            return
+        self.protocol.makeConnection(self)
+
+    def data_received(self, data):
+        self.protocol.dataReceived(data)
+
+    def connection_lost(self, exc):
+        if self.protocol is None:
+            return
+        reason = ConnectionDone() if exc is None else ConnectionLost(str(exc))
+        self.protocol.connected = 0
+        self.protocol.connectionLost(Failure(reason))
+        self.protocol = None
+
+    #transport of Twisted protocol
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writeSequence(self, data):
+        self.transport.writelines(data)
+
+    def loseConnection(self):
+        'Closes after buffered data is sent'
+        self.transport.close()
+
+    def abortConnection(self):
+        self.transport.abort()
+
+    def getPeer(self):
+        host, port = self.transport.get_extra_info('peername')[:2]
+        return IPv4Address('TCP', host, port)
+
+    def getHost(self):
+        host, port = self.transport.get_extra_info('sockname')[:2]
+        return IPv4Address('TCP', host, port)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
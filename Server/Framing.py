@@ -0,0 +1,201 @@
+'''
+Cuts TCP stream into packets.
+
+TCP gives no guarantee that one read is one packet: under load kernel
+splits packets and merges them together. Framer keeps received bytes and
+gives complete packets one by one, using length rules of protocol.
+'''
+import struct
+
+
+class FrameError(Exception):
+    '''Stream can't be cut into packets: unknown opcode or too much data.'''
+
+
+#length rules. Each gets memoryview of buffered data which starts with
+#packet and returns length of this packet, or None if there is not enough
+#bytes to know it yet.
+
+def fixed(size):
+    return lambda view: size
+
+def prefixed(offset, fmt, extra):
+    '''
+    Packet length is number in header at offset plus extra bytes.
+    '''
+    st = struct.Struct(fmt)
+    def length(view):
+        if len(view) < offset + st.size:
+            return None
+        return st.unpack_from(view, offset)[0] + extra
+    return length
+
+#internal packets between servers: uint16 size of body in 9 bytes
+#header, see CommPackets.py
+comm_packet_length = prefixed(2, '<H', 9)
+
+#auth protocol, opcode is first byte
+auth_rules = {
+    0x00 : prefixed(2, '<H', 4), #AUTH_LOGON_CHALLENGE, uint16 size in header
+    0x01 : fixed(75),            #AUTH_LOGON_PROOF
+    0x02 : prefixed(2, '<H', 4), #AUTH_RECONNECT_CHALLENGE
+    0x03 : fixed(58),            #AUTH_RECONNECT_PROOF
+    0x10 : fixed(5),             #REALM_LIST
+    0xFF : comm_packet_length,   #internal packets of world servers
+}
+
+comm_rules = {
+    0xFF : comm_packet_length,
+}
+
+def opcode_length(rules):
+    def length(view):
+        rule = rules.get(view[0])
+        if rule is None:
+            raise FrameError('unknown opcode {0}'.format(view[0]))
+        return rule(view)
+    return length
+
+def server_challenge_length(view):
+    'g and N of AUTH_LOGON_CHALLENGE answer are prefixed with uint8 length'
+    #refused challenge is only cmd, unk and result
+    if len(view) >= 3 and view[2]:
+        return 3
+    if len(view) < 36:
+        return None
+    g_len = view[35]
+    if len(view) < 37 + g_len:
+        return None
+    #B, g, N, then Salt[32], unk3[16], unk4
+    return 37 + g_len + view[36 + g_len] + 32 + 16 + 1
+
+def server_proof_length(view):
+    'Failed AUTH_LOGON_PROOF is only cmd and error'
+    if len(view) < 2:
+        return None
+    return 26 if view[1] == 0 else 2
+
+#answers of realm server, for clients in tests and benchmarks
+client_rules = {
+    0x00 : server_challenge_length, #AUTH_LOGON_CHALLENGE
+    0x01 : server_proof_length,     #AUTH_LOGON_PROOF
+    0x02 : fixed(34),               #AUTH_RECONNECT_CHALLENGE
+    0x03 : fixed(2),                #AUTH_RECONNECT_PROOF
+    0x10 : prefixed(1, '<H', 3),    #REALM_LIST
+}
+
+auth_length   = opcode_length(auth_rules)
+comm_length   = opcode_length(comm_rules)
+client_length = opcode_length(client_rules)
+
+#world packet from client: uint16 big-endian size of the rest, then opcode
+_world_length = prefixed(0, '>H', 2)
+
+def world_length(view):
+    'Client world packets, and internal packets from realm server'
+    if view[0] == 0xFF:
+        return comm_length(view)
+    return _world_length(view)
+
+
+class Framer:
+    '''
+    Growable buffer with read offset. feed adds received bytes, next
+    returns next complete packet or None. max_buffer limits only the
+    unfinished packet at the end, one read can bring more bytes of
+    complete packets.
+
+    >>> f = Framer(auth_length, max_buffer=100)
+    >>> proof = bytes([1]) + bytes(74)
+    >>> f.feed(bytes([16, 0, 0]))
+    >>> f.next() is None
+    True
+    >>> f.feed(bytes([0, 0]) + proof[:10])
+    >>> f.next()
+    b'\\x10\\x00\\x00\\x00\\x00'
+    >>> f.next() is None
+    True
+    >>> f.feed(proof[10:] + bytes([16, 0, 0, 0, 0]))
+    >>> [len(packet) for packet in f.packets()]
+    [75, 5]
+    >>> f.feed(bytes([7]))
+    >>> f.next()
+    Traceback (most recent call last):
+    ...
+    Framing.FrameError: unknown opcode 7
+
+    >>> f = Framer(auth_length, max_buffer=100)
+    >>> f.feed(bytes([16, 0, 0, 0, 0]) * 30)
+    >>> len(list(f.packets()))
+    30
+    >>> challenge = bytes([0, 0, 200, 0]) + bytes(100)
+    >>> f.feed(bytes([16, 0, 0, 0, 0]) * 30 + challenge)
+    Traceback (most recent call last):
+    ...
+    Framing.FrameError: buffer overflow, 104 bytes
+    '''
+    #one for every connection
+    __slots__ = ('length', 'max_buffer', 'buf', 'start', 'end')
+
+    def __init__(self, length, max_buffer=4096):
+        self.length     = length
+        self.max_buffer = max_buffer
+        self.buf        = bytearray()
+        #first byte which is not given as packet yet
+        self.start      = 0
+        #end of complete packets in buffer, unfinished one starts here
+        self.end        = 0
+
+    def __len__(self):
+        'Bytes waiting in buffer'
+        return len(self.buf) - self.start
+
+    def feed(self, data):
+        if self.start and self.start == len(self.buf):
+            #everything is read, start from beginning
+            del self.buf[:]
+            self.start = self.end = 0
+        elif self.start > len(self.buf) // 2:
+            #drop read half, so buffer doesn't grow forever
+            del self.buf[:self.start]
+            self.end  -= self.start
+            self.start = 0
+        self.buf += data
+        with memoryview(self.buf) as view:
+            while self.end < len(self.buf):
+                with view[self.end:] as rest:
+                    try:
+                        size = self.length(rest)
+                    except FrameError:
+                        #next raises it when packets before are taken
+                        break
+                if size is None or size > len(self.buf) - self.end:
+                    break
+                self.end += size
+        unfinished = len(self.buf) - self.end
+        if unfinished > self.max_buffer:
+            raise FrameError('buffer overflow, {0} bytes'.format(unfinished))
+
+    def next(self):
+        if self.start == len(self.buf):
+            return None
+        #views are released at once, bytearray can't grow while they exist
+        with memoryview(self.buf) as view, view[self.start:] as rest:
+            size = self.length(rest)
+            if size is None or size > len(rest):
+                return None
+            packet = bytes(rest[:size])
+        self.start += size
+        return packet
+
+    def packets(self):
+        'All complete packets in buffer'
+        packet = self.next()
+        while packet is not None:
+            yield packet
+            packet = self.next()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
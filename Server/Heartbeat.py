@@ -0,0 +1,86 @@
+'''
+Realm server pings world servers and keeps realm status in realm list
+up to date.
+'''
+import time
+
+from RealmList import OFFLINE
+
+
+class Heartbeat:
+    '''
+    Heartbeat state of one world server.
+    ping is called on every tick before PING is sent, pong when PONG
+    comes. Realm is offline after max_missed pings without answer,
+    when world server says it is dead and when connection is lost.
+
+    >>> from RealmList import RealmList
+    >>> now = [0.0]
+    >>> rl = RealmList([{'name': 'PYWOW', 'color': 0}])
+    >>> hb = Heartbeat('PYWOW', rl, max_missed=2, clock=lambda: now[0])
+    >>> rl['PYWOW']['color']
+    2
+    >>> hb.ping(); now[0] = 0.25; hb.pong()
+    >>> rl['PYWOW']['color'], hb.rtt
+    (0, 0.25)
+    >>> hb.ping(); hb.ping(); hb.ping()
+    >>> rl['PYWOW']['color'], hb.stats()['missed']
+    (2, 2)
+    '''
+
+    def __init__(self, name, realm_list, max_missed=3, clock=time.monotonic):
+        self.name       = name
+        self.realm_list = realm_list
+        self.max_missed = max_missed
+        self.clock      = clock
+        #color from config, realm gets it back when world server is alive
+        self.color      = realm_list[name]['color']
+        self.online     = None
+        #time of ping without answer yet
+        self.sent       = None
+        self.rtt        = None
+        self.rtt_total  = 0.0
+        self.beats      = 0
+        self.missed     = 0
+        self.total_missed = 0
+        self.set_online(False)
+
+    def set_online(self, online):
+        if online != self.online:
+            self.online = online
+            self.realm_list.update(self.name,
+                                   color=self.color if online else OFFLINE)
+
+    def ping(self):
+        if self.sent is not None:
+            self.missed       += 1
+            self.total_missed += 1
+            if self.missed >= self.max_missed:
+                self.set_online(False)
+        self.sent = self.clock()
+
+    def pong(self, alive=True):
+        if self.sent is not None:
+            self.rtt        = self.clock() - self.sent
+            self.rtt_total += self.rtt
+            self.beats     += 1
+            self.sent       = None
+        self.missed = 0
+        self.set_online(alive)
+
+    def lost(self):
+        self.sent = None
+        self.set_online(False)
+
+    def stats(self):
+        return {'online'       : self.online,
+                'rtt'          : self.rtt,
+                'avg_rtt'      : self.rtt_total / self.beats if self.beats else None,
+                'beats'        : self.beats,
+                'missed'       : self.missed,
+                'total_missed' : self.total_missed}
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
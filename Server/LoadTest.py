@@ -0,0 +1,246 @@
+'''
+Load generator for capacity planning of realm server. Logs in many
+headless clients (see AuthClient.py) instead of real game clients.
+
+python Server/LoadTest.py --port 3724 --clients 5000 --rate 200
+    5000 logins of PLAYER:PLAYER, 200 new connections per second
+python Server/LoadTest.py --accounts accounts.txt --pollers 1000 --polls 10
+    accounts.txt has login:password lines, 1000 of clients stay on realm
+    selection screen and ask for realm list 10 times
+python Server/LoadTest.py --local 100 --clients 2000
+    against in-process realm server with in-memory account store
+'''
+import argparse
+import sys
+import time
+
+from AuthLib import make_pwHash
+import AuthClient
+from Benchmark import summary, start_server
+
+from twisted.internet.task import LoopingCall
+
+
+class Histogram:
+    '''
+    Latencies in buckets 1-2-5 ms, 10-20-50 ms ... up to 50 s.
+    >>> h = Histogram()
+    >>> for ms in (0.5, 3, 3, 40, 70000):
+    ...     h.add(ms / 1000)
+    >>> h.counts[:4], h.counts[-1]
+    ([1, 0, 2, 0], 1)
+    >>> print(h.render(width=4).splitlines()[2])
+         5 ms        2 ####
+    '''
+    bounds = [m * 10 ** e for e in range(-3, 2) for m in (1, 2, 5)]
+
+    def __init__(self):
+        #last bucket is for everything slower than bounds
+        self.counts  = [0] * (len(self.bounds) + 1)
+        self.samples = []
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        for i, bound in enumerate(self.bounds):
+            if seconds <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def render(self, width=40):
+        top   = max(self.counts) or 1
+        last  = max([i for i, count in enumerate(self.counts) if count] or [0])
+        lines = []
+        for i, count in enumerate(self.counts[:last + 1]):
+            if i < len(self.bounds):
+                bound = self.bounds[i]
+                label = '{0:>6g} {1}'.format(bound * 1000 if bound < 1
+                                             else bound,
+                                             'ms' if bound < 1 else 's ')
+            else:
+                label = '  more   '
+            lines.append('{0}{1:>9} {2}'.format(label, count,
+                                                '#' * (count * width // top)))
+        return '\n'.join(lines)
+
+
+class LoadTest:
+    '''
+    Starts clients logins at rate per second (0 -> all at once), first
+    pollers of them poll realm list after login. finished fires when all
+    clients are done or failed.
+    '''
+
+    def __init__(self, reactor, host, port, accounts, clients, rate=0,
+                 pollers=0, polls=0, poll_interval=5.0, timeout=30,
+                 source_ips=1):
+        from twisted.internet import defer
+        self.reactor       = reactor
+        self.host          = host
+        self.port          = port
+        #[(username, pwHash)]
+        self.accounts      = accounts
+        self.clients       = clients
+        self.rate          = rate
+        self.pollers       = pollers
+        self.polls         = polls
+        self.poll_interval = poll_interval
+        self.timeout       = timeout
+        self.source_ips    = source_ips
+        self.histograms    = {phase: Histogram()
+                              for phase in AuthClient.phases + ('total', 'poll')}
+        #(phase, reason) -> count
+        self.errors        = {}
+        self.started       = 0
+        self.succeeded     = 0
+        self.failed        = 0
+        self.active        = 0
+        self.peak_active   = 0
+        self.finished      = defer.Deferred()
+
+    def start(self):
+        self.begin  = time.perf_counter()
+        self.ticker = LoopingCall(self.ramp)
+        self.ticker.start(0.01)
+        return self.finished
+
+    def ramp(self):
+        due = self.clients
+        if self.rate:
+            elapsed = time.perf_counter() - self.begin
+            due = min(self.clients, int(elapsed * self.rate) + 1)
+        while self.started < due:
+            self.connect()
+        if self.started == self.clients and self.ticker.running:
+            self.ticker.stop()
+
+    def connect(self):
+        username, pwHash = self.accounts[self.started % len(self.accounts)]
+        bind = None
+        if self.source_ips > 1:
+            bind = ('127.0.0.{0}'.format(2 + self.started % self.source_ips), 0)
+        polls = self.polls if self.started < self.pollers else 0
+        self.started += 1
+        self.active  += 1
+        self.peak_active = max(self.peak_active, self.active)
+        factory = AuthClient.AuthClientFactory(username, pwHash, self.reactor,
+                                               self.timeout, polls,
+                                               self.poll_interval)
+        self.reactor.connectTCP(self.host, self.port, factory, self.timeout,
+                                bind)
+        factory.deferred.addCallbacks(self.client_done, self.client_failed)
+        factory.deferred.addBoth(self.client_closed, factory)
+
+    def client_done(self, times):
+        self.succeeded += 1
+        for phase, seconds in times.items():
+            self.histograms[phase].add(seconds)
+
+    def client_failed(self, failure):
+        self.failed += 1
+        error = failure.value
+        if isinstance(error, AuthClient.LoginError):
+            key = (error.phase, str(error.reason))
+        else:
+            key = ('unknown', str(error))
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def client_closed(self, result, factory):
+        for seconds in factory.poll_times:
+            self.histograms['poll'].add(seconds)
+        self.active -= 1
+        if self.started == self.clients and not self.active:
+            self.elapsed = time.perf_counter() - self.begin
+            self.finished.callback(self)
+
+    def report(self):
+        print('clients {0}, succeeded {1} ({2:.1%}), failed {3}, '
+              'peak connections {4}'.format(
+                  self.clients, self.succeeded,
+                  self.succeeded / self.clients if self.clients else 0,
+                  self.failed, self.peak_active))
+        print('elapsed {0:.2f} s, {1:.1f} logins/s'.format(
+              self.elapsed, self.succeeded / self.elapsed))
+        for phase, histogram in self.histograms.items():
+            if not histogram.samples:
+                continue
+            s = summary(histogram.samples, self.elapsed)
+            print()
+            print('{0}: {1} samples, p50 {2:.1f} ms, p90 {3:.1f} ms, '
+                  'p99 {4:.1f} ms, max {5:.1f} ms'.format(
+                      phase, s['count'], s['p50'] / 1000, s['p90'] / 1000,
+                      s['p99'] / 1000, s['max'] / 1000))
+            print(histogram.render())
+        if self.errors:
+            print()
+            print('errors:')
+        for (phase, reason), count in sorted(self.errors.items()):
+            print('{0:>9} {1}: {2}'.format(count, phase, reason))
+
+
+def read_accounts(path):
+    'login:password lines -> [(username, pwHash)]'
+    accounts = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                username, password = line.split(':', 1)
+                accounts.append((username.upper(),
+                                 make_pwHash(username, password)))
+    return accounts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Realm server load generator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3724)
+    parser.add_argument('--clients', type=int, default=1000,
+                        help='number of logins')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='new connections per second, 0 -> all at once')
+    parser.add_argument('--username', default='PLAYER')
+    parser.add_argument('--password', default='PLAYER')
+    parser.add_argument('--accounts', help='file with login:password lines')
+    parser.add_argument('--pollers', type=int, default=0,
+                        help='clients which poll realm list after login')
+    parser.add_argument('--polls', type=int, default=5)
+    parser.add_argument('--poll-interval', type=float, default=5.0)
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds for connect and for login')
+    parser.add_argument('--source-ips', type=int, default=1,
+                        help='connect from 127.0.0.2 and up, for local server')
+    parser.add_argument('--local', type=int, default=0, metavar='ACCOUNTS',
+                        help='start in-process realm server with so many accounts')
+    parser.add_argument('--backend', default='openssl',
+                        help='big number backend of local server')
+    parser.add_argument('--workers-mode', default='thread',
+                        help='workers mode of local server')
+    args = parser.parse_args(argv)
+
+    from twisted.internet import reactor
+
+    host, port = args.host, args.port
+    if args.accounts:
+        accounts = read_accounts(args.accounts)
+    else:
+        accounts = [(args.username.upper(),
+                     make_pwHash(args.username, args.password))]
+    if args.local:
+        listening, usernames = start_server(reactor, args.backend,
+                                            args.workers_mode, 0, args.local)
+        host, port = '127.0.0.1', listening.getHost().port
+        accounts = [(name, make_pwHash(name, name)) for name in usernames]
+
+    test = LoadTest(reactor, host, port, accounts, args.clients, args.rate,
+                    args.pollers, args.polls, args.poll_interval,
+                    args.timeout, args.source_ips)
+    reactor.callWhenRunning(
+        lambda: test.start().addBoth(lambda result: reactor.stop()))
+    reactor.run()
+    test.report()
+    return 1 if test.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
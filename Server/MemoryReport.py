@@ -0,0 +1,171 @@
+'''
+Memory of realm server per connection: python heap bytes of idle
+session (logged in, on realm selection screen) and of session in the
+middle of handshake (challenge is sent, proof is not). Server runs in
+this process with in-memory accounts (see Benchmark.start_server),
+clients are plain sockets of child process, so only server is measured.
+Kernel socket buffers and OpenSSL allocations are not counted.
+
+python Server/MemoryReport.py --sessions 5000
+python Server/MemoryReport.py --sessions 1000 --top 10
+'''
+import argparse
+import gc
+import socket
+import sys
+import tracemalloc
+
+from AuthLib import SRP6Client, make_pwHash
+from WoWPackets import *
+from Framing import Framer, client_length
+import EventLoop
+
+from twisted.internet.protocol import ProcessProtocol
+
+
+modes = ('idle', 'handshake')
+
+def source_ip(index):
+    'Every client has its own 127.x.y.z address, server sheds repeated ones'
+    index += 2
+    return '127.{0}.{1}.{2}'.format(index // 62500 % 250,
+                                    index // 250 % 250, index % 250 + 2)
+
+def receive(sock, framer):
+    while True:
+        packet = framer.next()
+        if packet is not None:
+            return packet
+        data = sock.recv(4096)
+        if not data:
+            raise Exception('server closed connection')
+        framer.feed(data)
+
+def client(mode, port, sessions, accounts):
+    '''
+    Child process: opens sessions connections in mode, tells "ready" and
+    keeps them until stdin is closed.
+    '''
+    connections = []
+    for i in range(sessions):
+        username = 'BENCH{0}'.format(i % accounts)
+        sock = socket.create_connection(('127.0.0.1', port),
+                                        source_address=(source_ip(i), 0))
+        framer = Framer(client_length)
+        sock.sendall(RS_CLIENT_LOGON_CHALLENGE().encode(username))
+        challenge = receive(sock, framer)
+        if mode == 'idle':
+            srp = SRP6Client(username, make_pwHash(username, username))
+            PublicB, g, N, Salt = RS_SERVER_LOGON_CHALLENGE(challenge).decode()
+            sock.sendall(RS_CLIENT_LOGON_PROOF()
+                         .encode(*srp.process_challenge(PublicB, g, N, Salt)))
+            receive(sock, framer)
+            sock.sendall(RS_CLIENT_REALM_LIST().encode())
+            receive(sock, framer)
+        connections.append(sock)
+    print('ready', flush=True)
+    sys.stdin.read()
+
+
+class Clients(ProcessProtocol):
+    '''Parent side of client process, measures when clients are ready.'''
+
+    def __init__(self, report, mode):
+        self.report = report
+        self.mode   = mode
+        self.output = b''
+
+    def outReceived(self, data):
+        self.output += data
+        if b'ready' in self.output:
+            self.output = b''
+            #let server handle the last packets
+            self.report.reactor.callLater(0.5, self.report.measure, self)
+
+    def processEnded(self, reason):
+        self.report.ended(self)
+
+
+class Report:
+    '''
+    Runs client process of every mode in turn, heap growth divided by
+    number of sessions is bytes per session.
+    '''
+
+    def __init__(self, reactor, port, args):
+        self.reactor = reactor
+        self.port    = port
+        self.args    = args
+        self.modes   = list(modes)
+        self.results = {}
+
+    def next(self):
+        if not self.modes:
+            self.reactor.stop()
+            return
+        mode = self.modes.pop(0)
+        gc.collect()
+        self.base     = tracemalloc.get_traced_memory()[0]
+        self.snapshot = tracemalloc.take_snapshot() if self.args.top else None
+        self.reactor.spawnProcess(
+            Clients(self, mode), sys.executable,
+            [sys.executable, __file__, '--client', mode,
+             '--port', str(self.port), '--sessions', str(self.args.sessions),
+             '--accounts', str(self.args.accounts)],
+            env=None, childFDs={0: 'w', 1: 'r', 2: 2})
+
+    def measure(self, clients):
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - self.base
+        self.results[clients.mode] = used / self.args.sessions
+        if self.snapshot is not None:
+            stats = tracemalloc.take_snapshot().compare_to(self.snapshot,
+                                                           'lineno')
+            print('top allocations of', clients.mode, 'sessions:')
+            for stat in stats[:self.args.top]:
+                print('   ', stat)
+            self.snapshot = None
+        clients.transport.closeStdin()
+
+    def ended(self, clients):
+        #wait until server sees all connections closed
+        self.reactor.callLater(1, self.next)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Memory per realm session')
+    parser.add_argument('--sessions', type=int, default=2000)
+    parser.add_argument('--accounts', type=int, default=100)
+    parser.add_argument('--top', type=int, default=0,
+                        help='print so many top allocation sites')
+    parser.add_argument('--event-loop', default='twisted',
+                        choices=EventLoop.names,
+                        help='event loop of server, see EventLoop.py')
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--client', choices=modes, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.client:
+        client(args.client, args.port, args.sessions, args.accounts)
+        return 0
+
+    EventLoop.install(args.event_loop)
+    from twisted.internet import reactor
+    from Benchmark import start_server
+
+    tracemalloc.start()
+    listening, usernames = start_server(reactor, accounts=args.accounts)
+    #sessions are measured, not reaped
+    listening.factory.timeouts = {}
+    report = Report(reactor, listening.getHost().port, args)
+    reactor.callWhenRunning(report.next)
+    reactor.run()
+    for mode in modes:
+        if mode in report.results:
+            print('{0:<12}{1:>10.0f} bytes per session'
+                  .format(mode, report.results[mode]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,321 @@
+'''
+Metrics of servers in Prometheus text format.
+
+Metrics are created once at module level and then only changed, so
+recording is an attribute increment (or bisect for histograms) in
+reactor thread, without locks. Text is built only when /metrics is
+requested, see [metrics] in RealmServer.ini.
+'''
+import bisect
+import time
+
+
+#seconds, from loopback round trip to slow database
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return str(int(value))
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value)
+                                            .replace('\\', '\\\\')
+                                            .replace('"', '\\"'))
+                          for name, value in zip(names, values)) + '}'
+
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield ('', (), (), self.value)
+
+
+class GaugeValue:
+    def __init__(self):
+        self.value = 0
+        self.func  = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, func):
+        'Value is taken from func when metrics are exported'
+        self.func = func
+
+    def samples(self):
+        yield ('', (), (), self.func() if self.func else self.value)
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        #last one is for values bigger than all buckets
+        self.counts  = [0] * (len(buckets) + 1)
+        self.sum     = 0.0
+        self.count   = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield ('_bucket', ('le',), (format_value(bound),), total)
+        yield ('_sum', (), (), self.sum)
+        yield ('_count', (), (), self.count)
+
+
+class Metric:
+    '''
+    Family of values with the same name, one value for each combination
+    of labels. Metric without labels has the only value and its methods.
+    '''
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name       = name
+        self.help       = help
+        self.labelnames = tuple(labelnames)
+        self.children   = {}
+        if not self.labelnames:
+            self.bind(self.labels())
+
+    def new_value(self):
+        raise NotImplementedError
+
+    def bind(self, value):
+        pass
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_value()
+        return child
+
+    def expose(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        for values, child in self.children.items():
+            for suffix, names, extra, value in child.samples():
+                lines.append('{0}{1}{2} {3}'.format(
+                    self.name, suffix,
+                    format_labels(self.labelnames + names, values + extra),
+                    format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def new_value(self):
+        return CounterValue()
+
+    def bind(self, value):
+        self.inc = value.inc
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def new_value(self):
+        return GaugeValue()
+
+    def bind(self, value):
+        self.set = value.set
+        self.inc = value.inc
+        self.dec = value.dec
+        self.set_function = value.set_function
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        Metric.__init__(self, name, help, labelnames)
+
+    def new_value(self):
+        return HistogramValue(self.buckets)
+
+    def bind(self, value):
+        self.observe = value.observe
+
+
+class Registry:
+    '''
+    All metrics of process. Asking for metric which exists returns it,
+    so modules loaded into one process share metrics.
+
+    >>> r = Registry()
+    >>> logins = r.counter('logins_total', 'Logins', ['result'])
+    >>> logins.labels('ok').inc()
+    >>> r.counter('logins_total', 'Logins', ['result']) is logins
+    True
+    >>> lag = r.histogram('lag_seconds', 'Lag', buckets=[0.1, 1])
+    >>> lag.observe(0.5)
+    >>> print(r.expose())
+    # HELP logins_total Logins
+    # TYPE logins_total counter
+    logins_total{result="ok"} 1
+    # HELP lag_seconds Lag
+    # TYPE lag_seconds histogram
+    lag_seconds_bucket{le="0.1"} 0
+    lag_seconds_bucket{le="1"} 1
+    lag_seconds_bucket{le="+Inf"} 1
+    lag_seconds_sum 0.5
+    lag_seconds_count 1
+    <BLANKLINE>
+    '''
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, cls, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise Exception('Metric {0} is {1} already'.format(name, metric.kind))
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=default_buckets):
+        return self.register(Histogram, name, help, labelnames, buckets)
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.expose()
+        return '\n'.join(lines) + '\n'
+
+
+#metrics of this process
+registry = Registry()
+
+
+class Traffic:
+    '''
+    Packets and bytes of one protocol in one direction by opcode.
+    Values of each opcode are found once and kept.
+
+    >>> r = Registry()
+    >>> t = Traffic('auth', 'in', r)
+    >>> t.record(16, 5); t.record(16, 5)
+    >>> r.metrics['packets_in_total'].labels('auth', '0x10').value
+    2
+    '''
+
+    def __init__(self, protocol, direction, registry=registry):
+        self.protocol = protocol
+        self.packets  = registry.counter(
+            'packets_{0}_total'.format(direction),
+            'Packets {0} by protocol and opcode'.format(direction),
+            ('protocol', 'opcode'))
+        self.bytes    = registry.counter(
+            'bytes_{0}_total'.format(direction),
+            'Bytes {0} by protocol and opcode'.format(direction),
+            ('protocol', 'opcode'))
+        #opcode -> (packets value, bytes value)
+        self.opcodes  = {}
+
+    def record(self, opcode, size):
+        values = self.opcodes.get(opcode)
+        if values is None:
+            label  = '0x{0:02x}'.format(opcode)
+            values = self.opcodes[opcode] = (
+                self.packets.labels(self.protocol, label),
+                self.bytes.labels(self.protocol, label))
+        values[0].value += 1
+        values[1].value += size
+
+
+class LagMonitor:
+    '''
+    Reactor loop lag: how late timer of interval seconds is called.
+    Big lag means reactor thread is busy with something long.
+    '''
+
+    def __init__(self, reactor, interval=0.5, registry=registry,
+                 clock=time.monotonic):
+        from twisted.internet.task import LoopingCall
+        self.interval  = interval
+        self.clock     = clock
+        self.histogram = registry.histogram('reactor_lag_seconds',
+                                            'Delay of reactor timers')
+        self.last      = registry.gauge('reactor_lag_last_seconds',
+                                        'Delay of last reactor timer')
+        self.expected  = None
+        self.loop      = LoopingCall(self.tick)
+        self.loop.clock = reactor
+
+    def start(self):
+        self.expected = self.clock()
+        self.loop.start(self.interval, now=True)
+
+    def tick(self):
+        now = self.clock()
+        lag = max(now - self.expected, 0.0)
+        self.histogram.observe(lag)
+        self.last.set(lag)
+        self.expected = now + self.interval
+
+
+def start(reactor, port, interface='127.0.0.1', lag_interval=0.5,
+          registry=registry):
+    '''
+    Serves registry as Prometheus text on http://interface:port/metrics
+    and starts reactor lag monitor. port 0 -> nothing is started.
+    '''
+    if not port:
+        return None
+    from twisted.web.resource import Resource
+    from twisted.web.server import Site
+
+    class MetricsPage(Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader(b'Content-Type',
+                              b'text/plain; version=0.0.4; charset=utf-8')
+            return registry.expose().encode('utf-8')
+
+    if lag_interval:
+        LagMonitor(reactor, lag_interval, registry).start()
+    site = Site(MetricsPage())
+    site.noisy = False
+    return reactor.listenTCP(port, site, interface=interface)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,105 @@
+'''
+Admission control of realm server. Connections are shed before they
+cost anything: rate limits are checked when connection is accepted,
+handshake cap when challenge comes, before database and SRP6 math.
+'''
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    '''
+    rate tokens per second, not more than burst are kept.
+
+    >>> now = [0.0]
+    >>> b = TokenBucket(rate=1, burst=2, clock=lambda: now[0])
+    >>> b.take(), b.take(), b.take()
+    (True, True, False)
+    >>> now[0] = 1.5
+    >>> b.take(), b.take()
+    (True, False)
+    '''
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate   = rate
+        self.burst  = burst
+        self.clock  = clock
+        self.tokens = burst
+        self.last   = clock()
+
+    def take(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last   = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Limiter:
+    '''
+    Token buckets for each source address and for all of them, and cap
+    on handshakes in flight (from challenge to proof). Zero rate or
+    max_handshakes means no limit. Buckets of max_addresses recently
+    seen addresses are kept.
+
+    >>> now = [0.0]
+    >>> l = Limiter(ip_rate=1, ip_burst=1, global_rate=10, global_burst=2,
+    ...             max_handshakes=1, clock=lambda: now[0])
+    >>> l.admit('1.1.1.1'), l.admit('1.1.1.1'), l.admit('2.2.2.2')
+    (None, 'ip_rate', None)
+    >>> l.admit('3.3.3.3')
+    'global_rate'
+    >>> l.begin(), l.begin()
+    (True, False)
+    >>> l.end(); l.begin()
+    True
+    '''
+
+    def __init__(self, ip_rate=0, ip_burst=1, global_rate=0, global_burst=1,
+                 max_handshakes=0, max_addresses=65536, clock=time.monotonic):
+        self.ip_rate        = ip_rate
+        self.ip_burst       = max(ip_burst, 1)
+        self.clock          = clock
+        self.max_addresses  = max_addresses
+        self.max_handshakes = max_handshakes
+        self.global_bucket  = None
+        if global_rate:
+            self.global_bucket = TokenBucket(global_rate,
+                                             max(global_burst, 1), clock)
+        #address -> TokenBucket, least recently seen first
+        self.buckets   = OrderedDict()
+        self.in_flight = 0
+
+    def admit(self, address):
+        'None if new connection from address is allowed, else reason'
+        if self.ip_rate:
+            bucket = self.buckets.get(address)
+            if bucket is None:
+                bucket = self.buckets[address] = TokenBucket(
+                    self.ip_rate, self.ip_burst, self.clock)
+                if len(self.buckets) > self.max_addresses:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(address)
+            if not bucket.take():
+                return 'ip_rate'
+        if self.global_bucket is not None and not self.global_bucket.take():
+            return 'global_rate'
+        return None
+
+    def begin(self):
+        'Handshake starts, False if there are too many already'
+        if self.max_handshakes and self.in_flight >= self.max_handshakes:
+            return False
+        self.in_flight += 1
+        return True
+
+    def end(self):
+        self.in_flight -= 1
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
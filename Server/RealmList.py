@@ -0,0 +1,136 @@
+'''
+Realm list which realm server sends to clients.
+'''
+from WoWPackets import RS_SERVER_REALM_LIST
+
+
+class RealmList:
+    '''
+    Keeps RS_SERVER_REALM_LIST encoded. Packet is built again only after
+    some realm is changed through update, clients get the same bytes.
+
+    >>> rl = RealmList([{'type': 0, 'isLocked': 0, 'color': 0,
+    ...                  'name': 'PYWOW', 'address': '127.0.0.1',
+    ...                  'game_port': 8085, 'population': 1,
+    ...                  'characters_count': 16, 'timezone': 1}])
+    >>> raw = rl.encode()
+    >>> rl.encode() is raw
+    True
+    >>> rl.update('PYWOW', population=1)
+    False
+    >>> rl.update('PYWOW', color=1)
+    True
+    >>> rl.encode() is raw, rl.builds
+    (False, 2)
+    '''
+
+    def __init__(self, realms):
+        self.realms  = realms
+        self.by_name = {realm['name']: realm for realm in realms}
+        self.raw     = None
+        #how many times packet was built, for statistics
+        self.builds  = 0
+        #called with realm name after realm is changed, see Supervisor.py
+        self.watchers = []
+
+    def __iter__(self):
+        return iter(self.realms)
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+    def update(self, name, **fields):
+        '''
+        Changes fields of realm. Returns True if something was changed
+        and packet will be rebuilt.
+        '''
+        realm = self.by_name[name]
+        changed = False
+        for field, value in fields.items():
+            if realm.get(field) != value:
+                realm[field] = value
+                changed = True
+        if changed:
+            self.raw = None
+            for watcher in self.watchers:
+                watcher(name)
+        return changed
+
+    def encode(self):
+        if self.raw is None:
+            self.raw = RS_SERVER_REALM_LIST().encode(self.realms)
+            self.builds += 1
+        return self.raw
+
+
+#population field of realm list, WoW 1.12 client shows these words
+LOW         = 0.0
+MEDIUM      = 1.0
+HIGH        = 2.0
+FULL        = 400.0
+RECOMMENDED = 600.0
+#color of realm whose world server doesn't answer, see Heartbeat.py
+OFFLINE     = 2
+
+class PopulationPolicy:
+    '''
+    Turns players counts reported by world servers into population of
+    realms. Realm is full when it has full_ratio of its capacity, least
+    loaded realm which is online and not full is recommended to new
+    accounts if recommend is True.
+
+    >>> rl = RealmList([{'name': 'A', 'color': 0, 'population': 1},
+    ...                 {'name': 'B', 'color': 0, 'population': 1},
+    ...                 {'name': 'C', 'color': 0, 'population': 1}])
+    >>> policy = PopulationPolicy(rl, full_ratio=0.9)
+    >>> policy.report('A', 95, 100)
+    >>> policy.report('B', 50, 100)
+    >>> policy.report('C', 10, 100)
+    >>> [realm['population'] for realm in rl]
+    [400.0, 1.0, 600.0]
+    >>> rl.update('C', color=OFFLINE)
+    True
+    >>> policy.report('B', 60, 100)
+    >>> [realm['population'] for realm in rl]
+    [400.0, 600.0, 0.2]
+    >>> policy.recommended
+    'B'
+    '''
+
+    def __init__(self, realm_list, full_ratio=1.0, recommend=True):
+        self.realm_list = realm_list
+        self.full_ratio = full_ratio
+        self.recommend  = recommend
+        #realm name -> (players, capacity)
+        self.reports    = {}
+        self.recommended = None
+
+    def report(self, name, players, capacity):
+        self.reports[name] = (players, capacity)
+        self.recompute()
+
+    def load(self, name):
+        players, capacity = self.reports[name]
+        return players / capacity if capacity else 1.0
+
+    def recompute(self):
+        candidates = [name for name in self.reports
+                      if self.load(name) < self.full_ratio
+                      and self.realm_list[name]['color'] != OFFLINE]
+        self.recommended = None
+        if self.recommend and candidates:
+            self.recommended = min(candidates, key=self.load)
+        for name in self.reports:
+            load = self.load(name)
+            if load >= self.full_ratio:
+                population = FULL
+            elif name == self.recommended:
+                population = RECOMMENDED
+            else:
+                population = min(load * HIGH, HIGH)
+            self.realm_list.update(name, population=population)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
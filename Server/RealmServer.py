@@ -1,197 +1,697 @@
-from AuthLib import SRP6Engine
+import sys
+import EventLoop
+if __name__ == '__main__' and len(sys.argv) > 1:
+    #reactor of event loop has to be installed before it is imported
+    event_loop = EventLoop.install_from_config(sys.argv[1])
+from AuthLib import get_backend
+from AuthWorkers import SRP6Executor
 from WoWPackets import *
 from CommPackets import *
+from CommChannel import CommChannel
 import configparser
-import sys
+import os
 from models import *
-from database import db_session
+from database import AccountStore
+from AccountCache import AccountCache
+from Framing import Framer, FrameError, auth_length, comm_length
+from RealmList import RealmList, PopulationPolicy
+from Heartbeat import Heartbeat
+from RateLimit import Limiter
+from SessionKeys import KeyStore, reconnect_digest
+from Dispatch import Dispatcher, ANY
+from TimerWheel import TimerWheel
+import Supervisor
+from ServerLog import DEBUG, net_log, auth_log, comm_log, packet_log
+import ServerLog
+from Metrics import registry, Traffic
+import Metrics
 import time
 
-from twisted.python import log
-from twisted.internet.protocol import Factory, ClientFactory, Protocol
-from twisted.protocols.basic import LineReceiver
-from twisted.internet import reactor
+from twisted.internet.protocol import Factory, ReconnectingClientFactory, Protocol
+from twisted.internet.task import LoopingCall
+from twisted.internet import reactor, defer
 
 
-if len(sys.argv) < 2: raise Exception(
-        'Give the config file! Defalut run is:\n'+\
-        'python Server/RealmServer.py RealmServer.ini\n'+\
-        'Default RealmServer.ini in root progect directory.')
+#see Metrics.py
+auth_in  = Traffic('auth', 'in')
+auth_out = Traffic('auth', 'out')
+comm_in  = Traffic('comm', 'in')
+comm_out = Traffic('comm', 'out')
+sessions = registry.gauge('auth_sessions', 'Open client connections')
+logins_started   = registry.counter('logins_started_total',
+                                    'Logon challenges received')
+logins_succeeded = registry.counter('logins_succeeded_total',
+                                    'Logins with right proof')
+logins_failed    = registry.counter('logins_failed_total',
+                                    'Failed logins by reason', ['reason'])
+phase_seconds    = registry.histogram('handshake_phase_seconds',
+                                      'From client packet to answer',
+                                      ['phase'])
+challenge_seconds = phase_seconds.labels('challenge')
+proof_seconds     = phase_seconds.labels('proof')
+realmlist_seconds = phase_seconds.labels('realmlist')
+keys_pushed      = registry.counter('session_keys_pushed_total',
+                                    'Session keys sent to world servers')
+login_seconds    = registry.histogram('login_seconds',
+                                      'From connection to right proof')
+shed_total       = registry.counter('connections_shed_total',
+                                    'Connections rejected by limits',
+                                    ['reason'])
+handshakes       = registry.gauge('handshakes_in_flight',
+                                  'Handshakes between challenge and proof')
+reconnects       = registry.counter('reconnects_total',
+                                    'Reconnect proofs by result', ['result'])
+reconnect_seconds = phase_seconds.labels('reconnect')
+keys_cached      = registry.gauge('reconnect_keys',
+                                  'Session keys kept for reconnect')
 
-else: confile = sys.argv[1]
 
-config = configparser.ConfigParser()
-config.read(confile)
+#seconds in state before connection is closed, None -> no deadline.
+#REALMLIST deadline starts again with every realm list request,
+#WORLDSERVER one with every packet of world server
+default_timeouts = {'CHALLENGE'       : 30,
+                    'PROOF'           : 30,
+                    'RECONNECT_PROOF' : 30,
+                    'REALMLIST'       : 300,
+                    'WORLDSERVER'     : 300}
 
-realms = [{'type'             : int(c['type']),
-           'isLocked'         : int(c['isLocked']),
-           'color'            : int(c['color']),
-           'name'             : c['name'],
-           'address'          : c['address'],
-           'game_port'        : int(c['game_port']),
-           'comm_port'        : int(c['comm_port']),
-           'population'       : 1,
-           'characters_count' : 16,
-           'timezone'         : int(c['timezone'])}
-          for c in [config[k] for k in config.keys() if k.startswith('world')]]
 
+def load_realms(config):
+    'Realms from config sections which names start with "world"'
+    return [{'type'             : int(c['type']),
+             'isLocked'         : int(c['isLocked']),
+             'color'            : int(c['color']),
+             'name'             : c['name'],
+             'address'          : c['address'],
+             'game_port'        : int(c['game_port']),
+             'comm_port'        : int(c['comm_port']),
+             'population'       : 1,
+             'characters_count' : 16,
+             'timezone'         : int(c['timezone'])}
+            for c in [config[k] for k in config.keys() if k.startswith('world')]]
 
-class CommSession(Protocol):
+
+class Handoff:
+    '''
+    Gives session keys of logged in accounts to every connected world
+    server, client chooses realm only after login. See SessionKeys.py.
+    '''
 
     def __init__(self):
+        #realm name -> CommChannel of its world server
+        self.channels = {}
+
+    def push(self, username, account_id, K, address):
+        for channel in self.channels.values():
+            channel.send(SESSION_KEY, username, account_id, K, address)
+            keys_pushed.inc()
+
+
+class CommSession(Protocol):
+
+    def __init__(self, heartbeat, interval, population, handoff):
         self.state = ''
+        self.framer = Framer(comm_length)
+        #see Heartbeat.py
+        self.heartbeat = heartbeat
+        self.interval = interval
+        #see RealmList.PopulationPolicy
+        self.population = population
+        self.beat = LoopingCall(self.send_PING)
+        #requests and batched writes, see CommChannel.py
+        self.channel = None
+        self.handoff = handoff
         
     def connectionMade(self):
-        self.transport.write(ARE_YOU_ALIVE().raw)
+        self.channel = CommChannel(reactor, self.transport, comm_out)
+        self.handoff.channels[self.heartbeat.name] = self.channel
+        self.beat.start(self.interval, now=True)
 
     def connectionLost(self, reason):
-        print('connection broken because', reason)
+        comm_log.info('connection to %s broken: %s',
+                      self.heartbeat.name, reason.getErrorMessage())
+        if self.beat.running:
+            self.beat.stop()
+        if self.handoff.channels.get(self.heartbeat.name) is self.channel:
+            del self.handoff.channels[self.heartbeat.name]
+        self.channel.lost(reason)
+        self.heartbeat.lost()
+
+    def send_PING(self):
+        self.heartbeat.ping()
+        #unanswered ping is counted as missed by heartbeat
+        d = self.channel.request(PING, timeout=self.interval)
+        d.addCallbacks(self.handle_PONG, lambda failure: None)
         
     def dataReceived(self, data):
-        
-        if data == YES_I_AM_ALIVE().raw:
-            self.state = 'alive'
-            
-        elif data == NO_I_AM_DEAD().raw:
-            self.state = 'dead'
-
-        print('packet recieved from',
-              self.transport.getPeer(),
-              'state is', self.state,
-              'and contain', data)
-            
-        
-class AuthSession(LineReceiver):
-    delimiter = b''
-    def __init__(self, connections):
-        self.setRawMode()
-        self.connections = connections
-        self.SRP6Engine = SRP6Engine()
+        try:
+            self.framer.feed(data)
+            for packet in self.framer.packets():
+                comm_in.record(comm_type(packet), len(packet))
+                if packet_log.isEnabledFor(DEBUG):
+                    packet_log.debug('from %s state %s: %r',
+                                     self.heartbeat.name, self.state, packet)
+                if not self.channel.received(packet):
+                    comm_dispatch.dispatch(self, packet)
+        except FrameError as e:
+            comm_log.warning('bad stream from %s: %s', self.heartbeat.name, e)
+            self.transport.loseConnection()
+
+    def handle_PONG(self, data):
+        alive = PONG(data).decode()
+        self.state = 'alive' if alive else 'dead'
+        self.heartbeat.pong(alive)
+
+    def handle_POPULATION(self, data):
+        players, capacity = POPULATION(data).decode()
+        self.population.report(self.heartbeat.name, players, capacity)
+
+
+#(state, type) -> handler of CommSession, see Dispatch.py
+comm_dispatch = Dispatcher('comm', comm_type)
+comm_dispatch.register(ANY, POPULATION.type, CommSession.handle_POPULATION)
+
+
+class AuthSession(Protocol):
+    '''
+    Client of realm server. There are many thousands of them, so they
+    have slots instead of __dict__ and keep no copies of factory things,
+    handshake state is dropped as soon as proof is checked.
+    '''
+    __slots__ = ('factory', 'transport', 'connected', 'framer', 'waiting',
+                 'processing', 'srp_state', 'username', 'account_id', 'K',
+                 'server_random', 'state', 'opened', 'received',
+                 'in_handshake', 'peer', 'closed')
+
+    def __init__(self, factory):
+        #realm list, accounts, SRP6 executor, limits and deadlines are
+        #shared by all sessions in factory
+        self.factory = factory
+        #cuts stream into packets, see Framing.py
+        self.framer = Framer(auth_length, factory.max_buffer)
+        #Deferred of packet which is handled now, next packets wait for it
+        self.waiting = None
+        self.processing = False
+        #state of SRP6 between challenge and proof, see AuthWorkers.py
+        self.srp_state = None
+        self.username = None
+        self.account_id = None
+        #session key and random of reconnect between its challenge and proof
+        self.K = None
+        self.server_random = None
         self.state = "CHALLENGE"
+        #for handshake latency metrics
+        self.opened = time.perf_counter()
+        self.received = None
+        #admission control, see RateLimit.py
+        self.in_handshake = False
+        self.peer = None
+        #connection is lost, late results of lookups and SRP6 are dropped
+        self.closed = False
 
     def connectionMade(self):
+        sessions.inc()
         peer = self.transport.getPeer()
         if peer.type=='TCP':
             self.peer = peer.host
         else:
-            self.loseConnection()
+            self.transport.loseConnection()
+            return
+        if self.peer in self.factory.connections:
+            self.shed('connected')
             return
-        if self.peer in self.connections:
-            self.loseConnection()
+        reason = self.factory.limiter.admit(self.peer)
+        if reason:
+            self.shed(reason)
             return
+        self.deadline()
+
+    def shed(self, reason):
+        'Drops connection before anything is read or looked up for it'
+        shed_total.labels(reason).inc()
+        net_log.debug('%s shed: %s', self.peer, reason)
+        self.state = "SHED"
+        self.transport.abortConnection()
+
+    def deadline(self):
+        'Connection is closed if it stays in this state for its timeout'
+        self.factory.wheel.schedule(self,
+                                    self.factory.timeouts.get(self.state))
+
+    def timed_out(self):
+        net_log.debug('%s timed out in state %s', self.peer, self.state)
+        self.transport.abortConnection()
+
+    def end_handshake(self):
+        if self.in_handshake:
+            self.in_handshake = False
+            self.factory.limiter.end()
         
     def connectionLost(self, reason):
-        if self.peer in self.connections:
-            del self.connections[self.peer]
+        self.closed = True
+        sessions.dec()
+        self.end_handshake()
+        self.factory.wheel.cancel(self)
+        if self.factory.connections.get(self.peer) is self:
+            del self.factory.connections[self.peer]
 
-    def rawDataReceived(self, data):
-        print('packet recieved from', self.transport.getPeer(),
-              'state is', self.state,
-              'and contain', data)
+    def sendLine(self, line):
+        auth_out.record(line[0], len(line))
+        self.transport.write(line)
 
-        #request from one of world servers
-        if self.peer in [realm['address'] for realm in realms]\
-           and data[0] == 255:
-            self.handle_WORLDSERVER(data)
-            self.state = "WORLDSERVER"
-        #client request types 
-        elif  self.state == "CHALLENGE":
-            self.handle_CHALLENGE(data)
-        elif self.state == "PROOF":
-            self.handle_PROOF(data)
-        elif self.state == "REALMLIST":
-            self.handle_REALMLIST(data)
-        else:
-            self.handle_ERROR(data, state)
+    def dataReceived(self, data):
+        try:
+            self.framer.feed(data)
+        except FrameError as e:
+            self.handle_FRAME_ERROR(e)
+            return
+        self.process()
+
+    def process(self):
+        'Handles buffered packets in order, one at a time'
+        if self.processing:
+            return
+        self.processing = True
+        try:
+            while self.waiting is None:
+                packet = self.framer.next()
+                if packet is None:
+                    return
+                auth_in.record(packet[0], len(packet))
+                d = self.dispatch(packet)
+                if isinstance(d, defer.Deferred):
+                    self.waiting = d
+                    #if d has result already, resume is called right here
+                    d.addBoth(self.resume)
+        except FrameError as e:
+            self.handle_FRAME_ERROR(e)
+        finally:
+            self.processing = False
+
+    def resume(self, result):
+        self.waiting = None
+        self.process()
+        return result
+
+    def dispatch(self, data):
+        if packet_log.isEnabledFor(DEBUG):
+            packet_log.debug('from %s state %s: %r',
+                             self.peer, self.state, data)
+
+        return auth_dispatch.dispatch(self, data)
 
     def handle_CHALLENGE(self, data):
+        if not self.factory.limiter.begin():
+            shed_total.labels('handshakes').inc()
+            self.sendLine(RS_SERVER_LOGON_CHALLENGE()
+                          .encode_error(WOW_FAIL_DB_BUSY))
+            self.transport.loseConnection()
+            return None
+        self.in_handshake = True
+        self.received = time.perf_counter()
+        logins_started.inc()
 
         username = RS_CLIENT_LOGON_CHALLENGE(data).decode()
-        account = db_session.query(Account)\
-                    .filter(Account.username == username)\
-                    .first()
-        if account:
-            pwHash = account.pwHash
-        else: raise Exception("Guy {0} tryed to log in"\
-                              .format([username]) )
-        self.SRP6Engine\
-            .process_rs_logon_challenge(username, pwHash)
-        resp_dict = self.SRP6Engine.get_raw_challenge_values()
+        d = self.factory.accounts.get(username)
+        d.addCallback(self.calculate_CHALLENGE, username)
+        d.addCallback(self.send_CHALLENGE)
+        d.addErrback(self.handle_FAILURE)
+        return d
+
+    def calculate_CHALLENGE(self, account, username):
+        if self.closed:
+            return None
+        if not account:
+            auth_log.info('%s tried unknown account %r', self.peer, username)
+            logins_failed.labels('unknown_account').inc()
+            self.end_handshake()
+            self.sendLine(RS_SERVER_LOGON_CHALLENGE()
+                          .encode_error(WOW_FAIL_UNKNOWN_ACCOUNT))
+            self.transport.loseConnection()
+            return None
+        self.username, self.account_id = username, account['id']
+        if account['verifier']:
+            return self.factory.srp.challenge(username,
+                                      Salt=bytes.fromhex(account['salt']),
+                                      verifier=bytes.fromhex(account['verifier']))
+        #verifier couldn't be saved, see AccountStore.store_verifier
+        d = self.factory.srp.challenge(username, account['pwHash'],
+                                       Salt=os.urandom(32))
+        d.addCallback(self.remember_VERIFIER, username)
+        return d
+
+    def remember_VERIFIER(self, result, username):
+        state = result[1]
+        self.factory.accounts.remember_verifier(username, state['Salt'], state['v'])
+        return result
+
+    def send_CHALLENGE(self, result):
+        #client is gone, it must not come back to connections or wheel
+        if self.closed or result is None:
+            return
+        resp_dict, self.srp_state = result
         rslc      = RS_SERVER_LOGON_CHALLENGE()
     
         rslc.encode(resp_dict['PublicB'],
                     resp_dict['g'],
                     resp_dict['N'],
                     resp_dict['Salt'])
-        self.connections[self.peer] = self
-        self.state = "PROOF"
+        self.factory.connections[self.peer] = self
+        auth_dispatch.transition(self, "PROOF")
         self.sendLine(rslc.raw)
+        challenge_seconds.observe(time.perf_counter() - self.received)
         
     def handle_PROOF(self, data):
+        self.received = time.perf_counter()
 
         A, M1 = RS_CLIENT_LOGON_PROOF(data).decode()
-        self.SRP6Engine.process_rs_logon_proof(A)
-        our_M1, M2 = self.SRP6Engine.get_M()
+        d = self.factory.srp.proof(self.srp_state, A)
+        d.addCallback(self.send_PROOF, M1)
+        d.addErrback(self.handle_FAILURE)
+        return d
+
+    def send_PROOF(self, result, M1):
+        our_M1, M2, K = result
+        #engine state is not needed after proof
+        self.srp_state = None
+        if self.closed:
+            return None
+        self.end_handshake()
         if not M1 == our_M1:
-            print('this guy not registered')
+            auth_log.info('%s sent wrong proof', self.peer)
+            logins_failed.labels('wrong_proof').inc()
             self.transport.loseConnection()
             return None
         rslp = RS_SERVER_LOGON_PROOF()
         rslp.encode(M2)
-        self.state = "REALMLIST"
+        auth_dispatch.transition(self, "REALMLIST")
         self.sendLine(rslp.raw)
+        if self.factory.reconnect_keys is not None:
+            self.factory.reconnect_keys.put(self.username, self.account_id, K,
+                                    self.peer)
+        self.factory.handoff.push(self.username, self.account_id, K, self.peer)
+        now = time.perf_counter()
+        proof_seconds.observe(now - self.received)
+        login_seconds.observe(now - self.opened)
+        logins_succeeded.inc()
+
+    def handle_RECONNECT_CHALLENGE(self, data):
+        username = RS_CLIENT_RECONNECT_CHALLENGE(data).decode()
+        entry = None
+        if self.factory.reconnect_keys is not None:
+            entry = self.factory.reconnect_keys.get(username)
+        if entry is None:
+            #client falls back to full login
+            auth_log.info('%s reconnect of %s without session key',
+                          self.peer, username)
+            reconnects.labels('unknown').inc()
+            self.transport.loseConnection()
+            return
+        self.username = username
+        self.account_id, self.K, address = entry
+        self.server_random = os.urandom(16)
+        self.factory.connections[self.peer] = self
+        auth_dispatch.transition(self, "RECONNECT_PROOF")
+        self.sendLine(RS_SERVER_RECONNECT_CHALLENGE()
+                      .encode(self.server_random))
+
+    def handle_RECONNECT_PROOF(self, data):
+        received = time.perf_counter()
+        R1, R2 = RS_CLIENT_RECONNECT_PROOF(data).decode()
+        if reconnect_digest(self.username, R1, self.server_random,
+                            self.K) != R2:
+            auth_log.info('%s sent wrong reconnect proof', self.peer)
+            reconnects.labels('wrong_proof').inc()
+            self.transport.loseConnection()
+            return
+        auth_dispatch.transition(self, "REALMLIST")
+        self.sendLine(RS_SERVER_RECONNECT_PROOF().encode())
+        #world servers may have dropped the key already
+        self.factory.handoff.push(self.username, self.account_id, self.K,
+                                  self.peer)
+        self.K = self.server_random = None
+        reconnect_seconds.observe(time.perf_counter() - received)
+        reconnects.labels('ok').inc()
 
     def handle_REALMLIST(self,data):
 
         if RS_CLIENT_REALM_LIST(data).decode() != 16:
             #0x10 command is realmlist request. 
             return
-        rsrl = RS_SERVER_REALM_LIST()
-        print('realms',realms)
-        rsrl.encode(realms)
-        self.sendLine(rsrl.raw)
-
-    def handle_ERROR(self, data, state):
-        print(self.peer,
-              'send this',
-              data,
-              'while it state was',
-              state,
-              'and it is not ok')
-        
+        received = time.perf_counter()
+        self.deadline()
+        self.sendLine(self.factory.realm_list.encode())
+        realmlist_seconds.observe(time.perf_counter() - received)
+
+    def handle_FRAME_ERROR(self, error):
+        net_log.warning('%s bad stream: %s', self.peer, error)
+        logins_failed.labels('bad_stream').inc()
+        self.transport.loseConnection()
+
+    def handle_FAILURE(self, failure):
+        if self.closed:
+            return
+        auth_log.info('%s handshake failed: %s',
+                      self.peer, failure.getErrorMessage())
+        logins_failed.labels('error').inc()
+        self.srp_state = None
+        self.end_handshake()
+        self.transport.loseConnection()
+
     def handle_WORLDSERVER(self, data):
-        print('data from world server ', self.peer, 'is', data)
+        #request from one of world servers
+        if self.peer not in self.factory.world_addresses:
+            auth_dispatch.drop(self, data[0])
+            return
+        auth_dispatch.transition(self, "WORLDSERVER")
+        comm_log.debug('data from world server %s: %r', self.peer, data)
+
+
+#(state, opcode) -> handler of AuthSession, see Dispatch.py
+auth_dispatch = Dispatcher('auth', entered=AuthSession.deadline)
+auth_dispatch.register("CHALLENGE", 0x00, AuthSession.handle_CHALLENGE,
+                       next=["PROOF"])
+auth_dispatch.register("PROOF", 0x01, AuthSession.handle_PROOF,
+                       next=["REALMLIST"])
+auth_dispatch.register("CHALLENGE", 0x02,
+                       AuthSession.handle_RECONNECT_CHALLENGE,
+                       next=["RECONNECT_PROOF"])
+auth_dispatch.register("RECONNECT_PROOF", 0x03,
+                       AuthSession.handle_RECONNECT_PROOF,
+                       next=["REALMLIST"])
+auth_dispatch.register("REALMLIST", 0x10, AuthSession.handle_REALMLIST)
+auth_dispatch.register(ANY, 0xFF, AuthSession.handle_WORLDSERVER,
+                       next=["WORLDSERVER"])
 
         
 class RealmServer(Factory):
-    def __init__(self):
+    def __init__(self, bignum_backend='openssl',
+                 workers_mode='inline', workers=0, accounts=None,
+                 max_buffer=4096, realm_list=None, population=None,
+                 limiter=None, handoff=None, reconnect_keys=None, srp=None,
+                 timeouts=None, wheel=None):
         self.connections = {}
+        #state -> seconds, see default_timeouts
+        self.timeouts = default_timeouts if timeouts is None else timeouts
+        #wheel is empty at start, so it is false
+        if wheel is None:
+            wheel = TimerWheel(reactor, 'auth')
+        self.wheel = wheel
+        #world servers which get session keys
+        self.handoff = handoff or Handoff()
+        #see SessionKeys.KeyStore, None -> reconnect is refused
+        self.reconnect_keys = reconnect_keys
+        if reconnect_keys is not None:
+            keys_cached.set_function(lambda: len(reconnect_keys))
+        #rate limits and handshake cap, none by default
+        self.limiter = limiter or Limiter()
+        handshakes.set_function(lambda: self.limiter.in_flight)
+        self.max_buffer = max_buffer
+        self.realm_list = realm_list or RealmList([])
+        #packets 0xFF are taken only from these addresses
+        self.world_addresses = frozenset(realm['address']
+                                         for realm in self.realm_list)
+        #realm name -> Heartbeat of its world server
+        self.heartbeats = {}
+        #population of realms from world servers reports
+        self.population = population or PopulationPolicy(self.realm_list)
+        #fail on startup, not on first login
+        get_backend(bignum_backend)()
+        self.srp = srp or SRP6Executor(reactor, workers_mode, workers,
+                                       bignum_backend)
+        self.accounts = accounts or AccountStore(reactor=reactor,
+                                                 cache=AccountCache())
+    def startFactory(self):
+        self.wheel.start()
+
+    def stopFactory(self):
+        self.wheel.stop()
+
     def buildProtocol(self, addr):
-        return AuthSession(self.connections)
+        return AuthSession(self)
+
+    def heartbeat_stats(self):
+        'Round trip time and missed beats of every world server'
+        return {name: hb.stats() for name, hb in self.heartbeats.items()}
 
     
-class Communicator(ClientFactory):
+class Communicator(ReconnectingClientFactory):
+    '''
+    Connection to one world server. Reconnects with exponential backoff
+    up to maxDelay seconds.
+    '''
+    def __init__(self, heartbeat, population, handoff, interval=5,
+                 max_delay=60):
+        self.heartbeat = heartbeat
+        self.population = population
+        self.handoff = handoff
+        self.interval = interval
+        self.maxDelay = max_delay
+
     def startedConnecting(self, connector):
-        print('Started to connect.')
+        comm_log.info('connecting to %s', self.heartbeat.name)
 
     def buildProtocol(self, addr):
-        return CommSession()
+        self.resetDelay()
+        return CommSession(self.heartbeat, self.interval, self.population,
+                           self.handoff)
 
     def clientConnectionLost(self, connector, reason):
-        print('Lost connection.  Reason:', reason)
+        comm_log.info('lost connection to %s: %s',
+                      self.heartbeat.name, reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
     def clientConnectionFailed(self, connector, reason):
-        print('Connection failed. Reason:', reason)
+        comm_log.info('connection to %s failed: %s',
+                      self.heartbeat.name, reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+
 
+def start_heartbeats(config, realm_list, population, handoff):
+    'Connects to world servers of realm_list, returns realm name -> Heartbeat'
+    online = registry.gauge('world_online', 'World server answers heartbeats',
+                            ['realm'])
+    rtt    = registry.gauge('world_rtt_seconds', 'Heartbeat round trip time',
+                            ['realm'])
+    interval   = config.getfloat('heartbeat', 'interval', fallback=5)
+    max_missed = config.getint('heartbeat', 'max_missed', fallback=3)
+    max_delay  = config.getfloat('heartbeat', 'reconnect_max_delay', fallback=60)
+    heartbeats = {}
+    for realm in realm_list:
+        hb = heartbeats[realm['name']] = Heartbeat(realm['name'], realm_list,
+                                                   max_missed)
+        online.labels(realm['name']).set_function(lambda hb=hb: hb.online)
+        rtt.labels(realm['name']).set_function(lambda hb=hb: hb.rtt)
+        reactor.connectTCP(realm['address'], realm['comm_port'],
+                           Communicator(hb, population, handoff, interval,
+                                        max_delay))
+    return heartbeats
 
 
 if __name__ == '__main__':
-    log.startLogging(sys.stdout)
-    comm = Communicator()
-    for realm in realms:
-        reactor.connectTCP(realm['address'], realm['comm_port'], comm)
+    if len(sys.argv) < 2: raise Exception(
+            'Give the config file! Defalut run is:\n'+\
+            'python Server/RealmServer.py RealmServer.ini\n'+\
+            'Default RealmServer.ini in root progect directory.')
+
+    config = configparser.ConfigParser()
+    config.read(sys.argv[1])
+    realms = load_realms(config)
+    #number of worker started by supervisor, see Supervisor.py
+    worker = None
+    if '--worker' in sys.argv:
+        worker = int(sys.argv[sys.argv.index('--worker') + 1])
+    processes = config.getint('supervisor', 'processes', fallback=1)
+
+    ServerLog.start(config, reactor)
+    net_log.info('event loop: %s', event_loop)
         
     realm_port = int(config['net']['realm_port'])
-    server = RealmServer()        
-    reactor.listenTCP(realm_port, server)
+    realm_list = RealmList(realms)
+    population = PopulationPolicy(
+        realm_list,
+        config.getfloat('population', 'full_ratio', fallback=1.0),
+        config.getboolean('population', 'recommend', fallback=True))
+    metrics_port = config.getint('metrics', 'port', fallback=0)
+    if metrics_port and worker is not None:
+        metrics_port += 1 + worker
+
+    if processes > 1 and worker is None:
+        #supervisor keeps world server heartbeats, workers handle logins
+        supervisor = Supervisor.Supervisor(
+            reactor, Supervisor.listen_socket(realm_port), processes,
+            realm_list, [os.path.abspath(sys.argv[0]), sys.argv[1]],
+            Handoff(),
+            config.getfloat('supervisor', 'restart_delay', fallback=1))
+        start_heartbeats(config, realm_list, population, supervisor.handoff)
+        Metrics.start(reactor, metrics_port,
+                      config.get('metrics', 'interface', fallback='127.0.0.1'),
+                      config.getfloat('metrics', 'lag_interval', fallback=0.5))
+        supervisor.start()
+        reactor.run()
+        sys.exit()
+
+    bignum_backend = config.get('auth', 'bignum_backend', fallback='openssl')
+    workers_mode   = config.get('auth', 'workers_mode', fallback='inline')
+    workers        = config.getint('auth', 'workers', fallback=0)
+    accounts = AccountStore(
+        config.get('database', 'url', fallback=None),
+        config.getint('database', 'pool_size', fallback=5),
+        config.getfloat('database', 'statement_timeout', fallback=0),
+        reactor,
+        AccountCache(config.getint('cache', 'size', fallback=10000),
+                     config.getfloat('cache', 'ttl', fallback=300),
+                     config.getfloat('cache', 'negative_ttl', fallback=30)))
+    max_buffer = config.getint('net', 'max_buffer', fallback=4096)
+    #limits are for whole server, each worker gets its part
+    share = processes if worker is not None else 1
+    max_handshakes = config.getint('limits', 'max_handshakes', fallback=0)
+    limiter = Limiter(
+        config.getfloat('limits', 'ip_rate', fallback=0) / share,
+        config.getint('limits', 'ip_burst', fallback=1) // share,
+        config.getfloat('limits', 'global_rate', fallback=0) / share,
+        config.getint('limits', 'global_burst', fallback=1) // share,
+        (max_handshakes + share - 1) // share)
+    reconnect_keys = None
+    if config.getboolean('reconnect', 'enabled', fallback=True):
+        reconnect_keys = KeyStore(
+            config.getfloat('reconnect', 'ttl', fallback=600),
+            size=config.getint('reconnect', 'size', fallback=50000))
+    #ephemeral keys made ahead, see AuthWorkers.EphemeralPool
+    srp = SRP6Executor(reactor, workers_mode, workers, bignum_backend,
+                       config.getint('auth', 'pool_size', fallback=0),
+                       config.getint('auth', 'pool_low_water', fallback=0),
+                       config.getint('auth', 'pool_batch', fallback=64),
+                       config.getfloat('auth', 'pool_refill_rate', fallback=0))
+    timeout = lambda name: config.getfloat('timeouts', name,
+                                           fallback=default_timeouts[name.upper()])
+    timeouts = {'CHALLENGE'       : timeout('challenge'),
+                'PROOF'           : timeout('proof'),
+                'RECONNECT_PROOF' : timeout('proof'),
+                'REALMLIST'       : timeout('realmlist'),
+                'WORLDSERVER'     : timeout('worldserver')}
+    wheel = TimerWheel(reactor, 'auth',
+                       config.getfloat('timeouts', 'resolution', fallback=1),
+                       batch=config.getint('timeouts', 'batch', fallback=1000))
+    server = RealmServer(bignum_backend, workers_mode, workers, accounts,
+                         max_buffer, realm_list, population, limiter,
+                         reconnect_keys=reconnect_keys, srp=srp,
+                         timeouts=timeouts, wheel=wheel)
+
+    try:
+        Metrics.start(reactor, metrics_port,
+                      config.get('metrics', 'interface', fallback='127.0.0.1'),
+                      config.getfloat('metrics', 'lag_interval', fallback=0.5))
+        if worker is None:
+            server.heartbeats = start_heartbeats(config, realm_list,
+                                                 population, server.handoff)
+            EventLoop.listen(reactor, server, realm_port)
+        else:
+            Supervisor.start_worker(reactor, server)
+    except Exception:
+        if worker is None:
+            raise
+        #worker exits and closes inherited socket, supervisor starts it again
+        net_log.exception('worker %d failed to start', worker)
+        sys.exit(1)
     reactor.run()
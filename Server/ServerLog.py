@@ -0,0 +1,150 @@
+'''
+Logging of servers.
+
+Records are put into bounded queue and written by separate thread, so
+reactor never waits for terminal, pipe or disk. If writer can't keep up,
+new records are dropped and counted instead of blocking.
+
+Every category is its own logger with its own level, see [log] and
+[log_categories] in RealmServer.ini. Packet dumps are the hot path, they
+are sampled and rate limited, and callers check packet_log.isEnabledFor
+before building the message.
+'''
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+from logging import DEBUG, INFO, WARNING, ERROR
+
+
+categories = ('net', 'auth', 'comm', 'packets', 'world', 'twisted')
+
+def get_logger(category):
+    return logging.getLogger('pywow.' + category)
+
+net_log    = get_logger('net')
+auth_log   = get_logger('auth')
+comm_log   = get_logger('comm')
+packet_log = get_logger('packets')
+world_log  = get_logger('world')
+
+
+class Sampler(logging.Filter):
+    '''
+    Passes every sample-th record, and not more than rate records per
+    second (0 -> no limit). Passed record tells how many were skipped
+    before it.
+
+    >>> now = [0.0]
+    >>> s = Sampler(sample=2, rate=2, clock=lambda: now[0])
+    >>> records = [logging.makeLogRecord({'msg': 'x'}) for i in range(9)]
+    >>> [s.filter(r) for r in records[:8]]
+    [True, False, True, False, False, False, False, False]
+    >>> now[0] = 1.0
+    >>> s.filter(records[8]), records[8].getMessage()
+    (True, 'x [5 skipped]')
+    '''
+
+    def __init__(self, sample=1, rate=0, clock=time.monotonic):
+        logging.Filter.__init__(self)
+        self.sample  = max(sample, 1)
+        self.rate    = rate
+        self.clock   = clock
+        self.count   = 0
+        self.skipped = 0
+        self.window  = None
+        self.passed  = 0
+
+    def filter(self, record):
+        self.count += 1
+        if (self.count - 1) % self.sample:
+            self.skipped += 1
+            return False
+        if self.rate:
+            second = int(self.clock())
+            if second != self.window:
+                self.window = second
+                self.passed = 0
+            if self.passed >= self.rate:
+                self.skipped += 1
+                return False
+            self.passed += 1
+        if self.skipped:
+            record.msg = '{0} [{1} skipped]'.format(record.msg, self.skipped)
+            self.skipped = 0
+        return True
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    '''
+    Puts records into queue without waiting, records which don't fit
+    are dropped and counted. Message is formatted by writer thread.
+    '''
+
+    def __init__(self, queue):
+        logging.handlers.QueueHandler.__init__(self, queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def start(config, reactor=None):
+    '''
+    Configures loggers from [log] and [log_categories] sections of
+    config and starts writer thread, which is stopped on reactor
+    shutdown or process exit. Twisted log goes to 'twisted' category.
+    Returns QueueHandler.
+    '''
+    root = logging.getLogger('pywow')
+    root.setLevel(config.get('log', 'level', fallback='INFO').upper())
+    root.propagate = False
+    if config.has_section('log_categories'):
+        for category, level in config.items('log_categories'):
+            get_logger(category).setLevel(level.upper())
+    packet_log.addFilter(
+        Sampler(config.getint('log', 'packet_sample', fallback=1),
+                config.getint('log', 'packet_rate', fallback=0)))
+
+    path = config.get('log', 'file', fallback='')
+    if path:
+        writer = logging.FileHandler(path)
+    else:
+        writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    handler  = QueueHandler(
+        queue.Queue(config.getint('log', 'queue_size', fallback=10000)))
+    listener = logging.handlers.QueueListener(handler.queue, writer)
+    root.addHandler(handler)
+    listener.start()
+
+    from twisted.python import log
+    log.startLoggingWithObserver(log.PythonLoggingObserver('pywow.twisted').emit,
+                                 setStdout=False)
+    stopped = []
+    def stop():
+        'Writes records which are still queued, only once'
+        if not stopped:
+            stopped.append(True)
+            listener.stop()
+    #process can exit without reactor shutdown, see RealmServer worker
+    atexit.register(stop)
+    if reactor is not None:
+        reactor.addSystemEventTrigger('after', 'shutdown', stop)
+    return handler
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,165 @@
+'''
+Session keys of accounts which logged in on realm server.
+
+Realm server sends SESSION_KEY to world servers after right proof (see
+CommPackets.py), world server keeps it for ttl seconds, so client is
+checked by lookup instead of database query. KeyStore is kept in memory
+of one process, FileKeyStore is sqlite file which all world server
+processes of one host share. Realm server keeps its own KeyStore of
+recent logins for AUTH_RECONNECT, so clients which lost connection
+prove they have session key with one hash instead of SRP6 exchange.
+'''
+import sqlite3
+import struct
+import time
+from collections import OrderedDict
+from hashlib import sha1
+
+
+def auth_digest(username, client_seed, server_seed, K):
+    'Digest of CMSG_AUTH_SESSION, seeds are uint32'
+    return sha1(username.encode('ascii') + bytes(4)
+                + struct.pack('<II', client_seed, server_seed) + K).digest()
+
+def reconnect_digest(username, client_random, server_random, K):
+    'R2 of AUTH_RECONNECT_PROOF, randoms are 16 bytes'
+    return sha1(username.encode('ascii') + client_random
+                + server_random + K).digest()
+
+
+class KeyStore:
+    '''
+    username -> (account id, session key, client address) for ttl
+    seconds after put. Keys are kept in order of expiry, expired ones
+    are dropped on put, the oldest ones too when there are more than
+    size of them (0 -> no limit).
+
+    >>> now = [0]
+    >>> keys = KeyStore(ttl=10, clock=lambda: now[0])
+    >>> keys.put('PLAYER', 4, bytes(40), '127.0.0.1')
+    >>> keys.get('PLAYER')[0], len(keys)
+    (4, 1)
+    >>> digest = auth_digest('PLAYER', 1, 2, bytes(40))
+    >>> keys.verify('PLAYER', 1, 2, digest), keys.verify('PLAYER', 1, 3, digest)
+    (4, None)
+    >>> now[0] = 10
+    >>> keys.get('PLAYER') is None, len(keys)
+    (True, 0)
+    >>> keys = KeyStore(ttl=10, size=2, clock=lambda: now[0])
+    >>> for name in ('A', 'B', 'C'): keys.put(name, 1, bytes(40))
+    >>> keys.get('A'), len(keys)
+    (None, 2)
+    '''
+
+    def __init__(self, ttl=300, clock=time.monotonic, size=0):
+        self.ttl   = ttl
+        self.clock = clock
+        self.size  = size
+        #username -> (expires, account id, K, address)
+        self.keys  = OrderedDict()
+
+    def __len__(self):
+        self.expire()
+        return len(self.keys)
+
+    def put(self, username, account_id, K, address=None):
+        self.keys[username] = (self.clock() + self.ttl, account_id, K, address)
+        self.keys.move_to_end(username)
+        self.expire()
+        if self.size:
+            while len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+
+    def get(self, username):
+        'Returns (account id, K, address) or None'
+        entry = self.keys.get(username)
+        if entry is None:
+            return None
+        if entry[0] <= self.clock():
+            del self.keys[username]
+            return None
+        return entry[1:]
+
+    def expire(self):
+        now = self.clock()
+        while self.keys:
+            username, entry = next(iter(self.keys.items()))
+            if entry[0] > now:
+                break
+            del self.keys[username]
+
+    def verify(self, username, client_seed, server_seed, digest):
+        'Account id if client proved it has session key, else None'
+        entry = self.get(username)
+        if entry is None:
+            return None
+        account_id, K, address = entry
+        if auth_digest(username, client_seed, server_seed, K) != digest:
+            return None
+        return account_id
+
+
+class FileKeyStore(KeyStore):
+    '''
+    The same as KeyStore, kept in sqlite file. Every process which opens
+    the file sees keys put by others.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'keys.db')
+    >>> now = [100.0]
+    >>> a = FileKeyStore(path, ttl=10, clock=lambda: now[0])
+    >>> b = FileKeyStore(path, ttl=10, clock=lambda: now[0])
+    >>> a.put('PLAYER', 4, bytes(40))
+    >>> b.get('PLAYER')[0], len(b)
+    (4, 1)
+    >>> now[0] = 110.0
+    >>> b.get('PLAYER') is None
+    True
+    '''
+
+    def __init__(self, path, ttl=300, clock=time.time):
+        #expiry is wall time, monotonic clocks of processes differ
+        self.ttl   = ttl
+        self.clock = clock
+        self.db    = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=OFF')
+        self.db.execute('CREATE TABLE IF NOT EXISTS session_keys '
+                        '(username TEXT PRIMARY KEY, expires REAL, '
+                        'account_id INTEGER, K BLOB, address TEXT)')
+
+    def __len__(self):
+        return self.db.execute('SELECT count(*) FROM session_keys '
+                               'WHERE expires > ?',
+                               (self.clock(),)).fetchone()[0]
+
+    def put(self, username, account_id, K, address=None):
+        self.db.execute('INSERT OR REPLACE INTO session_keys '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (username, self.clock() + self.ttl, account_id,
+                         K, address))
+
+    def get(self, username):
+        row = self.db.execute('SELECT account_id, K, address '
+                              'FROM session_keys '
+                              'WHERE username = ? AND expires > ?',
+                              (username, self.clock())).fetchone()
+        if row is None:
+            return None
+        return (row[0], bytes(row[1]), row[2])
+
+    def expire(self):
+        self.db.execute('DELETE FROM session_keys WHERE expires <= ?',
+                        (self.clock(),))
+
+
+def open_store(store='memory', ttl=300):
+    'KeyStore for "memory", else FileKeyStore in file store'
+    if store == 'memory':
+        return KeyStore(ttl)
+    return FileKeyStore(store, ttl)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,281 @@
+'''
+Realm server in several processes, so logins use all cores.
+
+Supervisor opens realm_port and starts worker processes
+(RealmServer.py config --worker N). Workers inherit listening socket as
+fd 3 and accept clients from it, each one with its own RealmServer.
+Heartbeats and population of world servers are kept only by
+supervisor, changed realms are sent to workers. Addresses in
+connections of one worker are sent to others through supervisor, so
+one address has one login at a time in all workers. Session keys of
+logins in workers go to world servers through supervisor too, and to
+other workers for AUTH_RECONNECT.
+
+Messages are JSON lines: workers read them from fd 4 and write to fd 5.
+Dead worker is started again after restart_delay seconds, worker stops
+when supervisor is gone.
+'''
+import json
+import os
+import socket
+import sys
+
+from ServerLog import net_log
+import EventLoop
+
+from twisted.internet.error import ReactorNotRunning
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols.basic import LineReceiver
+
+
+#file descriptors of worker
+LISTEN_FD   = 3
+CONTROL_IN  = 4
+CONTROL_OUT = 5
+
+
+def listen_socket(port, interface='', backlog=50):
+    'Listening socket for workers, supervisor never accepts from it'
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+def encode(message):
+    return json.dumps(message).encode('utf-8') + b'\n'
+
+def realm_message(realm):
+    return {'op': 'realm', 'name': realm['name'],
+            'fields': {field: value for field, value in realm.items()
+                       if field != 'name'}}
+
+
+class SharedConnections(dict):
+    '''
+    connections of AuthSession in worker. Sessions of this worker are
+    in dict itself, addresses which have session in other workers are
+    in remote. Own addresses are reported with send.
+
+    >>> sent = []
+    >>> c = SharedConnections(sent.append)
+    >>> c['1.1.1.1'] = 'session'
+    >>> c.remote.add('2.2.2.2')
+    >>> '1.1.1.1' in c, '2.2.2.2' in c, c.get('2.2.2.2')
+    (True, True, None)
+    >>> del c['1.1.1.1']
+    >>> [(m['op'], m['address']) for m in sent]
+    [('add', '1.1.1.1'), ('remove', '1.1.1.1')]
+    '''
+
+    def __init__(self, send):
+        dict.__init__(self)
+        self.send   = send
+        self.remote = set()
+
+    def __contains__(self, address):
+        return dict.__contains__(self, address) or address in self.remote
+
+    def __setitem__(self, address, session):
+        if not dict.__contains__(self, address):
+            self.send({'op': 'add', 'address': address})
+        dict.__setitem__(self, address, session)
+
+    def __delitem__(self, address):
+        dict.__delitem__(self, address)
+        self.send({'op': 'remove', 'address': address})
+
+
+class WorkerChannel(LineReceiver):
+    '''
+    Worker side of pipes to supervisor. Applies realm changes, addresses
+    and session keys of other workers, stops reactor when supervisor is
+    gone.
+    '''
+    delimiter = b'\n'
+
+    def __init__(self, reactor, realm_list, keys=None):
+        self.reactor     = reactor
+        self.realm_list  = realm_list
+        self.connections = SharedConnections(self.send)
+        #reconnect keys of server, see SessionKeys.KeyStore
+        self.keys        = keys
+
+    def send(self, message):
+        if self.transport is not None:
+            self.transport.write(encode(message))
+
+    def lineReceived(self, line):
+        message = json.loads(line)
+        op = message['op']
+        if op == 'realm':
+            self.realm_list.update(message['name'], **message['fields'])
+        elif op == 'add':
+            self.connections.remote.add(message['address'])
+        elif op == 'remove':
+            self.connections.remote.discard(message['address'])
+        elif op == 'session' and self.keys is not None:
+            self.keys.put(message['username'], message['account_id'],
+                          bytes.fromhex(message['K']), message['address'])
+
+    def push(self, username, account_id, K, address):
+        'Session key goes to world servers through supervisor'
+        self.send({'op': 'session', 'username': username,
+                   'account_id': account_id, 'K': K.hex(),
+                   'address': address})
+
+    def connectionLost(self, reason):
+        net_log.info('supervisor is gone, stopping worker')
+        try:
+            self.reactor.stop()
+        except ReactorNotRunning:
+            pass
+
+
+def start_worker(reactor, server):
+    '''
+    Worker process: server accepts from inherited socket, its realm
+    list and connections are kept in sync by supervisor, session keys
+    are sent to world servers by supervisor.
+    '''
+    from twisted.internet.stdio import StandardIO
+    channel = WorkerChannel(reactor, server.realm_list,
+                            server.reconnect_keys)
+    server.connections = channel.connections
+    server.handoff = channel
+    StandardIO(channel, CONTROL_IN, CONTROL_OUT, reactor)
+    return EventLoop.listen(reactor, server, fileno=LISTEN_FD)
+
+
+class WorkerProcess(ProcessProtocol):
+    '''Supervisor side of one worker.'''
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index      = index
+        self.buffer     = b''
+        #addresses with session in this worker
+        self.addresses  = set()
+        #control pipe is closed, worker is stopping
+        self.closed     = False
+
+    def connectionMade(self):
+        net_log.info('worker %d started, pid %d',
+                     self.index, self.transport.pid)
+        self.supervisor.started(self)
+
+    def send(self, message):
+        if self.closed or self.transport is None:
+            return
+        self.transport.writeToChild(CONTROL_IN, encode(message))
+
+    def close(self):
+        'Worker stops when its control pipe is closed'
+        if not self.closed:
+            self.closed = True
+            self.transport.closeChildFD(CONTROL_IN)
+
+    def childDataReceived(self, fd, data):
+        if fd != CONTROL_OUT:
+            return
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self.supervisor.message(self, json.loads(line))
+
+    def processEnded(self, reason):
+        net_log.info('worker %d ended: %s',
+                     self.index, reason.getErrorMessage())
+        self.supervisor.ended(self)
+
+
+class Supervisor:
+    '''
+    Starts count workers which accept from sock and keeps them running.
+    args are command line of worker without its index. Session keys from
+    workers are given to handoff (see RealmServer.Handoff) and to other
+    workers.
+    '''
+
+    def __init__(self, reactor, sock, count, realm_list, args, handoff,
+                 restart_delay=1.0):
+        self.reactor       = reactor
+        self.sock          = sock
+        self.count         = count
+        self.realm_list    = realm_list
+        self.args          = args
+        self.restart_delay = restart_delay
+        self.handoff       = handoff
+        #index -> WorkerProcess
+        self.workers       = {}
+        self.stopping      = False
+        realm_list.watchers.append(self.realm_changed)
+
+    def start(self):
+        for index in range(self.count):
+            self.spawn(index)
+        self.reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def spawn(self, index):
+        if self.stopping:
+            return
+        worker = self.workers[index] = WorkerProcess(self, index)
+        self.reactor.spawnProcess(
+            worker, sys.executable,
+            [sys.executable] + self.args + ['--worker', str(index)],
+            env=os.environ, path=os.getcwd(),
+            childFDs={0: 0, 1: 1, 2: 2, LISTEN_FD: self.sock.fileno(),
+                      CONTROL_IN: 'w', CONTROL_OUT: 'r'})
+
+    def started(self, worker):
+        'New worker gets current realms and addresses of other workers'
+        for realm in self.realm_list:
+            worker.send(realm_message(realm))
+        for other in self.workers.values():
+            if other is not worker:
+                for address in other.addresses:
+                    worker.send({'op': 'add', 'address': address})
+
+    def broadcast(self, message, source=None):
+        if self.stopping:
+            return
+        for worker in self.workers.values():
+            if worker is not source:
+                worker.send(message)
+
+    def message(self, worker, message):
+        op = message['op']
+        if op == 'session':
+            self.handoff.push(message['username'], message['account_id'],
+                              bytes.fromhex(message['K']), message['address'])
+        elif op == 'add':
+            worker.addresses.add(message['address'])
+        elif op == 'remove':
+            worker.addresses.discard(message['address'])
+        self.broadcast(message, worker)
+
+    def realm_changed(self, name):
+        self.broadcast(realm_message(self.realm_list[name]))
+
+    def ended(self, worker):
+        if self.workers.get(worker.index) is worker:
+            del self.workers[worker.index]
+        for address in worker.addresses:
+            self.broadcast({'op': 'remove', 'address': address})
+        if not self.stopping:
+            self.reactor.callLater(self.restart_delay, self.spawn,
+                                   worker.index)
+
+    def stop(self):
+        'Workers stop when their control pipe is closed'
+        self.stopping = True
+        if self.realm_changed in self.realm_list.watchers:
+            self.realm_list.watchers.remove(self.realm_changed)
+        for worker in self.workers.values():
+            worker.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
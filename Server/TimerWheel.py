@@ -0,0 +1,128 @@
+'''
+Deadlines of many connections on one hashed timer wheel.
+
+Time is cut into ticks of resolution seconds, wheel has slots for ticks
+and deadline goes to slot of its tick, deadlines further than one turn
+of wheel wait in their slot for later turns. One LoopingCall advances
+wheel, so 100k connections cost one timer instead of 100k callLater.
+Setting new deadline or cancelling it is dict operation. Expired
+sessions get timed_out() called, not more than batch per tick, rest
+wait for next tick.
+'''
+import itertools
+
+from ServerLog import net_log
+from Metrics import registry
+
+from twisted.internet.task import LoopingCall
+
+
+reaped = registry.counter('connections_reaped_total',
+                          'Connections closed by timeout',
+                          ['protocol', 'state'])
+
+
+class TimerWheel:
+    '''
+    >>> from twisted.internet.task import Clock
+    >>> class Session:
+    ...     state = 'CHALLENGE'
+    ...     def timed_out(self):
+    ...         closed.append(self)
+    >>> clock, closed = Clock(), []
+    >>> wheel = TimerWheel(clock, 'test', resolution=1, slots=4, batch=1)
+    >>> wheel.start()
+    >>> a, b, c = Session(), Session(), Session()
+    >>> wheel.schedule(a, 2)
+    >>> wheel.schedule(b, 2)
+    >>> wheel.schedule(c, 6)
+    >>> clock.advance(2)
+    >>> len(closed), len(wheel)
+    (1, 2)
+    >>> clock.advance(1)
+    >>> len(closed), closed[1] is not c
+    (2, True)
+    >>> wheel.schedule(c, None)
+    >>> clock.advance(10)
+    >>> len(closed), len(wheel), reaped.labels('test', 'CHALLENGE').value
+    (2, 0, 2)
+    '''
+
+    def __init__(self, reactor, protocol, resolution=1.0, slots=512,
+                 batch=1000):
+        self.reactor    = reactor
+        #label of reaped metric
+        self.protocol   = protocol
+        self.resolution = resolution
+        self.batch      = batch
+        #session -> its tick, one dict for each slot
+        self.slots      = [{} for i in range(slots)]
+        #session -> slot where it waits
+        self.where      = {}
+        #tick which was handled last
+        self.tick       = self.now()
+        #expired sessions which didn't fit into batch, in order
+        self.overdue    = {}
+        self.turn       = LoopingCall(self.advance)
+        self.turn.clock = reactor
+
+    def __len__(self):
+        return len(self.where) + len(self.overdue)
+
+    def now(self):
+        return int(self.reactor.seconds() / self.resolution)
+
+    def start(self):
+        self.tick = self.now()
+        self.turn.start(self.resolution, now=False)
+
+    def stop(self):
+        if self.turn.running:
+            self.turn.stop()
+
+    def schedule(self, session, seconds):
+        'New deadline after seconds, None or 0 -> no deadline'
+        self.cancel(session)
+        if not seconds:
+            return
+        #deadline is never earlier than asked
+        tick = self.now() + max(1, -int(-seconds // self.resolution))
+        slot = tick % len(self.slots)
+        self.slots[slot][session] = tick
+        self.where[session] = slot
+
+    def cancel(self, session):
+        slot = self.where.pop(session, None)
+        if slot is not None:
+            del self.slots[slot][session]
+        self.overdue.pop(session, None)
+
+    def advance(self):
+        'Handles all ticks since the last call, closes expired sessions'
+        now = self.now()
+        expired = self.overdue
+        #one turn of wheel visits every slot
+        for tick in range(self.tick + 1,
+                          min(now, self.tick + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            due = [session for session, deadline in slot.items()
+                   if deadline <= now]
+            for session in due:
+                del slot[session]
+                del self.where[session]
+                expired[session] = tick
+        self.tick = now
+        closing = list(itertools.islice(expired, self.batch))
+        for session in closing:
+            del expired[session]
+        for session in closing:
+            reaped.labels(self.protocol, session.state).inc()
+            session.timed_out()
+        if closing:
+            net_log.info('%s: %d connections timed out, %d wait for next tick',
+                         self.protocol, len(closing), len(expired))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,27 +1,149 @@
-import operator
 import os
 import struct
-from functools import reduce
-from cryptography.hazmat.backends.openssl import backend
 
-RAND_bytes = backend._lib.RAND_bytes
-Cnew       = backend._ffi.new  
-buffer     = backend._ffi.buffer
 
 
+#result codes of failed logon challenge
+WOW_FAIL_UNKNOWN_ACCOUNT = 0x04
+WOW_FAIL_DB_BUSY         = 0x08
+
 
 def align(byte_arr, length):
     'Add null bytes in right of bytestring, sum size = length'
     return byte_arr + bytes(length - len(byte_arr))
 
+class Layout:
+    '''
+    Compiled description of packet fields.
+    fields is sequence of (name, format), where format is one of
+    struct format of single field ('B', 'H', 'I', 'f', '32s'...),
+    'p' - bytes prefixed with uint8 length,
+    'z' - null terminated ascii string.
+    Neighbouring fixed size fields are compiled into one struct.Struct,
+    all numbers are little-endian like in WoW protocol.
+
+    >>> l = Layout([('cmd', 'B'), ('size', 'H'), ('g', 'p'),
+    ...             ('name', 'z'), ('M', '4s')])
+    >>> raw = l.pack({'cmd': 1, 'size': 2, 'g': b'\\x07',
+    ...               'name': 'PYWOW', 'M': b'ab'})
+    >>> raw
+    b'\\x01\\x02\\x00\\x01\\x07PYWOW\\x00ab\\x00\\x00'
+    >>> l.size({'g': b'\\x07', 'name': 'PYWOW'}) == len(raw)
+    True
+    >>> values, end = l.unpack_from(memoryview(raw))
+    >>> values['g'], values['name'], values['M'], end
+    (b'\\x07', 'PYWOW', b'ab\\x00\\x00', 15)
+    '''
+
+    def __init__(self, fields):
+        self.names = [name for name, fmt in fields]
+        #value of field which is not given to pack
+        self.defaults = {name: b'' if fmt.endswith('s') else 0
+                         for name, fmt in fields}
+        #fields with size depending on value
+        self.variable = [name for name, fmt in fields if fmt in ('p', 'z')]
+        #steps are (struct.Struct, names, their (name, default) pairs)
+        #or (kind, name, None)
+        self.steps = []
+        run = []
+        for name, fmt in fields:
+            if fmt in ('p', 'z'):
+                self._close_run(run)
+                run = []
+                self.steps.append((fmt, name, None))
+            else:
+                run.append((name, fmt))
+        self._close_run(run)
+        self.fixed_size = sum(step.size for step, names, pairs in self.steps
+                              if isinstance(step, struct.Struct))
+
+    def _close_run(self, run):
+        if run:
+            names = tuple(name for name, fmt in run)
+            self.steps.append(
+                (struct.Struct('<' + ''.join(fmt for name, fmt in run)),
+                 names,
+                 tuple((name, self.defaults[name]) for name in names)))
+
+    def size(self, values):
+        'Size of packed values in bytes'
+        #one byte for length or for null in the end
+        return self.fixed_size + sum(len(values[name]) + 1
+                                     for name in self.variable)
+
+    def pack_into(self, buf, offset, values):
+        '''
+        Writes values into preallocated buffer, returns offset
+        of first byte after them.
+        '''
+        get = values.get
+        for step, names, pairs in self.steps:
+            if pairs is not None:
+                step.pack_into(buf, offset,
+                               *[get(name, default) for name, default in pairs])
+                offset += step.size
+            elif step == 'p':
+                value = values[names]
+                end = offset + 1 + len(value)
+                buf[offset] = len(value)
+                buf[offset + 1:end] = value
+                offset = end
+            else:
+                value = values[names].encode('ascii')
+                end = offset + len(value)
+                buf[offset:end] = value
+                buf[end] = 0
+                offset = end + 1
+        return offset
+
+    def pack(self, values):
+        buf = bytearray(self.size(values))
+        self.pack_into(buf, 0, values)
+        return bytes(buf)
+
+    def unpack_from(self, view, offset=0):
+        '''
+        Reads fields from memoryview (or bytes) starting with offset,
+        returns (dict of values, offset after them).
+        '''
+        values = {}
+        for step, names, pairs in self.steps:
+            if step == 'p':
+                length = view[offset]
+                values[names] = bytes(view[offset + 1:offset + 1 + length])
+                offset += 1 + length
+            elif step == 'z':
+                end = offset
+                while view[end]:
+                    end += 1
+                values[names] = str(view[offset:end], 'ascii')
+                offset = end + 1
+            else:
+                values.update(zip(names, step.unpack_from(view, offset)))
+                offset += step.size
+        return (values, offset)
+
+
 class Packet:
-    '''WoW packet implementation'''
+    '''
+    WoW packet implementation.
+    Subclasses describe their fields in layout.
+    '''
+    layout = Layout([])
+
     def __init__(self, raw=b''):
         self.raw = raw
-        self.raw_iter = iter(raw)
-        self.nb = self.raw_iter.__next__ #next byte from raw request
-        
-    def decode(self, raw):
+
+    def unpack(self):
+        'All fields of packet from client as dict'
+        return self.layout.unpack_from(memoryview(self.raw))[0]
+
+    def pack(self, **values):
+        'Builds raw packet for client from field values'
+        self.raw = self.layout.pack(values)
+        return self.raw
+
+    def decode(self):
         '''if packet from client need to decode it to python values'''
         pass
 
@@ -29,17 +151,14 @@ class Packet:
         '''if packet to client need to encode it from python values'''
         pass
 
-    def reduce_n_bytes_by(self, iterator, func, n):
-        #just repeat interator 4 times and concatenate chars into string
-        return reduce(func, map(lambda x: bytes([iterator.__next__()]), range(n)))
 
 class RS_CLIENT_LOGON_CHALLENGE(Packet):
     '''
     Client->Server
-    When client enter Account name, Account password and click Login 
-    WoW client send this package. 
+    When client enter Account name, Account password and click Login
+    WoW client send this package.
 
-    In this case I enter PLAYER:PLAYER. First packet in python bytes 
+    In this case I enter PLAYER:PLAYER. First packet in python bytes
     representation looks this:
     >>> raw = [0,   3,   36,  0,   87, 111, 87,  0]   + \
               [1,   12,  1,   243, 22, 54,  56,  120] + \
@@ -48,10 +167,27 @@ class RS_CLIENT_LOGON_CHALLENGE(Packet):
               [4,   6,   80,  76,  65, 89,  69,  82]
     >>> raw = bytes(raw)
     >>> packet = RS_CLIENT_LOGON_CHALLENGE(raw=raw).decode()
-    >>> packet 
+    >>> packet
     'PLAYER'
+    >>> RS_CLIENT_LOGON_CHALLENGE().encode('PLAYER')[:4] == raw[:4]
+    True
     '''
-        
+    #Info from here http://www.arcemu.org/wiki/Client_Logon_Challenge#I
+    layout = Layout([('cmd',           'B'),
+                     ('error',         'B'),
+                     ('size',          'H'),
+                     ('gamename',      '4s'),
+                     ('version1',      'B'),
+                     ('version2',      'B'),
+                     ('version3',      'B'),
+                     ('build',         'H'),
+                     ('platform',      '4s'),
+                     ('os',            '4s'),
+                     ('country',       '4s'),
+                     ('timezone_bias', 'I'),
+                     ('ip',            '4s'),
+                     ('I',             'p')])
+
     def decode(self):
         '''
         Content of RS_CLIENT_LOGON_CHALLENGE is
@@ -69,27 +205,21 @@ class RS_CLIENT_LOGON_CHALLENGE(Packet):
         uint32  timezone_bias;
         uint32  ip;
         uint8   I_len;
-        uint8   I[50];        
+        uint8   I[50];
 
-        Info from here http://www.arcemu.org/wiki/Client_Logon_Challenge#I
+        Returns account name.
         '''
-        
-        cmd      = self.nb()
-        error    = self.nb()
-        size     = int(self.nb()) + int(self.nb())
-        gamename = self.reduce_n_bytes_by(self.raw_iter, operator.add,4) 
-        version1 = self.nb()
-        version2 = self.nb()
-        version3 = self.nb()
-        build    = chr(self.nb()) + chr(self.nb())
-        platform = self.reduce_n_bytes_by(self.raw_iter, operator.add,4) 
-        os       = self.reduce_n_bytes_by(self.raw_iter, operator.add,4) 
-        country  = self.reduce_n_bytes_by(self.raw_iter, operator.add,4)
-        timezone_bias = self.reduce_n_bytes_by(self.raw_iter, operator.add,4) 
-        ip       = '.'.join(map(lambda x:str(self.nb()), range(4)))
-        I_len    = int(self.nb())
-        I        = self.reduce_n_bytes_by(self.raw_iter, operator.add,I_len)
-        return str(I, 'ascii')
+        return str(self.unpack()['I'], 'ascii')
+
+    def encode(self, username, build=5875):
+        'Packet of WoW 1.12.1 client on x86 Windows, for tests'
+        I = username.encode('ascii')
+        #size counts bytes after itself
+        return self.pack(cmd=0, error=3, size=self.layout.fixed_size + len(I) - 3,
+                         gamename=b'WoW\x00', version1=1, version2=12,
+                         version3=1, build=build, platform=b'68x\x00',
+                         os=b'niW\x00', country=b'SUne',
+                         ip=bytes([127, 0, 0, 1]), I=I)
 
 
 class RS_SERVER_LOGON_CHALLENGE(Packet):
@@ -110,35 +240,61 @@ class RS_SERVER_LOGON_CHALLENGE(Packet):
     uint8   unk4;
 
     >>> test = RS_SERVER_LOGON_CHALLENGE()
-    >>> test.encode(b'1', b'2', b'3', b'4')
-    >>> 
-
+    >>> len(test.encode(b'1', b'2', b'3', b'4'))
+    119
+    >>> B, g, N, Salt = test.decode()
+    >>> g, len(N), Salt[:1]
+    (b'2', 32, b'4')
+    >>> test.encode_error(WOW_FAIL_DB_BUSY)
+    b'\\x00\\x00\\x08'
     '''
+    layout = Layout([('cmd',   'B'),
+                     ('error', 'B'),
+                     ('unk2',  'B'),
+                     ('B',     '32s'),
+                     ('g',     'p'),
+                     ('N',     'p'),
+                     ('s',     '32s'),
+                     ('unk3',  '16s'),
+                     ('unk4',  'B')])
 
     def encode(self, PublicB, g, N, Salt):
+        #error. no error == 0
+        #length N always should be 32
+        #unk3 is random crc salt
+        return self.pack(cmd=0, error=0, unk2=0, B=PublicB, g=g,
+                         N=align(N, 32), s=Salt, unk3=os.urandom(16),
+                         unk4=0)
 
-        self.raw += bytes([0]) #cmd
-        self.raw += bytes([0]) #error. no error == 0
-        self.raw += bytes([0]) #unknown
-        self.raw += align(PublicB, 32)   #B
-        self.raw += bytes([len(g)]) #length g
-        self.raw += g # g
-        self.raw += bytes([32])#length N. always should be 32
-        self.raw += align(N, 32)# N
-        self.raw += align(Salt, 32)# s
-        crcsalt = Cnew('char[]',16)
-        RAND_bytes(crcsalt, 16)
-        self.raw += buffer(crcsalt)[:]
-        #self.raw += os.urandom(16) #unknown
-        self.raw += bytes([0])
+    def encode_error(self, result):
+        'Refusal without challenge, result is one of WOW_FAIL_* codes'
+        self.raw = bytes([0, 0, result])
         return self.raw
-        
+
+    def decode(self):
+        'Returns (PublicB, g, N, Salt) for client side'
+        values = self.unpack()
+        return (values['B'], values['g'], values['N'], values['s'])
+
+
 class RS_CLIENT_LOGON_PROOF(Packet):
     '''Client->Server
     Second client request.
+    >>> raw = bytes([1]) + bytes(range(32)) + bytes(range(40, 60)) + bytes(22)
+    >>> A, M1 = RS_CLIENT_LOGON_PROOF(raw).decode()
+    >>> A == bytes(range(32)), M1 == bytes(range(40, 60))
+    (True, True)
+    >>> RS_CLIENT_LOGON_PROOF().encode(A, M1) == raw
+    True
     '''
-    
-        
+    #Info from  http://www.arcemu.org
+    layout = Layout([('cmd',            'B'),
+                     ('A',              '32s'),
+                     ('M1',             '20s'),
+                     ('crc_hash',       '20s'),
+                     ('number_of_keys', 'B'),
+                     ('unk',            'B')])
+
     def decode(self):
         '''
         Content of RS_CLIENT_LOGON_PROOF is
@@ -148,16 +304,12 @@ class RS_CLIENT_LOGON_PROOF(Packet):
         uint8   crc_hash[20];
         uint8   number_of_keys;
         uint8   unk;
-
-        Info from  http://www.arcemu.org
         '''
-        cmd      = self.nb()
-        A        = self.reduce_n_bytes_by(self.raw_iter, operator.add,32) 
-        M1       = self.reduce_n_bytes_by(self.raw_iter, operator.add,20)
-        crc_hash = self.reduce_n_bytes_by(self.raw_iter, operator.add,20)
-        number_of_keys = self.nb()
-        unk      = self.nb()
-        return (A, M1)
+        values = self.unpack()
+        return (values['A'], values['M1'])
+
+    def encode(self, A, M1):
+        return self.pack(cmd=1, A=A, M1=M1)
 
 class RS_SERVER_LOGON_PROOF(Packet):
     '''
@@ -167,28 +319,142 @@ class RS_SERVER_LOGON_PROOF(Packet):
     uint8   error;
     uint8   M2[20];
     uint32  accountflags;
+    >>> p = RS_SERVER_LOGON_PROOF()
+    >>> p.encode(bytes(20))
+    >>> p.raw[:2], len(p.raw)
+    (b'\\x01\\x00', 26)
+    >>> p.decode() == (0, bytes(20))
+    True
     '''
+    layout = Layout([('cmd',          'B'),
+                     ('error',        'B'),
+                     ('M2',           '20s'),
+                     ('accountflags', 'I')])
 
     def encode(self, M2):
-        self.raw = bytes([1,0]) + M2 + bytes(4)
+        self.pack(cmd=1, error=0, M2=M2, accountflags=0)
+
+    def decode(self):
+        'Returns (error, M2) for client side'
+        values = self.unpack()
+        return (values['error'], values['M2'])
+
+
+class RS_CLIENT_RECONNECT_CHALLENGE(RS_CLIENT_LOGON_CHALLENGE):
+    '''
+    Client->Server
+    Client which was logged in short time ago sends it instead of
+    RS_CLIENT_LOGON_CHALLENGE, content is the same, only cmd is 2.
+    >>> raw = RS_CLIENT_RECONNECT_CHALLENGE().encode('PLAYER')
+    >>> raw[0], RS_CLIENT_RECONNECT_CHALLENGE(raw).decode()
+    (2, 'PLAYER')
+    '''
+
+    def encode(self, username, build=5875):
+        RS_CLIENT_LOGON_CHALLENGE.encode(self, username, build)
+        self.raw = bytes([2]) + self.raw[1:]
+        return self.raw
+
+
+class RS_SERVER_RECONNECT_CHALLENGE(Packet):
+    '''
+    Server->Client
+    uint8   cmd;
+    uint8   error;
+    uint8   R[16];     random bytes which client hashes with session key
+    uint8   unk[16];
+    >>> p = RS_SERVER_RECONNECT_CHALLENGE()
+    >>> raw = p.encode(bytes(range(16)))
+    >>> len(raw), raw[:2], p.decode() == bytes(range(16))
+    (34, b'\\x02\\x00', True)
+    '''
+    layout = Layout([('cmd',   'B'),
+                     ('error', 'B'),
+                     ('R',     '16s'),
+                     ('unk',   '16s')])
+
+    def encode(self, R):
+        return self.pack(cmd=2, error=0, R=R, unk=bytes(16))
+
+    def decode(self):
+        'Returns R for client side'
+        return self.unpack()['R']
+
+
+class RS_CLIENT_RECONNECT_PROOF(Packet):
+    '''
+    Client->Server
+    uint8   cmd;
+    uint8   R1[16];    random bytes of client
+    uint8   R2[20];    sha1(account name, R1, R of server, session key)
+    uint8   R3[20];
+    uint8   number_of_keys;
+    >>> raw = RS_CLIENT_RECONNECT_PROOF().encode(bytes(16), bytes(range(20)))
+    >>> len(raw), RS_CLIENT_RECONNECT_PROOF(raw).decode() == (bytes(16),
+    ...                                                       bytes(range(20)))
+    (58, True)
+    '''
+    layout = Layout([('cmd',            'B'),
+                     ('R1',             '16s'),
+                     ('R2',             '20s'),
+                     ('R3',             '20s'),
+                     ('number_of_keys', 'B')])
+
+    def decode(self):
+        'Returns (R1, R2)'
+        values = self.unpack()
+        return (values['R1'], values['R2'])
+
+    def encode(self, R1, R2):
+        return self.pack(cmd=3, R1=R1, R2=R2, R3=bytes(20))
+
+
+class RS_SERVER_RECONNECT_PROOF(Packet):
+    '''
+    Server->Client
+    uint8   cmd;
+    uint8   error;
+    >>> RS_SERVER_RECONNECT_PROOF().encode()
+    b'\\x03\\x00'
+    >>> RS_SERVER_RECONNECT_PROOF(b'\\x03\\x0e').decode()
+    14
+    '''
+    layout = Layout([('cmd',   'B'),
+                     ('error', 'B')])
+
+    def encode(self, error=0):
+        return self.pack(cmd=3, error=error)
+
+    def decode(self):
+        'Returns error for client side'
+        return self.unpack()['error']
+
 
-        
 class RS_CLIENT_REALM_LIST(Packet):
     '''Client->Server
     Client asks server what realms are avaiable.
     Packet contains:
     uint8 cmd;
+    uint32 unk;
+    >>> RS_CLIENT_REALM_LIST(bytes([16, 0, 0, 0, 0])).decode()
+    16
+    >>> RS_CLIENT_REALM_LIST().encode()
+    b'\\x10\\x00\\x00\\x00\\x00'
     '''
-        
+    layout = Layout([('cmd', 'B'),
+                     ('unk', 'I')])
+
     def decode(self):
         '''
         Content of RS_CLIENT_REALM_LIST is only '10' byte and 4 null bytes.
         Info from  wireshark dump
         '''
-        cmd      = self.nb()
-        return int(cmd)
+        return self.unpack()['cmd']
+
+    def encode(self):
+        return self.pack(cmd=16)
+
 
-    
 class RS_SERVER_REALM_LIST(Packet):
     '''Server->Client
     Server answer what realms he have.
@@ -202,54 +468,79 @@ class RS_SERVER_REALM_LIST(Packet):
     uint8 type; 0 if ok
     uint8 status; 0 if online
     uint8 color; 0
-    uint8[8] name; 
-    uint8[15] server_socket; 
-    uint32 population_level; 
+    uint8[8] name;
+    uint8[15] server_socket;
+    uint32 population_level;
     uint8 number_of_charachters;
     uint8 timezone;
     uint32 unk2;
-    
+
+    >>> rl = RS_SERVER_REALM_LIST()
+    >>> raw = rl.encode([{'type': 0, 'isLocked': 0, 'color': 0,
+    ...                   'name': 'PYWOW', 'address': '127.0.0.1',
+    ...                   'game_port': 8085, 'population': 1,
+    ...                   'characters_count': 16, 'timezone': 1}])
+    >>> raw[:9]
+    b'\\x10(\\x00\\x00\\x00\\x00\\x00\\x01\\x00'
+    >>> raw[9:]
+    b'\\x00\\x00\\x00\\x00PYWOW\\x00127.0.0.1:8085\\x00\\x00\\x00\\x80?\\x10\\x01\\x00\\x02\\x00'
+    >>> realm = RS_SERVER_REALM_LIST(raw).decode()[0]
+    >>> realm['name'], realm['address'], realm['game_port'], realm['population']
+    ('PYWOW', '127.0.0.1', 8085, 1.0)
     '''
-        
+    header  = Layout([('cmd',              'B'),
+                      ('packet_size',      'H'),
+                      ('unk1',             'I'),
+                      ('number_of_realms', 'H')])
+    realm   = Layout([('type',             'B'),
+                      ('isLocked',         'B'),
+                      ('unk',              'B'),
+                      ('color',            'B'),
+                      ('name',             'z'),
+                      ('server_socket',    'z'),
+                      ('population',       'f'),
+                      ('characters_count', 'B'),
+                      ('timezone',         'B'),
+                      ('unk2',             'B')])
+    trailer = Layout([('unk3', 'H')])
+
     def encode(self, realms):
-        def align(byte_arr, length):
-            'Add null bytes in right of bytestring, '
-            return byte_arr + bytes(length - len(byte_arr))
-        cmd = bytes([16]) 
-        unk1 = bytes(4) 
-        
-        number_of_realms = struct.pack('h', len(realms))
-
-        body = b''
+        realms = [dict(realm,
+                       server_socket='{0}:{1}'.format(realm['address'],
+                                                      realm['game_port']))
+                  for realm in realms]
+        size = self.header.fixed_size + self.trailer.fixed_size\
+               + sum(self.realm.size(realm) for realm in realms)
+        buf = bytearray(size)
+        #packet_size counts bytes after itself
+        offset = self.header.pack_into(buf, 0, {'cmd'              : 16,
+                                                'packet_size'      : size - 3,
+                                                'number_of_realms' : len(realms)})
         for realm in realms:
-            body += bytes([realm['type']])
-            body += bytes([realm['isLocked']])
-            body += bytes(1) #2 unknown bytes
-            body += bytes([realm['color']])
-            body += bytes(realm['name'], 'ascii') + bytes(1)
-            body += bytes(realm['address'], 'ascii') \
-                    + bytes(':', 'ascii')\
-                    + bytes(str(realm['game_port']), 'ascii')\
-                    + bytes(1)
-
-            #float number to byte representation
-            body += struct.pack('f', realm['population'])
-            body += bytes([realm['characters_count']])
-            body += bytes([realm['timezone']])
-            body += bytes(1)
-
-        body += bytes([2,0])
-            
-        packet_size = struct.pack('h', len(unk1 + number_of_realms + body))
-        self.raw = cmd + packet_size + unk1 + number_of_realms + body
+            offset = self.realm.pack_into(buf, offset, realm)
+        self.trailer.pack_into(buf, offset, {'unk3': 2})
+        self.raw = bytes(buf)
         return self.raw
 
+    def decode(self):
+        'List of realm dicts like encode takes, for client side'
+        view = memoryview(self.raw)
+        header, offset = self.header.unpack_from(view)
+        realms = []
+        for i in range(header['number_of_realms']):
+            realm, offset = self.realm.unpack_from(view, offset)
+            address, port = realm.pop('server_socket').rsplit(':', 1)
+            realm['address']   = address
+            realm['game_port'] = int(port)
+            realms.append(realm)
+        return realms
+
+
 
 
 
-    
 
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
-    
+
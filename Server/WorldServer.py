@@ -1,77 +1,245 @@
-import configparser
 import sys
+import EventLoop
+if __name__ == '__main__' and len(sys.argv) > 1:
+    #reactor of event loop has to be installed before it is imported
+    event_loop = EventLoop.install_from_config(sys.argv[1])
+import configparser
 import socket
 from CommPackets import *
+from CommChannel import CommChannel
+from Framing import Framer, FrameError, world_length
+from Dispatch import Dispatcher
+from SessionKeys import open_store
+from TimerWheel import TimerWheel
+from ServerLog import DEBUG, net_log, world_log, packet_log
+import ServerLog
+from Metrics import registry, Traffic
+import Metrics
 
-from twisted.python import log
-from twisted.internet.protocol import Factory
-from twisted.protocols.basic import LineReceiver
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import LoopingCall
 from twisted.internet import reactor
 
-if len(sys.argv) < 2: raise Exception(
-        'Give the config file! Defalut run is:\n'+\
-        'python Server/WorldServer.py WorldServer.ini\n'+\
-        'Default WorldServer.ini in root progect directory.')
-else: confile = sys.argv[1]
-
-config = configparser.ConfigParser()
-config.read(confile)
 
-game_port  = int(config['net']['game_port'])
-comm_port  = int(config['realm']['comm_port'])
-realm_addr = config['realm']['address']
+#see Metrics.py
+world_in  = Traffic('world', 'in')
+comm_in   = Traffic('comm', 'in')
+comm_out  = Traffic('comm', 'out')
+players   = registry.gauge('world_players', 'Connections to game port')
+session_keys = registry.gauge('world_session_keys',
+                              'Session keys from realm server')
+#seconds without packets before disconnect, see TimerWheel.py.
+#Realm server connection has no deadline
+default_timeouts = {'GAME'    : 300,
+                    'UNKNOWN' : 30}
         
-class GameSession(LineReceiver):
-    delimiter = b''
-    def __init__(self, alive, connections):
-        self.setRawMode()
-        self.alive = alive
-        self.connections = connections
+class GameSession(Protocol):
+    '''
+    Connection to game or comm port: player, realm server or unknown
+    peer. Slots, as there is one for every player.
+
+    Realm server sends session keys of a login burst in one write, it
+    can be more than max_buffer of players:
+    >>> from twisted.internet.task import Clock
+    >>> from twisted.internet.testing import StringTransport
+    >>> from twisted.internet.address import IPv4Address
+    >>> clock = Clock()
+    >>> server = WorldServer(clock=clock)
+    >>> realm = server.buildProtocol(None)
+    >>> realm.makeConnection(StringTransport(
+    ...     hostAddress=IPv4Address('TCP', '127.0.0.1', 8090),
+    ...     peerAddress=IPv4Address('TCP', '127.0.0.1', 40000)))
+    >>> link = StringTransport()
+    >>> channel = CommChannel(clock, link)
+    >>> for i in range(600):
+    ...     channel.send(SESSION_KEY, 'PLAYER{0}'.format(i), i, bytes(40),
+    ...                  '127.0.0.2')
+    >>> clock.advance(0)
+    >>> len(link.value()) > server.max_buffer
+    True
+    >>> realm.dataReceived(link.value())
+    >>> realm.state, len(server.keys), realm.transport.disconnecting
+    ('REALMSERVER', 600, False)
+    '''
+    __slots__ = ('factory', 'transport', 'connected', 'framer', 'report',
+                 'channel', 'state', 'peer')
+
+    def __init__(self, factory):
+        #connections, limits and deadlines are shared in factory
+        self.factory = factory
+        self.framer = Framer(world_length, factory.max_buffer)
+        #population reports, started when realm server talks to us
+        self.report = None
+        #connection of realm server, see CommChannel.py
+        self.channel = None
+        self.state = "GAME"
+        self.peer = None
 
     def connectionMade(self):
         self.peer = self.transport.getPeer()
+        #players are connections to game port
+        if self.transport.getHost().port == self.factory.game_port:
+            self.factory.connections[self.peer] = self
+        #internal packets are taken only from realm server
+        elif self.peer.host == self.factory.realm_addr:
+            self.state = "REALMSERVER"
+            self.framer.max_buffer = self.factory.comm_max_buffer
+            self.channel = CommChannel(self.factory.clock, self.transport,
+                                       comm_out)
+        else:
+            self.state = "UNKNOWN"
+        self.deadline()
+
+    def deadline(self):
+        self.factory.wheel.schedule(self,
+                                    self.factory.timeouts.get(self.state))
+
+    def timed_out(self):
+        net_log.debug('%s idle in state %s', self.peer.host, self.state)
+        self.transport.abortConnection()
         
     def connectionLost(self, reason):
-        if self.peer in self.connections:
-            del self.connections[self.peer]
-
-    def rawDataReceived(self, data):
-        print('packet recieved from', self.peer,
-              'packet contains', data)
-        # 255 is command byte for internal conversation
-        # between servers
-        # this command should be fror realm server address
-        if data[0]       == 255\
-           and self.peer.host == realm_addr: 
-            self.handle_SERVER(data)
-        else: self.handle_GAME(data)
-
-    def handle_SERVER(self, data):
-        print('handle server')
-        # ARE_YOU_ALIVE packet
-        if data == bytes([255,0]):
-            if self.alive:
-                self.sendLine(YES_I_AM_ALIVE().raw)
-            else:
-                self.sendLine(NO_I_AM_DEAD().raw)
-        
-    def handle_GAME(self, data):
-        pass
-    
-    
+        self.factory.wheel.cancel(self)
+        if self.peer in self.factory.connections:
+            del self.factory.connections[self.peer]
+        if self.report is not None and self.report.running:
+            self.report.stop()
+        if self.channel is not None:
+            self.channel.lost(reason)
+
+    def dataReceived(self, data):
+        if self.state == "GAME":
+            self.deadline()
+        try:
+            self.framer.feed(data)
+            for packet in self.framer.packets():
+                if packet[0] == 255:
+                    comm_in.record(comm_type(packet), len(packet))
+                    if self.channel is not None and \
+                       self.channel.received(packet):
+                        continue
+                else:
+                    #uint16 size, then uint32 opcode
+                    world_in.record(int.from_bytes(packet[2:6], 'little'),
+                                    len(packet))
+                self.handle_packet(packet)
+        except FrameError as e:
+            net_log.warning('bad stream from %s: %s', self.peer.host, e)
+            self.transport.loseConnection()
+
+    def handle_packet(self, data):
+        if packet_log.isEnabledFor(DEBUG):
+            packet_log.debug('from %s: %r', self.peer.host, data)
+        world_dispatch.dispatch(self, data)
+
+    def handle_PING(self, data):
+        world_log.debug('packet from realm server %r', data)
+        self.channel.answer(PING(data).request, PONG, self.factory.alive)
+        if self.report is None:
+            self.report = LoopingCall(self.send_POPULATION)
+            self.report.clock = self.factory.clock
+            self.report.start(self.factory.population_interval, now=True)
+
+    def handle_SESSION_KEY(self, data):
+        username, account_id, K, address = SESSION_KEY(data).decode()
+        self.factory.keys.put(username, account_id, K, address)
+
+    def send_POPULATION(self):
+        self.channel.send(POPULATION, len(self.factory.connections),
+                          self.factory.player_limit)
+
+
+def world_opcode(data):
+    '''
+    Internal packets are keyed by (255, type), client packets by uint32
+    opcode after uint16 size
+    '''
+    if data[0] == 255:
+        return (255, comm_type(data))
+    return int.from_bytes(data[2:6], 'little')
+
+#(state, opcode) -> handler of GameSession, see Dispatch.py. Game
+#opcodes are not handled yet, they are counted as dropped
+world_dispatch = Dispatcher('world', world_opcode)
+world_dispatch.register("REALMSERVER", (255, PING.type), GameSession.handle_PING)
+world_dispatch.register("REALMSERVER", (255, SESSION_KEY.type),
+                        GameSession.handle_SESSION_KEY)
+
 
 class WorldServer(Factory):
-    def __init__(self):
+    def __init__(self, player_limit=100, keys=None, timeouts=None,
+                 wheel=None, game_port=8085, realm_addr='127.0.0.1',
+                 population_interval=10, max_buffer=4096,
+                 comm_max_buffer=65536, clock=None):
         self.alive = True
         self.connections = {}
+        self.player_limit = player_limit
+        self.game_port = game_port
+        #internal packets are taken only from this address
+        self.realm_addr = realm_addr
+        #seconds between POPULATION reports to realm server
+        self.population_interval = population_interval
+        #bytes of unfinished packet of player and of realm server
+        self.max_buffer = max_buffer
+        self.comm_max_buffer = comm_max_buffer
+        #reactor of timers, Clock in tests
+        self.clock = reactor if clock is None else clock
+        #session keys of accounts, see SessionKeys.py
+        self.keys = keys if keys is not None else open_store()
+        #state -> seconds, see default_timeouts
+        self.timeouts = default_timeouts if timeouts is None else timeouts
+        #wheel is empty at start, so it is false
+        if wheel is None:
+            wheel = TimerWheel(self.clock, 'world')
+        self.wheel = wheel
+
+    def startFactory(self):
+        self.wheel.start()
+
+    def stopFactory(self):
+        self.wheel.stop()
 
     def buildProtocol(self, addr):
-        return GameSession(self.alive, self.connections)
+        return GameSession(self)
 
     
 if __name__ == '__main__':
-    log.startLogging(sys.stdout)
-    server = WorldServer()
-    reactor.listenTCP(comm_port, server)
-    reactor.listenTCP(game_port, server)
+    if len(sys.argv) < 2: raise Exception(
+            'Give the config file! Defalut run is:\n'+\
+            'python Server/WorldServer.py WorldServer.ini\n'+\
+            'Default WorldServer.ini in root progect directory.')
+
+    config = configparser.ConfigParser()
+    config.read(sys.argv[1])
+    game_port  = int(config['net']['game_port'])
+    comm_port  = int(config['realm']['comm_port'])
+
+    ServerLog.start(config, reactor)
+    net_log.info('event loop: %s', event_loop)
+    ttl = config.getfloat('session_keys', 'ttl', fallback=300)
+    timeouts = {
+        'GAME'    : config.getfloat('timeouts', 'idle',
+                                    fallback=default_timeouts['GAME']),
+        'UNKNOWN' : config.getfloat('timeouts', 'unknown',
+                                    fallback=default_timeouts['UNKNOWN'])}
+    wheel = TimerWheel(reactor, 'world',
+                       config.getfloat('timeouts', 'resolution', fallback=1),
+                       batch=config.getint('timeouts', 'batch', fallback=1000))
+    server = WorldServer(
+        int(config['server']['player_limit']),
+        open_store(config.get('session_keys', 'store', fallback='memory'),
+                   ttl),
+        timeouts, wheel, game_port, config['realm']['address'],
+        config.getfloat('server', 'population_interval', fallback=10),
+        config.getint('net', 'max_buffer', fallback=4096),
+        config.getint('realm', 'max_buffer', fallback=65536))
+    LoopingCall(server.keys.expire).start(ttl, now=False)
+    players.set_function(lambda: len(server.connections))
+    session_keys.set_function(lambda: len(server.keys))
+    Metrics.start(reactor,
+                  config.getint('metrics', 'port', fallback=0),
+                  config.get('metrics', 'interface', fallback='127.0.0.1'),
+                  config.getfloat('metrics', 'lag_interval', fallback=0.5))
+    EventLoop.listen(reactor, server, comm_port)
+    EventLoop.listen(reactor, server, game_port)
     reactor.run()
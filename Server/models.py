@@ -13,6 +13,10 @@ class Account(Base):
     id = Column(Integer, primary_key = True)
     username = Column(String(50))
     pwHash   = Column(String(40))
+    #SRP6 salt and verifier g^x mod N, hex of 32 little-endian bytes.
+    #Filled by database.py backfill
+    salt     = Column(String(64))
+    verifier = Column(String(64))
     gmlevel  = Column(Integer)
     joindate = Column(Time)
 